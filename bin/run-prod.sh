@@ -4,4 +4,5 @@ echo "$GIT_SHA" > static/revision.txt
 exec gunicorn wsgi.app --bind "0.0.0.0:${PORT:-8000}" --error-logfile - --access-logfile - \
                        --workers "${WSGI_NUM_WORKERS:-2}" \
                        --worker-class "${WSGI_WORKER_CLASS:-sync}" \
+                       --worker-connections "${WSGI_WORKER_CONNECTIONS:-1000}" \
                        --log-level "${WSGI_LOG_LEVEL:-warning}"
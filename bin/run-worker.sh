@@ -1,6 +1,22 @@
 #!/bin/bash -ex
 
-exec newrelic-admin run-program celery -A news worker \
-                                       -P "${CELERY_POOL:-prefork}" \
-                                       -l "${CELERY_LOG_LEVEL:-warning}" \
-                                       -c "${CELERY_NUM_WORKERS:-4}"
+worker=(newrelic-admin run-program celery -A news worker
+        -P "${CELERY_POOL:-prefork}"
+        -l "${CELERY_LOG_LEVEL:-warning}")
+
+if [[ -z "$CELERY_WORKER_POOLS" ]]; then
+    exec "${worker[@]}" -c "${CELERY_NUM_WORKERS:-4}" ${CELERY_QUEUES:+-Q "$CELERY_QUEUES"}
+fi
+
+# one worker per "queue[,queue...]:concurrency" entry, e.g.
+# CELERY_WORKER_POOLS="basket-interactive-sfdc,basket-interactive-sfmc:4 basket-bulk-sfmc:2"
+pids=()
+for pool in $CELERY_WORKER_POOLS; do
+    queues="${pool%%:*}"
+    "${worker[@]}" -c "${pool##*:}" -Q "$queues" -n "${queues%%,*}@%h" &
+    pids+=($!)
+done
+
+# stop them all when one stops so that the whole thing gets restarted
+trap 'kill -TERM "${pids[@]}" 2> /dev/null' EXIT INT TERM
+wait -n
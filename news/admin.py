@@ -1,8 +1,9 @@
 from django.conf import settings
 from django.contrib import admin, messages
 
-from news.models import (APIUser, BlockedEmail, FailedTask, Interest, LocaleStewards, Newsletter,
-                         NewsletterGroup, QueuedTask, SMSMessage, TransactionalEmailMessage)
+from news.models import (APIUser, BlockedEmail, DelayedTask, FailedTask, Interest, LocaleStewards,
+                         Newsletter, NewsletterGroup, QueuedTask, SMSMessage,
+                         TransactionalEmailMessage)
 
 
 class TransactionalEmailAdmin(admin.ModelAdmin):
@@ -95,6 +96,23 @@ class QueuedTaskAdmin(admin.ModelAdmin):
     retry_task_action.short_description = u'Process task(s)'
 
 
+class DelayedTaskAdmin(admin.ModelAdmin):
+    list_display = ('due', 'name', 'retries')
+    list_filter = (TaskNameFilter,)
+    search_fields = ('name',)
+    date_hierarchy = 'due'
+    actions = ['release_task_action']
+
+    def release_task_action(self, request, queryset):
+        """Admin action to retry some tasks now instead of when they're due"""
+        count = 0
+        for delayed_task in queryset:
+            delayed_task.release()
+            count += 1
+        messages.info(request, 'Queued %d task%s to try again' % (count, '' if count == 1 else 's'))
+    release_task_action.short_description = u'Retry task(s) now'
+
+
 class FailedTaskAdmin(admin.ModelAdmin):
     list_display = ('when', 'name', 'formatted_call', 'exc')
     list_filter = (TaskNameFilter,)
@@ -116,6 +134,7 @@ admin.site.register(TransactionalEmailMessage, TransactionalEmailAdmin)
 admin.site.register(SMSMessage, SMSMessageAdmin)
 admin.site.register(APIUser, APIUserAdmin)
 admin.site.register(BlockedEmail, BlockedEmailAdmin)
+admin.site.register(DelayedTask, DelayedTaskAdmin)
 admin.site.register(FailedTask, FailedTaskAdmin)
 admin.site.register(QueuedTask, QueuedTaskAdmin)
 admin.site.register(Interest, InterestAdmin)
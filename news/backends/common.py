@@ -1,7 +1,16 @@
 from functools import wraps
+from threading import Condition, Event, Lock
 from time import time
 
+from django.conf import settings
+from django.core.cache import cache
+
+import requests
+from basket import errors
 from django_statsd.clients import statsd
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.packages import six
+from requests.packages.urllib3.util.retry import Retry
 
 
 class UnauthorizedException(Exception):
@@ -12,9 +21,11 @@ class UnauthorizedException(Exception):
 class NewsletterException(Exception):
     """Error when trying to talk to the the email server."""
 
-    def __init__(self, msg=None, error_code=None, status_code=None):
+    def __init__(self, msg=None, error_code=None, status_code=None, retry_after=None):
         self.error_code = error_code
         self.status_code = status_code
+        # the Retry-After header of the vendor response, if any
+        self.retry_after = retry_after
         super(NewsletterException, self).__init__(msg)
 
 
@@ -26,6 +37,165 @@ class NewsletterNoResultsException(NewsletterException):
     pass
 
 
+class CircuitOpenException(NewsletterException):
+    """A vendor has been failing, so calls to it are refused until it recovers."""
+
+    def __init__(self, name):
+        super(CircuitOpenException, self).__init__(
+            '{} is unavailable'.format(name.upper()),
+            error_code=errors.BASKET_NETWORK_FAILURE,
+            status_code=503)
+
+
+class VendorRetry(Retry):
+    """
+    Retry failed connections for any request, but retry errors after the request was
+    sent (e.g. a reset keep-alive connection) only for idempotent methods, so that a
+    record is never created twice.
+    """
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None,
+                  _stacktrace=None):
+        if (error and self._is_read_error(error) and
+                (method or '').upper() not in self.method_whitelist):
+            six.reraise(type(error), error, _stacktrace)
+
+        return super(VendorRetry, self).increment(method, url, response, error, _pool,
+                                                  _stacktrace)
+
+
+class VendorSession(requests.Session):
+    """
+    A requests Session for talking to a vendor API.
+
+    Uses pooled keep-alive connections, default connect and read timeouts, and retries
+    on connection errors, all configured in settings. Reports pool metrics to statsd
+    after each response.
+    """
+    def __init__(self, name):
+        super(VendorSession, self).__init__()
+        self.name = name
+        self.timeout = (settings.VENDOR_HTTP_CONNECT_TIMEOUT, settings.VENDOR_HTTP_READ_TIMEOUT)
+        retries = VendorRetry(total=settings.VENDOR_HTTP_RETRIES,
+                              connect=settings.VENDOR_HTTP_RETRIES,
+                              read=settings.VENDOR_HTTP_RETRIES,
+                              redirect=False,
+                              backoff_factor=0.1)
+        adapter = HTTPAdapter(pool_connections=settings.VENDOR_HTTP_POOL_SIZE,
+                              pool_maxsize=settings.VENDOR_HTTP_POOL_SIZE,
+                              max_retries=retries)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+        if not settings.VENDOR_HTTP_KEEP_ALIVE:
+            self.headers['Connection'] = 'close'
+
+        self.hooks['response'].append(self.record_pool_stats)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(VendorSession, self).request(method, url, **kwargs)
+
+    def pool_stats(self):
+        """
+        Return a dict with the number of connections opened, requests sent, and idle
+        connections in all of this session's connection pools.
+        """
+        stats = {'connections': 0, 'requests': 0, 'idle': 0}
+        for adapter in set(self.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+
+                stats['connections'] += pool.num_connections
+                stats['requests'] += pool.num_requests
+                if pool.pool is not None:
+                    stats['idle'] += sum(1 for conn in list(pool.pool.queue) if conn)
+
+        return stats
+
+    def record_pool_stats(self, response, **kwargs):
+        prefix = 'news.backends.http.{}.'.format(self.name)
+        for name, value in self.pool_stats().items():
+            statsd.gauge(prefix + name, value, rate=0.5)
+
+
+_vendor_sessions = {}
+
+
+def vendor_call_timeout():
+    """Return the longest a vendor call can take in seconds, with all of its retries"""
+    # backoff_factor of VendorRetry is small enough to round up into the extra second
+    attempts = settings.VENDOR_HTTP_RETRIES + 1
+    return int((settings.VENDOR_HTTP_CONNECT_TIMEOUT + settings.VENDOR_HTTP_READ_TIMEOUT) *
+               attempts) + 1
+
+
+def get_vendor_session(name):
+    """Return the shared VendorSession for a vendor in this process"""
+    session = _vendor_sessions.get(name)
+    if session is None:
+        session = _vendor_sessions.setdefault(name, VendorSession(name))
+
+    return session
+
+
+class ConcurrencyLimit(object):
+    """
+    Decorator that limits how many calls to a vendor each process makes at once.
+
+    Meant for gevent workers, where hundreds of requests can be waiting on a vendor at
+    the same time. Calls beyond `VENDOR_MAX_CONCURRENCY` wait up to
+    `VENDOR_CONCURRENCY_WAIT` seconds for another to finish, then fail with a
+    BASKET_NETWORK_FAILURE error. A limit of 0 turns this off.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.metric_prefix = 'news.backends.{}.concurrency.'.format(name)
+        self.active = 0
+        self._cond = Condition(Lock())
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if not settings.VENDOR_MAX_CONCURRENCY:
+                return f(*args, **kwargs)
+
+            self.acquire()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.release()
+
+        return wrapped
+
+    def acquire(self):
+        give_up = time() + settings.VENDOR_CONCURRENCY_WAIT
+        with self._cond:
+            if self.active >= settings.VENDOR_MAX_CONCURRENCY:
+                statsd.incr(self.metric_prefix + 'wait')
+
+            while self.active >= settings.VENDOR_MAX_CONCURRENCY:
+                remaining = give_up - time()
+                if remaining <= 0:
+                    statsd.incr(self.metric_prefix + 'timeout')
+                    raise NewsletterException(
+                        'Too many concurrent {} requests'.format(self.name.upper()),
+                        error_code=errors.BASKET_NETWORK_FAILURE,
+                        status_code=503)
+
+                self._cond.wait(remaining)
+
+            self.active += 1
+            statsd.gauge(self.metric_prefix + 'active', self.active, rate=0.5)
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+
 def get_timer_decorator(prefix):
     """
     Decorator for timing and counting requests to the API
@@ -55,3 +225,221 @@ def get_timer_decorator(prefix):
         return wrapped
 
     return decorator
+
+
+class BatchItem(object):
+    """A single value waiting in a Batcher, and the result of sending it."""
+
+    def __init__(self, value):
+        self.value = value
+        self.result = None
+        self.error = None
+        self.done = Event()
+
+
+class Batcher(object):
+    """
+    Collect values submitted by concurrent callers in this process (threads or
+    greenlets) and send them to the vendor in groups.
+
+    The first caller for a key waits up to `max_wait` seconds for others to join
+    its batch, then calls `flush_func(key, values)`. A batch that reaches
+    `max_size` is sent right away by the caller that filled it. `flush_func`
+    must return one result per value, in order. A result that is an exception
+    is raised in the caller that submitted that value, so each caller still
+    sees its own success or failure.
+    """
+
+    def __init__(self, name, flush_func, max_size, max_wait):
+        self.name = name
+        self.flush_func = flush_func
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._lock = Lock()
+        self._pending = {}
+
+    def submit(self, key, value):
+        item = BatchItem(value)
+        with self._lock:
+            batch = self._pending.setdefault(key, [])
+            batch.append(item)
+            is_leader = len(batch) == 1
+            if len(batch) >= self.max_size:
+                del self._pending[key]
+                ready = batch
+            else:
+                ready = None
+
+        if ready is None and is_leader:
+            # returns early if a full batch containing this item was sent
+            if self.max_wait:
+                item.done.wait(self.max_wait)
+
+            with self._lock:
+                if self._pending.get(key) is batch:
+                    del self._pending[key]
+                    ready = batch
+
+        if ready is not None:
+            self._flush(key, ready)
+
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+
+        return item.result
+
+    def _flush(self, key, batch):
+        statsd.incr(self.name + '.batch.flush')
+        statsd.incr(self.name + '.batch.items', len(batch))
+        try:
+            results = self.flush_func(key, [item.value for item in batch])
+            if len(results) != len(batch):
+                raise NewsletterException('Expected {} batch results, got {}'.format(
+                    len(batch), len(results)))
+        except Exception as e:
+            for item in batch:
+                item.error = e
+        else:
+            for item, result in zip(batch, results):
+                if isinstance(result, Exception):
+                    item.error = result
+                else:
+                    item.result = result
+        finally:
+            for item in batch:
+                item.done.set()
+
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half-open'
+CIRCUIT_STATE_VALUES = {
+    CIRCUIT_CLOSED: 0,
+    CIRCUIT_HALF_OPEN: 1,
+    CIRCUIT_OPEN: 2,
+}
+
+
+class CircuitBreaker(object):
+    """
+    Decorator that stops calling a vendor that keeps failing.
+
+    The state is shared by all processes through the cache:
+
+    * closed: calls go through. Once `VENDOR_CIRCUIT_BREAKER_THRESHOLD` of them fail
+      within `VENDOR_CIRCUIT_BREAKER_WINDOW` seconds the circuit opens.
+    * open: calls raise CircuitOpenException right away, for
+      `VENDOR_CIRCUIT_BREAKER_RESET_TIMEOUT` seconds.
+    * half-open: one call at a time is let through as a trial. The circuit closes if
+      it succeeds and opens again if it fails.
+
+    Only the exceptions in `failures` count as failures. Any other result, including
+    other errors, means the vendor responded.
+    """
+
+    def __init__(self, name, failures):
+        self.name = name
+        self.failures = failures
+        self.metric_prefix = 'news.backends.{}.circuit.'.format(name)
+        self.cache_prefix = 'backends:{}:circuit:'.format(name)
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if not settings.VENDOR_CIRCUIT_BREAKER_ENABLE:
+                return f(*args, **kwargs)
+
+            state = self.before_call()
+            try:
+                result = f(*args, **kwargs)
+            except self.failures as e:
+                self.record_failure(state, e)
+                raise
+            except Exception:
+                self.record_success(state)
+                raise
+
+            self.record_success(state)
+            return result
+
+        return wrapped
+
+    @property
+    def _opened_key(self):
+        return self.cache_prefix + 'opened'
+
+    @property
+    def _trial_key(self):
+        return self.cache_prefix + 'trial'
+
+    def _failures_key(self):
+        window = settings.VENDOR_CIRCUIT_BREAKER_WINDOW
+        return '{}failures:{}'.format(self.cache_prefix, int(time() / window))
+
+    def state(self):
+        opened = cache.get(self._opened_key)
+        if opened is None:
+            return CIRCUIT_CLOSED
+
+        if time() - opened < settings.VENDOR_CIRCUIT_BREAKER_RESET_TIMEOUT:
+            return CIRCUIT_OPEN
+
+        return CIRCUIT_HALF_OPEN
+
+    def before_call(self):
+        """Return the current state, or raise CircuitOpenException if the call can't be made"""
+        state = self.state()
+        statsd.gauge(self.metric_prefix + 'state', CIRCUIT_STATE_VALUES[state], rate=0.5)
+        if state == CIRCUIT_HALF_OPEN:
+            # only one trial call at a time. it must finish within the HTTP timeouts and retries.
+            if cache.add(self._trial_key, True, vendor_call_timeout()):
+                statsd.incr(self.metric_prefix + 'trial')
+                return state
+
+            state = CIRCUIT_OPEN
+
+        if state == CIRCUIT_OPEN:
+            statsd.incr(self.metric_prefix + 'rejected')
+            raise CircuitOpenException(self.name)
+
+        return state
+
+    def record_failure(self, state, exc=None):
+        if exc is not None:
+            # a failed Batcher flush is raised to every caller in the batch, but it was
+            # one call to the vendor
+            if getattr(exc, '_circuit_counted', False):
+                return
+
+            try:
+                exc._circuit_counted = True
+            except AttributeError:
+                pass
+
+        statsd.incr(self.metric_prefix + 'failure')
+        if state == CIRCUIT_HALF_OPEN:
+            self.open()
+            cache.delete(self._trial_key)
+            return
+
+        key = self._failures_key()
+        cache.add(key, 0, settings.VENDOR_CIRCUIT_BREAKER_WINDOW * 2)
+        try:
+            failures = cache.incr(key)
+        except ValueError:
+            # expired between add and incr
+            return
+
+        if failures >= settings.VENDOR_CIRCUIT_BREAKER_THRESHOLD:
+            self.open()
+
+    def record_success(self, state):
+        if state == CIRCUIT_HALF_OPEN:
+            statsd.incr(self.metric_prefix + 'closed')
+            cache.delete_many([self._opened_key, self._trial_key, self._failures_key()])
+
+    def open(self):
+        statsd.incr(self.metric_prefix + 'opened')
+        # removed when a trial call succeeds. the timeout only keeps it from lingering.
+        cache.set(self._opened_key, time(), settings.VENDOR_CIRCUIT_BREAKER_RESET_TIMEOUT * 10)
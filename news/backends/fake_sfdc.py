@@ -0,0 +1,545 @@
+"""
+A stand-in for the parts of the Salesforce.com REST API that basket uses.
+
+Run it with `./manage.py run_fake_sfdc` and set SFDC_LOGIN_URL to its address
+to measure the SFDC backend locally without touching a real org. It keeps
+records in memory and can be made slow, flaky, short on API calls, or quick
+to expire sessions.
+"""
+from __future__ import unicode_literals
+
+import json
+import re
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import datetime
+from itertools import count
+from random import random, uniform
+from SocketServer import ThreadingMixIn
+from threading import Lock
+from time import sleep, time
+from urllib import unquote
+from urlparse import parse_qs, urlparse
+from uuid import uuid4
+
+
+ID_PREFIXES = {
+    'Contact': '003',
+    'Opportunity': '006',
+}
+# fields that work like external IDs for get_by_custom_id
+EXTERNAL_ID_FIELDS = ('Token__c', 'Email')
+API_PATH_RE = re.compile(r'^/services/data/v[\d.]+/(?P<resource>.+?)/?$')
+SOAP_PATH_RE = re.compile(r'^/services/Soap/u/(?P<version>[\d.]+)')
+QUERY_RE = re.compile(r'^\s*SELECT\s+(?P<fields>.+?)\s+FROM\s+(?P<type>\w+)'
+                      r'(?:\s+WHERE\s+(?P<where>.+?))?'
+                      r'(?:\s+ORDER\s+BY\s+(?P<order>\w+(?:\s*,\s*\w+)*)'
+                      r'(?:\s+(?P<direction>ASC|DESC))?)?'
+                      r'(?:\s+LIMIT\s+(?P<limit>\d+))?\s*$', re.IGNORECASE | re.DOTALL)
+CONDITION_RE = re.compile(r"\s*(?P<field>\w+)\s*(?P<op>=|!=|>=|<=|>|<)\s*"
+                          r"(?P<value>'(?:[^'\\]|\\.)*'|[^\s')]+)\s*", re.IGNORECASE)
+JOIN_RE = re.compile(r'\s*(?:(?P<join>AND|OR)\b\s*|$)', re.IGNORECASE)
+CONDITION_OPS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>': lambda a, b: a is not None and a > b,
+    '>=': lambda a, b: a is not None and a >= b,
+    '<': lambda a, b: a is not None and a < b,
+    '<=': lambda a, b: a is not None and a <= b,
+}
+REFERENCE_RE = re.compile(r'@\{(\w+)\.(\w+)\}')
+# UTC datetimes as SOQL literals and Get Deleted parameters, e.g. 2017-06-01T12:00:00Z
+DATETIME_RE = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})(?:\.\d+)?(?:Z|[+-]00:?00)$')
+LOGIN_RESPONSE = """<?xml version="1.0" encoding="UTF-8"?>
+<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/"
+    xmlns="urn:partner.soap.sforce.com">
+<soapenv:Body><loginResponse><result>
+<serverUrl>{server_url}</serverUrl>
+<sessionId>{session_id}</sessionId>
+</result></loginResponse></soapenv:Body></soapenv:Envelope>"""
+
+
+class FakeSFDCError(Exception):
+    def __init__(self, status_code, error_code, message):
+        super(FakeSFDCError, self).__init__(message)
+        self.status_code = status_code
+        self.error_code = error_code
+
+    def body(self):
+        return [{'errorCode': self.error_code, 'message': self.message}]
+
+
+def now_iso():
+    return datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000+0000')
+
+
+def normalize_datetime(value):
+    """Return a UTC datetime string in the form the fake stores them, so they compare as strings"""
+    match = DATETIME_RE.match(value)
+    if not match:
+        raise FakeSFDCError(400, 'INVALID_FIELD', 'Unsupported datetime: ' + value)
+
+    return match.group(1) + '.000+0000'
+
+
+def soql_value(value):
+    if value.startswith("'"):
+        return re.sub(r'\\(.)', r'\1', value[1:-1])
+
+    if DATETIME_RE.match(value):
+        return normalize_datetime(value)
+
+    lower = value.lower()
+    if lower in ('true', 'false'):
+        return lower == 'true'
+
+    if lower == 'null':
+        return None
+
+    return value
+
+
+def resolve_references(text, results):
+    """Replace @{referenceId.field} in text with values from earlier composite subrequests"""
+    def replace(match):
+        try:
+            return results[match.group(1)][match.group(2)]
+        except (KeyError, TypeError):
+            raise FakeSFDCError(400, 'INVALID_REFERENCE',
+                                'Invalid reference specified: ' + match.group(0))
+
+    return REFERENCE_RE.sub(replace, text)
+
+
+def parse_condition(where, pos):
+    match = CONDITION_RE.match(where, pos)
+    if not match:
+        raise FakeSFDCError(400, 'MALFORMED_QUERY', 'Unsupported condition: ' + where[pos:])
+
+    condition = (match.group('field'), match.group('op'), soql_value(match.group('value')))
+    return condition, match.end()
+
+
+def parse_join(where, pos, joins):
+    match = JOIN_RE.match(where, pos)
+    if not match or (match.group('join') or '').upper() not in joins:
+        raise FakeSFDCError(400, 'MALFORMED_QUERY', 'Unsupported condition: ' + where[pos:])
+
+    return match.end()
+
+
+def parse_where(where):
+    """
+    Return a list of alternatives for SOQL conditions joined with AND, each a list of
+    (field, op, value) of which one must match. Conditions in parentheses can be joined
+    with OR, e.g. ``a = 1 AND (b > 2 OR c = 3)``.
+    """
+    conditions = []
+    pos = 0
+    while pos < len(where):
+        if where[pos:].lstrip().startswith('('):
+            pos = where.index('(', pos) + 1
+            alternatives = []
+            while True:
+                condition, pos = parse_condition(where, pos)
+                alternatives.append(condition)
+                if where[pos:].startswith(')'):
+                    pos += 1
+                    break
+
+                pos = parse_join(where, pos, ('OR',))
+        else:
+            condition, pos = parse_condition(where, pos)
+            alternatives = [condition]
+
+        conditions.append(alternatives)
+        pos = parse_join(where, pos, ('AND', ''))
+
+    return conditions
+
+
+class FakeSFDC(object):
+    """
+    In memory records and API accounting for the fake server.
+
+    @param latency: seconds added to each API request
+    @param latency_jitter: up to this many more seconds are added at random
+    @param error_rate: fraction of API requests (0-1) that fail with a 503
+    @param session_timeout: seconds a session is valid for. 0 means it doesn't expire.
+    @param api_limit: daily API request limit reported in sforce-limit-info
+    @param api_used: API requests already used today
+    """
+    def __init__(self, latency=0, latency_jitter=0, error_rate=0, session_timeout=0,
+                 api_limit=1000000, api_used=0):
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.session_timeout = session_timeout
+        self.api_limit = api_limit
+        self.api_used = api_used
+        self.records = {name: {} for name in ID_PREFIXES}
+        # (id, deletedDate) of deleted records
+        self.deleted = {name: [] for name in ID_PREFIXES}
+        self.sessions = {}
+        self.lock = Lock()
+        self.ids = count(1)
+
+    def new_id(self, sobject):
+        return '{}{:015d}'.format(ID_PREFIXES[sobject], next(self.ids))
+
+    def login(self):
+        session_id = uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = (time() + self.session_timeout
+                                         if self.session_timeout else None)
+
+        return session_id
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def check_session(self, auth_header):
+        session_id = (auth_header or '').replace('Bearer ', '', 1)
+        with self.lock:
+            if session_id in self.sessions:
+                expires = self.sessions[session_id]
+                if expires is None or expires > time():
+                    return
+
+                del self.sessions[session_id]
+
+        raise FakeSFDCError(401, 'INVALID_SESSION_ID', 'Session expired or invalid')
+
+    def use_api(self):
+        """Count an API request, failing it if the limit is used up or by chance"""
+        with self.lock:
+            if self.api_used >= self.api_limit:
+                raise FakeSFDCError(403, 'REQUEST_LIMIT_EXCEEDED',
+                                    'TotalRequests Limit exceeded.')
+
+            self.api_used += 1
+
+        if self.latency or self.latency_jitter:
+            sleep(self.latency + uniform(0, self.latency_jitter))
+
+        if self.error_rate and random() < self.error_rate:
+            raise FakeSFDCError(503, 'SERVER_UNAVAILABLE', 'Server temporarily unavailable')
+
+    def limit_info(self):
+        return 'api-usage={}/{}'.format(self.api_used, self.api_limit)
+
+    def _table(self, sobject):
+        try:
+            return self.records[sobject]
+        except KeyError:
+            raise FakeSFDCError(404, 'NOT_FOUND', 'The requested resource does not exist')
+
+    def _find(self, sobject, field, value):
+        return [record for record in self._table(sobject).itervalues()
+                if record.get(field) == value]
+
+    def get(self, sobject, record_id):
+        with self.lock:
+            try:
+                return dict(self._table(sobject)[record_id])
+            except KeyError:
+                raise FakeSFDCError(404, 'NOT_FOUND', 'The requested resource does not exist')
+
+    def get_by_custom_id(self, sobject, field, value):
+        if field == 'Id':
+            return self.get(sobject, value)
+
+        if field not in EXTERNAL_ID_FIELDS:
+            raise FakeSFDCError(400, 'NOT_FOUND', 'Provided external ID field does not exist')
+
+        with self.lock:
+            records = self._find(sobject, field, value)
+
+        if not records:
+            raise FakeSFDCError(404, 'NOT_FOUND', 'The requested resource does not exist')
+
+        if len(records) > 1:
+            raise FakeSFDCError(300, 'MULTIPLE_CHOICES', 'More than one record found')
+
+        return dict(records[0])
+
+    def create(self, sobject, data):
+        data = {k: v for k, v in data.iteritems() if k != 'attributes'}
+        with self.lock:
+            table = self._table(sobject)
+            if data.get('Token__c') and self._find(sobject, 'Token__c', data['Token__c']):
+                raise FakeSFDCError(400, 'DUPLICATE_VALUE',
+                                    'duplicate value found: Token__c')
+
+            record_id = self.new_id(sobject)
+            timestamp = now_iso()
+            data.update(Id=record_id, CreatedDate=timestamp, LastModifiedDate=timestamp)
+            table[record_id] = data
+
+        return record_id
+
+    def update(self, sobject, record_id, data):
+        data = {k: v for k, v in data.iteritems() if k not in ('attributes', 'id', 'Id')}
+        with self.lock:
+            try:
+                record = self._table(sobject)[record_id]
+            except KeyError:
+                raise FakeSFDCError(404, 'NOT_FOUND', 'The requested resource does not exist')
+
+            record.update(data, LastModifiedDate=now_iso())
+
+    def delete(self, sobject, record_id):
+        with self.lock:
+            try:
+                del self._table(sobject)[record_id]
+            except KeyError:
+                raise FakeSFDCError(404, 'NOT_FOUND', 'The requested resource does not exist')
+
+            self.deleted[sobject].append((record_id, now_iso()))
+
+    def get_deleted(self, sobject, start, end):
+        start = normalize_datetime(start)
+        end = normalize_datetime(end)
+        with self.lock:
+            self._table(sobject)
+            deleted = [{'id': record_id, 'deletedDate': deleted_date}
+                       for record_id, deleted_date in self.deleted[sobject]
+                       if start <= deleted_date <= end]
+
+        return {'deletedRecords': deleted, 'earliestDateAvailable': start,
+                'latestDateCovered': end}
+
+    def query(self, soql):
+        match = QUERY_RE.match(soql)
+        if not match:
+            raise FakeSFDCError(400, 'MALFORMED_QUERY', 'Unsupported query')
+
+        fields = [f.strip() for f in match.group('fields').split(',')]
+        conditions = parse_where(match.group('where')) if match.group('where') else []
+        with self.lock:
+            records = [record for record in self._table(match.group('type')).itervalues()
+                       if all(any(CONDITION_OPS[op](record.get(field), value)
+                                  for field, op, value in alternatives)
+                              for alternatives in conditions)]
+
+        if match.group('order'):
+            order = [f.strip() for f in match.group('order').split(',')]
+            records.sort(key=lambda r: [r.get(f) for f in order],
+                         reverse=(match.group('direction') or '').upper() == 'DESC')
+
+        if match.group('limit'):
+            records = records[:int(match.group('limit'))]
+
+        records = [dict({f: record.get(f) for f in fields},
+                        attributes={'type': match.group('type')}) for record in records]
+        return {'totalSize': len(records), 'done': True, 'records': records}
+
+    def collection(self, method, records):
+        results = []
+        for record in records:
+            sobject = record.get('attributes', {}).get('type')
+            try:
+                if method == 'POST':
+                    record_id = self.create(sobject, record)
+                else:
+                    record_id = record.get('id')
+                    self.update(sobject, record_id, record)
+            except FakeSFDCError as e:
+                results.append({'id': None, 'success': False, 'errors': [
+                    {'statusCode': e.error_code, 'message': e.message, 'fields': []}]})
+            else:
+                results.append({'id': record_id, 'success': True, 'errors': []})
+
+        return results
+
+    def composite(self, subrequests, all_or_none=False):
+        """
+        Run the subrequests of a composite request in order.
+
+        Subrequests can refer to the results of earlier ones with @{referenceId.field}.
+        When all_or_none is set and one fails the others are reported as halted and any
+        records they created are removed again.
+        """
+        results = {}
+        responses = []
+        created = []
+        failed = False
+        for sub in subrequests:
+            ref = sub.get('referenceId')
+            if failed and all_or_none:
+                responses.append((ref, 400, None))
+                continue
+
+            try:
+                url = resolve_references(sub['url'], results)
+                body = sub.get('body')
+                if body is not None:
+                    body = json.loads(resolve_references(json.dumps(body), results))
+
+                status, result = self.route(sub['method'], url, body)
+            except FakeSFDCError as e:
+                failed = True
+                responses.append((ref, e.status_code, e.body()))
+            else:
+                results[ref] = result
+                responses.append((ref, status, result))
+                if sub['method'] == 'POST' and status == 201:
+                    created.append((API_PATH_RE.match(urlparse(url).path)
+                                    .group('resource').split('/')[1], result['id']))
+
+        if failed and all_or_none:
+            for sobject, record_id in created:
+                self.delete(sobject, record_id)
+
+            halted = [{'errorCode': 'PROCESSING_HALTED',
+                       'message': 'The transaction was rolled back since another operation '
+                                  'in the same transaction failed.'}]
+            responses = [response if response[2] and response[1] >= 300 else
+                         (response[0], 400, halted) for response in responses]
+
+        return {'compositeResponse': [{'referenceId': response[0], 'httpStatusCode': response[1],
+                                       'body': response[2], 'httpHeaders': {}}
+                                      for response in responses]}
+
+    def route(self, method, path, data=None):
+        """Handle a REST API request and return the status code and response body"""
+        url = urlparse(path)
+        match = API_PATH_RE.match(url.path)
+        if not match:
+            raise FakeSFDCError(404, 'NOT_FOUND', 'The requested resource does not exist')
+
+        parts = match.group('resource').split('/')
+        if parts == ['query'] and method == 'GET':
+            soql = parse_qs(url.query).get('q', [''])[0].decode('utf-8')
+            return 200, self.query(soql)
+
+        if parts == ['composite'] and method == 'POST':
+            return 200, self.composite(data.get('compositeRequest', []),
+                                       data.get('allOrNone', False))
+
+        if parts == ['composite', 'sobjects'] and method in ('POST', 'PATCH'):
+            return 200, self.collection(method, data.get('records', []))
+
+        if parts[0] != 'sobjects' or len(parts) < 2:
+            raise FakeSFDCError(404, 'NOT_FOUND', 'The requested resource does not exist')
+
+        sobject = parts[1]
+        if len(parts) == 2 and method == 'POST':
+            return 201, {'id': self.create(sobject, data), 'success': True, 'errors': []}
+
+        if len(parts) == 3 and parts[2] == 'deleted' and method == 'GET':
+            params = parse_qs(url.query)
+            return 200, self.get_deleted(sobject, params.get('start', [''])[0],
+                                         params.get('end', [''])[0])
+
+        if len(parts) == 3:
+            if method == 'GET':
+                return 200, self.get(sobject, parts[2])
+
+            if method == 'PATCH':
+                self.update(sobject, parts[2], data)
+                return 204, None
+
+            if method == 'DELETE':
+                self.delete(sobject, parts[2])
+                return 204, None
+
+        if len(parts) == 4 and method == 'GET':
+            return 200, self.get_by_custom_id(sobject, parts[2], unquote(parts[3]).decode('utf-8'))
+
+        raise FakeSFDCError(405, 'METHOD_NOT_ALLOWED', 'HTTP Method not allowed')
+
+
+class FakeSFDCHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def read_body(self):
+        if self.body_read:
+            return ''
+
+        self.body_read = True
+        length = int(self.headers.get('content-length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def read_json(self):
+        body = self.read_body()
+        try:
+            return json.loads(body) if body else {}
+        except ValueError:
+            raise FakeSFDCError(400, 'JSON_PARSER_ERROR', 'Invalid JSON')
+
+    def send(self, status_code, body=None, content_type='application/json'):
+        if body is not None and content_type == 'application/json':
+            body = json.dumps(body)
+
+        body = (body or '').encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Sforce-Limit-Info', self.fake.limit_info())
+        self.end_headers()
+        self.wfile.write(body)
+
+    def login(self):
+        self.read_body()
+        version = SOAP_PATH_RE.match(self.path).group('version')
+        server_url = 'http://{}/services/Soap/u/{}/00Dfake'.format(self.headers.get('host'),
+                                                                  version)
+        self.send(200, LOGIN_RESPONSE.format(server_url=server_url,
+                                             session_id=self.fake.login()),
+                  content_type='text/xml')
+
+    def handle_api(self, method):
+        data = self.read_json() if method in ('POST', 'PATCH') else None
+        self.fake.check_session(self.headers.get('authorization'))
+        self.fake.use_api()
+        self.send(*self.fake.route(method, self.path, data))
+
+    def handle_method(self, method):
+        self.body_read = False
+        try:
+            if method == 'POST' and SOAP_PATH_RE.match(self.path):
+                self.login()
+            else:
+                self.handle_api(method)
+        except FakeSFDCError as e:
+            # drop any body we didn't get to so that the connection can be reused
+            self.read_body()
+
+            self.send(e.status_code, e.body())
+
+    def do_GET(self):
+        self.handle_method('GET')
+
+    def do_POST(self):
+        self.handle_method('POST')
+
+    def do_PATCH(self):
+        self.handle_method('PATCH')
+
+    def do_DELETE(self):
+        self.handle_method('DELETE')
+
+
+class FakeSFDCServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # enough for load tests to open hundreds of connections at once
+    request_queue_size = 512
+
+    def __init__(self, address, fake=None, verbose=False):
+        HTTPServer.__init__(self, address, FakeSFDCHandler)
+        self.fake = fake or FakeSFDC()
+        self.verbose = verbose
+
+    @property
+    def url(self):
+        host, port = self.server_address
+        return 'http://{}:{}'.format(host, port)
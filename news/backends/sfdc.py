@@ -1,21 +1,29 @@
 """
 API Client Library for Salesforce.com (SFDC)
 """
+import json
+from hashlib import sha256
 from random import randint
-from time import time
+from threading import Lock
+from time import sleep, time
+from urlparse import urlparse
+from xml.sax.saxutils import escape
 
-import requests
 from django.conf import settings
 from django.core.cache import cache
+from django.db import DatabaseError
 
 import simple_salesforce as sfapi
 from django_statsd.clients import statsd
 from product_details import product_details
 from simple_salesforce.api import DEFAULT_API_VERSION
+from simple_salesforce.util import getUniqueElementValueFromXmlString
 
-from news.backends.common import get_timer_decorator
+from news.backends.common import (Batcher, CircuitBreaker, ConcurrencyLimit, get_timer_decorator,
+                                  get_vendor_session)
 from news.country_codes import convert_country_3_to_2
-from news.newsletters import newsletter_map, newsletter_inv_map, is_supported_newsletter_language
+from news.models import ContactIdIndex, ContactReplica
+from news.newsletters import newsletter_languages, newsletter_map, newsletters_version
 
 
 _BOOLEANS = {'1': True, 'y': True, 'yes': True, 'true': True, 'on': True,
@@ -36,10 +44,43 @@ def cast_lower(value):
 
 
 time_request = get_timer_decorator('news.backends.sfdc')
+# network and server errors count toward opening the circuit
+circuit_breaker = CircuitBreaker('sfdc', (IOError, sfapi.SalesforceGeneralError))
+limit_concurrency = ConcurrencyLimit('sfdc')
 LAST_NAME_DEFAULT_VALUE = '_'
 SFDC_SESSION_CACHE_KEY = 'backends:sfdc:auth:sessionid'
+CONTACT_CACHE_KEY = 'backends:sfdc:contact:{}'
+API_USAGE_CACHE_KEY = 'backends:sfdc:api_usage'
+# forget the usage if no calls have reported it in this long
+API_USAGE_CACHE_TIMEOUT = 600  # 10 min
+# Priorities of work that calls the SFDC API. As usage nears the daily limit
+# low priority work is deferred first, then normal. Interactive work never is.
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_NORMAL = 'normal'
+PRIORITY_LOW = 'low'
+SFDC_SESSION_LOCK_KEY = 'backends:sfdc:auth:lock'
 AUTH_BUFFER = 300  # 5 min
 HERD_TIMEOUT = 60
+MAX_BUFFER = HERD_TIMEOUT + AUTH_BUFFER
+# seconds one process may spend logging in for all of them
+SESSION_LOCK_TIMEOUT = 30
+# seconds to wait for another process to log in, and how often to check
+SESSION_WAIT_TIMEOUT = 10
+SESSION_WAIT_INTERVAL = 0.2
+# sObject Collections and composite requests need at least this version of the REST API
+COLLECTIONS_API_VERSION = '42.0'
+# most records Salesforce accepts in one sObject Collections request
+COLLECTIONS_MAX_RECORDS = 200
+# error codes for a record Id that was deleted, or merged into another record
+STALE_ID_ERRORS = ('NOT_FOUND', 'ENTITY_IS_DELETED')
+# the errors simple_salesforce raises for each status, for failed composite subrequests
+COMPOSITE_EXCEPTIONS = {
+    300: sfapi.SalesforceMoreThanOneRecord,
+    400: sfapi.SalesforceMalformedRequest,
+    401: sfapi.SalesforceExpiredSession,
+    403: sfapi.SalesforceRefusedRequest,
+    404: sfapi.SalesforceResourceNotFound,
+}
 FIELD_MAP = {
     'id': 'Id',
     'record_type': 'RecordTypeId',
@@ -91,6 +132,175 @@ FIELD_MAX_LENGTHS = {
 }
 
 
+class VendorTranslator(object):
+    """
+    Converts contact data between basket and SFDC.
+
+    All of the lookup tables are built once from the newsletter data so that
+    converting a record is only dict lookups. Use `get_translator` to get one
+    for the current newsletter data.
+    """
+    def __init__(self, version=None):
+        self.version = version
+        self.news_map = newsletter_map()
+        self.news_inv_map = {v: k for k, v in self.news_map.iteritems()}
+        self.countries = frozenset(product_details.get_regions('en-US').keys())
+        self.languages = frozenset(lang[:2].lower() for lang in newsletter_languages())
+        self.query_fields = sorted(set(FIELD_MAP.values()) | set(self.news_inv_map))
+        # basket name: (vendor name, processor)
+        self.fields_to_vendor = {name: (vendor_name, PROCESSORS_TO_VENDOR.get(name))
+                                 for name, vendor_name in FIELD_MAP.iteritems()}
+        # vendor name: (basket name, has default, default, processor)
+        self.fields_from_vendor = {vendor_name: (name,
+                                                 name in FIELD_DEFAULTS,
+                                                 FIELD_DEFAULTS.get(name),
+                                                 PROCESSORS_FROM_VENDOR.get(name))
+                                   for name, vendor_name in FIELD_MAP.iteritems()}
+
+    def to_vendor(self, data):
+        """
+        Take data received by basket and convert it to be sent to SFDC
+
+        @param data: dict data received
+        @return:
+        """
+        data = data.copy()
+        contact = {}
+        if data.pop('_set_subscriber', True):
+            contact['Subscriber__c'] = True
+
+        if 'email' in data:
+            for domain in settings.TESTING_EMAIL_DOMAINS:
+                if data['email'].endswith(u'@{}'.format(domain)):
+                    contact['UAT_Test_Data__c'] = True
+
+        if 'country' in data:
+            data['country'] = data['country'].lower()
+            if len(data['country']) == 3:
+                new_country = convert_country_3_to_2(data['country'])
+                if new_country:
+                    data['country'] = new_country
+
+            if data['country'] not in self.countries:
+                # just don't set the country
+                del data['country']
+
+        lang = data.get('lang')
+        if lang:
+            if lang.lower() in settings.EXTRA_SUPPORTED_LANGS:
+                pass
+            elif lang[:2].lower() in self.languages:
+                data['lang'] = lang[:2].lower()
+            else:
+                # use our default language (English) if we don't support the language
+                data['lang'] = 'en'
+
+        for k, v in data.iteritems():
+            if k in self.fields_to_vendor:
+                vendor_name, processor = self.fields_to_vendor[k]
+                if processor:
+                    v = processor(v)
+
+                contact[vendor_name] = v
+
+        news_map = self.news_map
+        newsletters = data.get('newsletters', None)
+        if newsletters:
+            if isinstance(newsletters, dict):
+                # we got newsletter slugs with boolean values
+                for k, v in newsletters.items():
+                    try:
+                        contact[news_map[k]] = v
+                    except KeyError:
+                        pass
+            else:
+                # we got a list of slugs for subscriptions
+                for nl in newsletters:
+                    try:
+                        contact[news_map[nl]] = True
+                    except KeyError:
+                        pass
+
+        # truncate long data
+        for field, length in FIELD_MAX_LENGTHS.items():
+            # SFDC records have None for empty fields
+            if contact.get(field) and len(contact[field]) > length:
+                statsd.incr('news.backends.sfdc.data_truncated')
+                contact[field] = contact[field][:length]
+
+        return contact
+
+    def from_vendor(self, contact):
+        """
+        Take contact data retrieved from SFDC and convert it for ease of use
+
+        @param contact: contact data from SFDC
+        @return:
+        """
+        news_map = self.news_inv_map
+        data = {}
+        newsletters = []
+        for fn, fv in contact.iteritems():
+            if fn in self.fields_from_vendor:
+                data_name, has_default, default, processor = self.fields_from_vendor[fn]
+                if has_default:
+                    fv = fv or default
+                if processor:
+                    fv = processor(fv)
+
+                data[data_name] = fv
+            elif fn in news_map and fv:
+                newsletters.append(news_map[fn])
+
+        data['newsletters'] = newsletters
+        return data
+
+    def diff(self, record, contact):
+        """
+        Return only the fields of contact whose values differ from those of the current record.
+
+        @param record: current contact record as returned by `from_vendor`
+        @param contact: data already converted with `to_vendor`
+        @return: dict of the changed vendor fields
+        """
+        current = self.to_vendor(dict(record, _set_subscriber=False))
+        changes = {}
+        for field, value in contact.iteritems():
+            if field in self.news_inv_map:
+                # records only list the newsletters they are subscribed to
+                changed = bool(value) != bool(current.get(field))
+            elif field == 'Subscriber__c':
+                # not in the records, but anyone subscribed to a newsletter has it set
+                changed = not record.get('newsletters')
+            else:
+                changed = field not in current or current[field] != value
+
+            if changed:
+                changes[field] = value
+
+        return changes
+
+    def to_vendor_many(self, records):
+        return [self.to_vendor(data) for data in records]
+
+    def from_vendor_many(self, contacts):
+        return [self.from_vendor(contact) for contact in contacts]
+
+
+_translator = None
+
+
+def get_translator():
+    """Return the VendorTranslator for the current newsletter data"""
+    global _translator
+    version = newsletters_version()
+    if _translator is None or _translator.version != version:
+        statsd.incr('news.backends.sfdc.translator_rebuild')
+        _translator = VendorTranslator(version)
+
+    return _translator
+
+
 def to_vendor(data):
     """
     Take data received by basket and convert it to be sent to SFDC
@@ -98,70 +308,7 @@ def to_vendor(data):
     @param data: dict data received
     @return:
     """
-    data = data.copy()
-    contact = {}
-    if data.pop('_set_subscriber', True):
-        contact['Subscriber__c'] = True
-
-    if 'email' in data:
-        for domain in settings.TESTING_EMAIL_DOMAINS:
-            if data['email'].endswith(u'@{}'.format(domain)):
-                contact['UAT_Test_Data__c'] = True
-
-    if 'country' in data:
-        data['country'] = data['country'].lower()
-        if len(data['country']) == 3:
-            new_country = convert_country_3_to_2(data['country'])
-            if new_country:
-                data['country'] = new_country
-
-        all_countries = product_details.get_regions('en-US').keys()
-        if data['country'] not in all_countries:
-            # just don't set the country
-            del data['country']
-
-    lang = data.get('lang')
-    if lang:
-        if lang.lower() in settings.EXTRA_SUPPORTED_LANGS:
-            pass
-        elif is_supported_newsletter_language(lang):
-            data['lang'] = lang[:2].lower()
-        else:
-            # use our default language (English) if we don't support the language
-            data['lang'] = 'en'
-
-    for k, v in data.iteritems():
-        if k in FIELD_MAP:
-            if k in PROCESSORS_TO_VENDOR:
-                v = PROCESSORS_TO_VENDOR[k](v)
-
-            contact[FIELD_MAP[k]] = v
-
-    news_map = newsletter_map()
-    newsletters = data.get('newsletters', None)
-    if newsletters:
-        if isinstance(newsletters, dict):
-            # we got newsletter slugs with boolean values
-            for k, v in newsletters.items():
-                try:
-                    contact[news_map[k]] = v
-                except KeyError:
-                    pass
-        else:
-            # we got a list of slugs for subscriptions
-            for nl in newsletters:
-                try:
-                    contact[news_map[nl]] = True
-                except KeyError:
-                    pass
-
-    # truncate long data
-    for field, length in FIELD_MAX_LENGTHS.items():
-        if field in contact and len(contact[field]) > length:
-            statsd.incr('news.backends.sfdc.data_truncated')
-            contact[field] = contact[field][:length]
-
-    return contact
+    return get_translator().to_vendor(data)
 
 
 def from_vendor(contact):
@@ -171,40 +318,333 @@ def from_vendor(contact):
     @param contact: contact data from SFDC
     @return:
     """
-    news_map = newsletter_inv_map()
-    data = {}
-    newsletters = []
-    for fn, fv in contact.iteritems():
-        if fn in INV_FIELD_MAP:
-            data_name = INV_FIELD_MAP[fn]
-            if data_name in FIELD_DEFAULTS:
-                fv = fv or FIELD_DEFAULTS[data_name]
-            if data_name in PROCESSORS_FROM_VENDOR:
-                fv = PROCESSORS_FROM_VENDOR[data_name](fv)
-
-            data[data_name] = fv
-        elif fn in news_map and fv:
-            newsletters.append(news_map[fn])
-
-    data['newsletters'] = newsletters
-    return data
-
-
-def get_sf_session(force=False):
-    if force:
-        session_info = None
+    return get_translator().from_vendor(contact)
+
+
+def vendor_diff(record, contact):
+    """Return the fields of vendor data contact that would change the current record"""
+    return get_translator().diff(record, contact)
+
+
+def to_vendor_many(records):
+    """Convert a list of basket data dicts to be sent to SFDC"""
+    return get_translator().to_vendor_many(records)
+
+
+def from_vendor_many(contacts):
+    """Convert a list of contacts retrieved from SFDC"""
+    return get_translator().from_vendor_many(contacts)
+
+
+def contact_query_fields():
+    """
+    Return the list of contact fields that `from_vendor` uses.
+
+    That is the fields in FIELD_MAP plus those of all known newsletters.
+    """
+    return get_translator().query_fields
+
+
+def soql_quote(value):
+    """Return value as a quoted SOQL string literal"""
+    return u"'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def contact_cache_key(field, value):
+    """Return the cache key for a contact by token or email without using the value in plain text"""
+    key = u'{}:{}'.format(field, value.lower()).encode('utf-8')
+    return CONTACT_CACHE_KEY.format(sha256(key).hexdigest())
+
+
+def contact_cache_keys(*records):
+    """Return the cache keys for the tokens and emails in the given records"""
+    keys = set()
+    for record in records:
+        for field in ('token', 'email'):
+            if record.get(field):
+                keys.add(contact_cache_key(field, record[field]))
+
+    return list(keys)
+
+
+def get_cached_contact(token=None, email=None):
+    field = 'token' if token else 'email'
+    return cache.get(contact_cache_key(field, token or email))
+
+
+def cache_contact(data):
+    keys = contact_cache_keys(data)
+    if keys:
+        cache.set_many({key: data for key in keys}, settings.SFDC_CONTACT_CACHE_TIMEOUT)
+
+
+def uncache_contact(*records):
+    keys = contact_cache_keys(*records)
+    if keys:
+        cache.delete_many(keys)
+
+
+def indexed_contact(token=None, email=None):
+    """
+    Return a dict with the Contact Id and email recorded for the token or email, or None
+    if it isn't known
+    """
+    if not settings.SFDC_CONTACT_ID_INDEX:
+        return None
+
+    try:
+        contact = ContactIdIndex.get_contact(token, email)
+    except DatabaseError:
+        statsd.incr('news.backends.sfdc.contact_index.error')
+        return None
+
+    statsd.incr('news.backends.sfdc.contact_index.{}'.format('hit' if contact else 'miss'))
+    if contact is None:
+        return None
+
+    return {'id': contact[0], 'email': contact[1]}
+
+
+def indexed_contact_id(token=None, email=None):
+    """Return the Contact Id recorded for the token or email, or None if it isn't known"""
+    contact = indexed_contact(token, email)
+    return contact['id'] if contact else None
+
+
+def index_contact(data):
+    """Record the Contact Id for the token and email in data"""
+    if not (settings.SFDC_CONTACT_ID_INDEX and data.get('id') and data.get('token')):
+        return
+
+    if settings.READ_ONLY_MODE:
+        return
+
+    try:
+        ContactIdIndex.set_id(data['id'], data['token'], data.get('email'))
+    except DatabaseError:
+        # the index is only an optimization. never fail a Salesforce write over it.
+        statsd.incr('news.backends.sfdc.contact_index.error')
+
+
+def index_fetched_contact(data, by_email=False):
+    """
+    Record the Contact Id of a record just fetched from SFDC.
+
+    Only tasks should index what they fetch, since they're the ones that write by Id.
+
+    @param data: the record, with its id
+    @param by_email: True if it was fetched by email. Any other contacts indexed for the
+        email are forgotten since SFDC says it belongs to this one.
+    """
+    if not (settings.SFDC_CONTACT_ID_INDEX and data.get('id') and data.get('token')):
+        return
+
+    if settings.READ_ONLY_MODE:
+        return
+
+    try:
+        ContactIdIndex.set_id(data['id'], data['token'], data.get('email'),
+                              replace_email=by_email)
+    except DatabaseError:
+        statsd.incr('news.backends.sfdc.contact_index.error')
+
+
+def unindex_contact(contact_id):
+    """Forget a Contact Id that was deleted or turned out to be stale"""
+    if not settings.SFDC_CONTACT_ID_INDEX or settings.READ_ONLY_MODE:
+        return
+
+    try:
+        ContactIdIndex.remove(contact_id)
+    except DatabaseError:
+        statsd.incr('news.backends.sfdc.contact_index.error')
+
+
+def is_stale_id_error(exc):
+    """
+    Return True if an SFDC error means the Contact Id used was deleted or merged.
+
+    Other errors, e.g. failed validation, must not be mistaken for a stale index entry.
+    """
+    if isinstance(exc, sfapi.SalesforceResourceNotFound):
+        return True
+
+    if not isinstance(exc, sfapi.SalesforceMalformedRequest):
+        return False
+
+    errors = exc.content
+    if isinstance(errors, dict):
+        errors = [errors]
+    if not isinstance(errors, list):
+        return False
+
+    for error in errors:
+        if isinstance(error, dict):
+            # sObject Collections results have statusCode instead of errorCode
+            code = error.get('errorCode') or error.get('statusCode')
+            if code in STALE_ID_ERRORS:
+                return True
+
+    return False
+
+
+def unreplicate_contact(*records):
+    """Remove the replica copies of contacts basket has changed until they are synced again"""
+    if not settings.SFDC_REPLICA_READS or settings.READ_ONLY_MODE:
+        return
+
+    try:
+        ContactReplica.remove(*records)
+    except DatabaseError:
+        statsd.incr('news.backends.sfdc.replica.error')
+
+
+def api_percent_used():
+    """Return the percent of the daily API limit used as last reported by SFDC, or None"""
+    usage = cache.get(API_USAGE_CACHE_KEY)
+    if not usage:
+        return None
+
+    return float(usage['used']) / float(usage['limit']) * 100
+
+
+def api_call_allowed(priority=PRIORITY_NORMAL):
+    """
+    Return False if work of this priority should wait because the daily API limit is close.
+
+    @param priority: one of the PRIORITY_* constants
+    @return: bool
+    """
+    threshold = {
+        PRIORITY_LOW: settings.SFDC_API_LIMIT_LOW_PRIORITY_PERCENT,
+        PRIORITY_NORMAL: settings.SFDC_API_LIMIT_NORMAL_PRIORITY_PERCENT,
+    }.get(priority)
+    if threshold is None:
+        return True
+
+    percentage = api_percent_used()
+    if percentage is None:
+        return True
+
+    return percentage < threshold
+
+
+# the session this process is using, so the cache isn't checked on every call
+_local_session = {
+    'info': None,
+}
+LOGIN_REQUEST = u"""<?xml version="1.0" encoding="utf-8" ?>
+<env:Envelope xmlns:env="http://schemas.xmlsoap.org/soap/envelope/">
+    <env:Body>
+        <n1:login xmlns:n1="urn:partner.soap.sforce.com">
+            <n1:username>{username}</n1:username>
+            <n1:password>{password}{token}</n1:password>
+        </n1:login>
+    </env:Body>
+</env:Envelope>"""
+
+
+def login_to_url(login_url, username=None, password=None, security_token=None, **kwargs):
+    """
+    Log in with the SOAP API at login_url instead of the Salesforce.com login servers.
+
+    Used to point basket at a stand-in for SFDC such as the run_fake_sfdc command.
+
+    @return: tuple of the session id and the instance URL (e.g. http://localhost:8500)
+    """
+    url = u'{}/services/Soap/u/{}'.format(login_url.rstrip('/'), DEFAULT_API_VERSION)
+    body = LOGIN_REQUEST.format(username=escape(username or ''), password=escape(password or ''),
+                                token=escape(security_token or ''))
+    resp = get_vendor_session('sfdc').post(url, body.encode('utf-8'), headers={
+        'content-type': 'text/xml',
+        'charset': 'UTF-8',
+        'SOAPAction': 'login',
+    })
+    if resp.status_code != 200:
+        raise sfapi.SalesforceAuthenticationFailed(
+            getUniqueElementValueFromXmlString(resp.content, 'sf:exceptionCode'),
+            getUniqueElementValueFromXmlString(resp.content, 'sf:exceptionMessage'))
+
+    server_url = urlparse(getUniqueElementValueFromXmlString(resp.content, 'serverUrl'))
+    session_id = getUniqueElementValueFromXmlString(resp.content, 'sessionId')
+    return session_id, u'{}://{}'.format(server_url.scheme, server_url.netloc)
+
+
+def sf_login():
+    """Log in to SFDC, share the new session in the cache, and return its info"""
+    statsd.incr('news.backends.sfdc.session_refresh')
+    login_settings = settings.SFDC_SETTINGS.copy()
+    login_url = login_settings.pop('login_url', None)
+    if login_url:
+        session_id, instance_url = login_to_url(login_url, **login_settings)
+        sf_instance = urlparse(instance_url).netloc
     else:
+        session_id, sf_instance = sfapi.SalesforceLogin(session=get_vendor_session('sfdc'),
+                                                        **login_settings)
+        instance_url = u'https://' + sf_instance
+
+    session_info = {
+        'id': session_id,
+        'instance': sf_instance,
+        'instance_url': instance_url,
+        'expires': time() + settings.SFDC_SESSION_TIMEOUT,
+    }
+    cache.set(SFDC_SESSION_CACHE_KEY, session_info, settings.SFDC_SESSION_TIMEOUT)
+    return session_info
+
+
+def sf_login_single_flight(is_usable):
+    """
+    Log in to SFDC unless another process is already doing so.
+
+    Only the process that gets the lock logs in. The others wait up to
+    SESSION_WAIT_TIMEOUT seconds for its new session to show up in the cache,
+    and log in themselves only if it doesn't.
+    """
+    if cache.add(SFDC_SESSION_LOCK_KEY, True, SESSION_LOCK_TIMEOUT):
+        try:
+            # another process may have finished logging in just before we got the lock
+            session_info = cache.get(SFDC_SESSION_CACHE_KEY)
+            if is_usable(session_info):
+                return session_info
+
+            return sf_login()
+        finally:
+            cache.delete(SFDC_SESSION_LOCK_KEY)
+
+    statsd.incr('news.backends.sfdc.session_refresh_wait')
+    give_up = time() + SESSION_WAIT_TIMEOUT
+    while time() < give_up:
+        sleep(SESSION_WAIT_INTERVAL)
         session_info = cache.get(SFDC_SESSION_CACHE_KEY)
+        if is_usable(session_info):
+            return session_info
 
-    if session_info is None:
-        statsd.incr('news.backends.sfdc.session_refresh')
-        session_id, sf_instance = sfapi.SalesforceLogin(**settings.SFDC_SETTINGS)
-        session_info = {
-            'id': session_id,
-            'instance': sf_instance,
-            'expires': time() + settings.SFDC_SESSION_TIMEOUT,
-        }
-        cache.set(SFDC_SESSION_CACHE_KEY, session_info, settings.SFDC_SESSION_TIMEOUT)
+    statsd.incr('news.backends.sfdc.session_refresh_wait_timeout')
+    return sf_login()
+
+
+def get_sf_session(stale_id=None):
+    """
+    Return info for a valid SFDC session.
+
+    Uses the session already known to this process if it has one, then the one
+    shared in the cache, and only logs in if neither is usable.
+
+    @param stale_id: ID of a session that should not be used (e.g. SFDC reported it expired)
+    @return: dict with the session id, instance, and expiration time
+    """
+    def is_usable(session_info):
+        return (session_info is not None and session_info['id'] != stale_id and
+                time() + MAX_BUFFER < session_info['expires'])
+
+    session_info = _local_session['info']
+    if not is_usable(session_info):
+        session_info = cache.get(SFDC_SESSION_CACHE_KEY)
+        if not is_usable(session_info):
+            session_info = sf_login_single_flight(is_usable)
+
+        _local_session['info'] = session_info
 
     return session_info
 
@@ -213,28 +653,49 @@ class RefreshingSFType(sfapi.SFType):
     session_id = None
     session_expires = None
     sf_instance = None
+    instance_url = None
 
     def __init__(self, name='Contact'):
         self.sf_version = DEFAULT_API_VERSION
         self.name = name
-        self.request = requests.Session()
+        self.request = get_vendor_session('sfdc')
+        # only one thread or greenlet refreshes this object's session at a time
+        self._session_lock = Lock()
         self.refresh_session()
 
     def _base_url(self):
-        return (u'https://{instance}/services/data/'
-                u'v{version}/sobjects/{name}/').format(instance=self.sf_instance,
+        return (u'{instance_url}/services/data/'
+                u'v{version}/sobjects/{name}/').format(instance_url=self.instance_url,
                                                        name=self.name,
                                                        version=self.sf_version)
 
+    def _collections_url(self):
+        return (u'{instance_url}/services/data/'
+                u'v{version}/composite/sobjects').format(instance_url=self.instance_url,
+                                                         version=COLLECTIONS_API_VERSION)
+
+    def _composite_url(self):
+        return (u'{instance_url}/services/data/'
+                u'v{version}/composite').format(instance_url=self.instance_url,
+                                                version=COLLECTIONS_API_VERSION)
+
     def refresh_session(self):
-        sf_session = get_sf_session()
-        if sf_session['id'] == self.session_id:
-            # no other instance has set a new one yet
-            sf_session = get_sf_session(force=True)
+        stale_id = self.session_id
+        with self._session_lock:
+            if self.session_id != stale_id:
+                # refreshed by another thread or greenlet while this one waited
+                return
+
+            # get a session other than the one this instance has already found to be expired
+            sf_session = get_sf_session(stale_id=stale_id)
+            self._set_session(sf_session)
 
+    def _set_session(self, sf_session):
         self.session_id = sf_session['id']
         self.session_expires = sf_session['expires']
         self.sf_instance = sf_session['instance']
+        # sessions cached before instance_url was added only have the host
+        self.instance_url = sf_session.get('instance_url') or u'https://' + self.sf_instance
         self.base_url = self._base_url()
 
     def session_is_expired(self):
@@ -271,13 +732,109 @@ class RefreshingSFType(sfapi.SFType):
                 statsd.gauge('news.backends.sfdc.daily_api_limit', limit, rate=0.5)
                 percentage = float(usage) / float(limit) * 100
                 statsd.gauge('news.backends.sfdc.percent_daily_api_used', percentage, rate=0.5)
+                # share with all processes so that they can throttle their work
+                cache.set(API_USAGE_CACHE_KEY, {'used': int(usage), 'limit': int(limit)},
+                          API_USAGE_CACHE_TIMEOUT)
 
         return resp
 
+    def _query_url(self):
+        return (u'{instance_url}/services/data/'
+                u'v{version}/query/').format(instance_url=self.instance_url,
+                                             version=self.sf_version)
+
+    def query(self, soql):
+        """
+        Run a SOQL query.
+
+        @param soql: the query string
+        @return: dict of results, with the matching records in 'records'
+        """
+        if self.session_is_expired():
+            self.refresh_session()
+
+        resp = self._call_salesforce('GET', self._query_url(), params={'q': soql})
+        return resp.json()
+
+    def query_more(self, next_records_url):
+        """
+        Get the next batch of results of a query.
+
+        @param next_records_url: the 'nextRecordsUrl' of the previous results
+        @return: dict of results like `query`
+        """
+        if self.session_is_expired():
+            self.refresh_session()
+
+        resp = self._call_salesforce('GET', self.instance_url + next_records_url)
+        return resp.json()
+
+    def collection(self, method, records):
+        """
+        Create (POST) or update (PATCH) several records in one sObject Collections request.
+
+        Records are processed independently (allOrNone is false).
+
+        @param method: 'POST' to create or 'PATCH' to update. Records to update need an 'id'.
+        @param records: list of dicts of vendor field data
+        @return: list of result dicts (id, success, errors) in the same order as `records`
+        """
+        records = [dict(record, attributes={'type': self.name}) for record in records]
+        # call this first so that the URL uses a refreshed instance
+        if self.session_is_expired():
+            self.refresh_session()
+
+        resp = self._call_salesforce(method, self._collections_url(), data=json.dumps({
+            'allOrNone': False,
+            'records': records,
+        }))
+        return resp.json()
+
+    def composite(self, subrequests):
+        """
+        Send several requests for any sObjects in one composite request.
+
+        The requests run in order and later ones can refer to the results of earlier
+        ones, e.g. '@{newContact.id}'. If any fails none of them are saved.
+
+        @param subrequests: list of (reference ID, method, sObject path, body) where the
+            path is relative to sobjects/, e.g. 'Contact/003...'
+        @return: list of subrequest results (dict or None) in the same order
+        @raise SalesforceError: for the first subrequest that failed
+        """
+        # call this first so that the URL uses a refreshed instance
+        if self.session_is_expired():
+            self.refresh_session()
+
+        url = self._composite_url()
+        resp = self._call_salesforce('POST', url, data=json.dumps({
+            'allOrNone': True,
+            'compositeRequest': [{
+                'referenceId': ref,
+                'method': method,
+                'url': u'/services/data/v{}/sobjects/{}'.format(COLLECTIONS_API_VERSION, path),
+                'body': body,
+            } for ref, method, path, body in subrequests],
+        }))
+        results = resp.json()['compositeResponse']
+        for result in results:
+            status_code = result['httpStatusCode']
+            if status_code < 300:
+                continue
+
+            errors = result['body'] or []
+            # the others are reported as halted, so raise for the one that failed
+            if not any(error.get('errorCode') == 'PROCESSING_HALTED' for error in errors):
+                exc_cls = COMPOSITE_EXCEPTIONS.get(status_code, sfapi.SalesforceGeneralError)
+                raise exc_cls(url, status_code, result['referenceId'], errors)
+
+        return [result['body'] for result in results]
+
 
 class SFDC(object):
     _contact = None
     _opportunity = None
+    _contact_batcher = None
 
     @property
     def contact(self):
@@ -293,20 +850,84 @@ class SFDC(object):
 
         return self._opportunity
 
+    @property
+    def contact_batcher(self):
+        if self._contact_batcher is None:
+            self._contact_batcher = Batcher('news.backends.sfdc.contact',
+                                            self._send_contact_batch,
+                                            min(settings.SFDC_BATCH_SIZE, COLLECTIONS_MAX_RECORDS),
+                                            settings.SFDC_BATCH_WAIT)
+
+        return self._contact_batcher
+
+    def _send_contact_batch(self, method, records):
+        """Send a batch of contact writes and convert failures into exceptions per record"""
+        results = []
+        for result in self.contact.collection(method, records):
+            if result.get('success'):
+                results.append(result.get('id'))
+            else:
+                statsd.incr('news.backends.sfdc.batch.record_failure')
+                results.append(sfapi.SalesforceMalformedRequest(
+                    self.contact._collections_url(), 400, self.contact.name, result.get('errors')))
+
+        return results
+
+    @limit_concurrency
+    @circuit_breaker
     @time_request
-    def get(self, token=None, email=None):
+    def get(self, token=None, email=None, use_cache=True):
         """
         Get a contact record.
 
         @param token: external ID
         @param email: email address
+        @param use_cache: False to always fetch the record from SFDC, e.g. to decide
+            what to change in it
         @return: dict
         """
         assert token or email, 'token or email is required'
+        use_cache = use_cache and settings.SFDC_CONTACT_CACHE_TIMEOUT > 0
+        if use_cache:
+            data = get_cached_contact(token, email)
+            if data is not None:
+                statsd.incr('news.backends.sfdc.contact_cache.hit')
+                return data
+
+            statsd.incr('news.backends.sfdc.contact_cache.miss')
+
         id_field = FIELD_MAP['token' if token else 'email']
-        contact = self.contact.get_by_custom_id(id_field, token or email)
-        return from_vendor(contact)
+        if settings.SFDC_QUERY_LOOKUPS:
+            contact = self._query_contact(id_field, token or email)
+        else:
+            contact = self.contact.get_by_custom_id(id_field, token or email)
 
+        data = from_vendor(contact)
+        if use_cache:
+            cache_contact(data)
+
+        return data
+
+    def _query_contact(self, id_field, value):
+        """
+        Fetch a contact with a SOQL query for only the fields basket uses.
+
+        Raises the same errors as `get_by_custom_id` for missing or duplicate records.
+        """
+        soql = u'SELECT {} FROM Contact WHERE {} = {} LIMIT 2'.format(
+            ', '.join(contact_query_fields()), id_field, soql_quote(value))
+        records = self.contact.query(soql)['records']
+        if not records:
+            raise sfapi.SalesforceResourceNotFound(self.contact._query_url(), 404,
+                                                   self.contact.name, [])
+        if len(records) > 1:
+            raise sfapi.SalesforceMoreThanOneRecord(self.contact._query_url(), 300,
+                                                    self.contact.name, records)
+
+        return records[0]
+
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def add(self, data):
         """
@@ -316,35 +937,135 @@ class SFDC(object):
         @return: None
         """
         data.setdefault('last_name', LAST_NAME_DEFAULT_VALUE)
-        self.contact.create(to_vendor(data))
+        contact = to_vendor(data)
+        try:
+            if settings.SFDC_BATCH_WRITES:
+                contact_id = self.contact_batcher.submit('POST', contact)
+            else:
+                contact_id = self.contact.create(contact)['id']
+        finally:
+            uncache_contact(data)
 
+        index_contact(dict(data, id=contact_id))
+
+    @limit_concurrency
+    @circuit_breaker
     @time_request
-    def update(self, record, data):
+    def update(self, record, data, diff=False):
         """
         Update data in an existing record.
 
         @param record: current contact record
         @param data: dict of user data
+        @param diff: only send the fields that differ from those in record, and
+            nothing at all if none do. record must be the full, current contact as
+            fetched without the cache.
         @return: None
         """
         # need a copy because we'll modify it
         data = data.copy()
+        indexed_field = None
         if 'id' in record:
             contact_id = record['id']
         elif 'token' in record or 'email' in record:
-            fn = 'token' if 'token' in record else 'email'
-            contact_id = '{}/{}'.format(FIELD_MAP[fn], record[fn])
-            # can't send the ID field in the data
-            data.pop(fn, None)
+            indexed_field = 'token' if 'token' in record else 'email'
+            contact_id = indexed_contact_id(**{indexed_field: record[indexed_field]})
+            if contact_id is None:
+                contact_id = '{}/{}'.format(FIELD_MAP[indexed_field], record[indexed_field])
+                # can't send the ID field in the data
+                data.pop(indexed_field, None)
+                indexed_field = None
         else:
             raise KeyError('id, token, or email required')
 
+        by_id = 'id' in record or indexed_field is not None
+
         # source_url should only be added if user doesn't already have one
         if record.get('source_url') and 'source_url' in data:
             del data['source_url']
 
-        self.contact.update(contact_id, to_vendor(data))
+        contact = to_vendor(data)
+        if diff:
+            contact = vendor_diff(record, contact)
+            if not contact:
+                statsd.incr('news.backends.sfdc.update_skipped')
+                return
+
+        try:
+            try:
+                self._update_contact(contact_id, contact, by_id)
+            except (sfapi.SalesforceResourceNotFound, sfapi.SalesforceMalformedRequest) as e:
+                if indexed_field is None or not is_stale_id_error(e):
+                    raise
+
+                # the indexed contact was deleted or merged. fall back to the external ID.
+                statsd.incr('news.backends.sfdc.contact_index.stale')
+                unindex_contact(contact_id)
+                contact.pop(FIELD_MAP[indexed_field], None)
+                contact_id = '{}/{}'.format(FIELD_MAP[indexed_field], record[indexed_field])
+                self._update_contact(contact_id, contact, by_id=False)
+                return
+        finally:
+            # the cached record is stale for the old and any new token or email
+            uncache_contact(record, data)
+            unreplicate_contact(record, data)
+
+        if by_id and ('token' in data or 'email' in data):
+            index_contact({
+                'id': contact_id,
+                'token': data.get('token', record.get('token')),
+                'email': data.get('email', record.get('email')),
+            })
+
+    def _update_contact(self, contact_id, contact, by_id):
+        if settings.SFDC_BATCH_WRITES and by_id:
+            # sObject Collections can only update by Salesforce ID
+            self.contact_batcher.submit('PATCH', dict(contact, id=contact_id))
+        else:
+            self.contact.update(contact_id, contact)
+
+    @limit_concurrency
+    @circuit_breaker
+    @time_request
+    def add_donation(self, donation, record=None, data=None):
+        """
+        Create a donation Opportunity along with any contact changes in one request.
+
+        @param donation: vendor field data for the Opportunity, without the contact ID
+        @param record: current contact record, or None to create a new contact from `data`
+        @param data: dict of user data for the new contact or to update the current one.
+            Only the fields that differ from those in `record`, fetched without the
+            cache, are updated.
+        @return: None
+        """
+        subrequests = []
+        if record is None:
+            data = data.copy()
+            data.setdefault('last_name', LAST_NAME_DEFAULT_VALUE)
+            subrequests.append(('newContact', 'POST', self.contact.name, to_vendor(data)))
+            contact_id = '@{newContact.id}'
+        else:
+            contact_id = record['id']
+            contact = vendor_diff(record, to_vendor(data)) if data else None
+            if contact:
+                subrequests.append(('updateContact', 'PATCH',
+                                    u'{}/{}'.format(self.contact.name, contact_id),
+                                    contact))
+
+        donation = dict(donation, Donation_Contact__c=contact_id)
+        subrequests.append(('newDonation', 'POST', self.opportunity.name, donation))
+        try:
+            results = self.contact.composite(subrequests)
+        finally:
+            uncache_contact(record or {}, data or {})
+            if record:
+                unreplicate_contact(record)
+
+        if record is None:
+            index_contact(dict(data, id=results[0]['id']))
 
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def delete(self, record):
         """
@@ -353,7 +1074,53 @@ class SFDC(object):
         @param record: current contact record
         @return: None
         """
-        self.contact.delete(record['id'])
+        try:
+            self.contact.delete(record['id'])
+        finally:
+            uncache_contact(record)
+            unreplicate_contact(record)
+
+        unindex_contact(record['id'])
+
+    @limit_concurrency
+    @circuit_breaker
+    @time_request
+    def query(self, soql):
+        """
+        Run a SOQL query for contacts.
+
+        @param soql: the query string
+        @return: dict of results. Fetch more with `query_more` while 'done' is false.
+        """
+        return self.contact.query(soql)
+
+    @limit_concurrency
+    @circuit_breaker
+    @time_request
+    def query_more(self, next_records_url):
+        """
+        Get the next batch of results of a query.
+
+        @param next_records_url: the 'nextRecordsUrl' of the previous results
+        @return: dict of results like `query`
+        """
+        return self.contact.query_more(next_records_url)
+
+    @limit_concurrency
+    @circuit_breaker
+    @time_request
+    def deleted(self, start, end):
+        """
+        Get the IDs of contacts deleted (or merged into another) between two times.
+
+        Salesforce only keeps these for about 30 days.
+
+        @param start: datetime
+        @param end: datetime
+        @return: list of contact IDs
+        """
+        result = self.contact.deleted(start, end)
+        return [record['id'] for record in result.get('deletedRecords', [])]
 
 
 sfdc = SFDC()
@@ -2,26 +2,107 @@
 API Client Library for Salesforce Marketing Cloud (SFMC)
 Formerly ExactTarget
 """
+import os
+from cStringIO import StringIO
+from hashlib import sha256
 from random import randint
-from time import time
+from threading import Lock, RLock
+from time import sleep, time
 
 from django.conf import settings
 from django.core.cache import cache
 
-import requests
+import suds.client
+import suds.wsse
 from django_statsd.clients import statsd
 from FuelSDK import ET_Client, ET_DataExtension_Row, ET_TriggeredSend
+from suds.cache import ObjectCache
+from suds.sax.element import Element
+from suds.transport import Reply, TransportError
+from suds.transport.http import HttpTransport
 
-from news.backends.common import get_timer_decorator, NewsletterException, \
-                                 NewsletterNoResultsException
+from news.backends.common import Batcher, CircuitBreaker, ConcurrencyLimit, get_timer_decorator, \
+                                 get_vendor_session, NewsletterException, NewsletterNoResultsException
 
 
 time_request = get_timer_decorator('news.backends.sfmc')
+# network and server errors count toward opening the circuit
+circuit_breaker = CircuitBreaker('sfmc', (IOError,))
+limit_concurrency = ConcurrencyLimit('sfmc')
 
 
 HERD_TIMEOUT = 60
 AUTH_BUFFER = 300  # 5 min
 MAX_BUFFER = HERD_TIMEOUT + AUTH_BUFFER
+TOKEN_LOCK_KEY = 'backends:sfmc:auth:lock'
+# seconds one process may spend requesting a token for all of them
+TOKEN_LOCK_TIMEOUT = 30
+# seconds to wait for another process to get a token, and how often to check
+TOKEN_WAIT_TIMEOUT = 10
+TOKEN_WAIT_INTERVAL = 0.2
+# parsed SOAP clients by WSDL URL, shared by every ETRefreshClient in the process
+_soap_clients = {}
+_soap_clients_lock = Lock()
+
+
+def wsdl_cache_location(wsdl_url):
+    """
+    Return the directory to keep the parsed WSDL in.
+
+    Each version of a local WSDL file gets its own directory so that an updated file
+    is never read from the cache of an older one.
+    """
+    version = wsdl_url
+    if wsdl_url.startswith('file://'):
+        with open(wsdl_url[len('file://'):], 'rb') as wsdl_file:
+            version = wsdl_file.read()
+
+    return os.path.join(settings.SFMC_WSDL_CACHE_DIR, sha256(version).hexdigest()[:16])
+
+
+class VendorTransport(HttpTransport):
+    """
+    A suds transport that sends SOAP calls with the shared SFMC VendorSession, so that
+    they reuse its pooled connections and get its timeouts and retries.
+
+    Only the WSDL and its imports, which may be local files and are read once per
+    process, are still fetched with urllib2.
+    """
+    def send(self, request):
+        response = get_vendor_session('sfmc').post(request.url, data=request.message,
+                                                   headers=request.headers)
+        if response.status_code in (202, 204):
+            return None
+
+        if response.status_code >= 300:
+            # suds reads SOAP faults from a 500 response
+            raise TransportError(response.reason, response.status_code,
+                                 StringIO(response.content))
+
+        return Reply(response.status_code, dict(response.headers), response.content)
+
+
+def get_soap_client(wsdl_url):
+    """
+    Return a suds client for the WSDL with options of its own.
+
+    The WSDL is parsed only the first time in each process. If SFMC_WSDL_CACHE_DIR is
+    set the parsed WSDL is also kept there so that new processes can skip parsing it.
+    """
+    with _soap_clients_lock:
+        client = _soap_clients.get(wsdl_url)
+        if client is None:
+            options = {'faults': False, 'cachingpolicy': 1, 'transport': VendorTransport()}
+            if settings.SFMC_WSDL_CACHE_DIR:
+                # no expiration: the location changes with the WSDL
+                options['cache'] = ObjectCache(location=wsdl_cache_location(wsdl_url))
+
+            with statsd.timer('news.backends.sfmc.build_soap_client.timing'):
+                client = suds.client.Client(wsdl_url, **options)
+
+            _soap_clients[wsdl_url] = client
+
+    return client.clone()
 
 
 class ETRefreshClient(ET_Client):
@@ -36,6 +117,8 @@ class ETRefreshClient(ET_Client):
     _old_authToken = None
 
     def __init__(self, get_server_wsdl=False, debug=False, params=None):
+        # only one thread or greenlet refreshes the shared client's token at a time
+        self._token_lock = RLock()
         # setting this manually as it has thrown errors and doesn't change
         if settings.USE_SANDBOX_BACKEND:
             self.endpoint = 'https://webservice.test.exacttarget.com/Service.asmx'
@@ -57,26 +140,58 @@ class ETRefreshClient(ET_Client):
         time_buffer = randint(1, HERD_TIMEOUT) + AUTH_BUFFER
         return time() + time_buffer > self.authTokenExpiration
 
+    def build_soap_client(self):
+        """
+        Set the SOAP client up to use the current token.
+
+        The client is only created once. After that only the auth header changes.
+        """
+        if self.soap_client is None:
+            if self.endpoint is None:
+                self.endpoint = self.determineStack()
+
+            self.soap_client = get_soap_client(self.wsdl_file_url)
+            self.soap_client.set_options(location=self.endpoint)
+            security = suds.wsse.Security()
+            security.tokens.append(suds.wsse.UsernameToken('*', '*'))
+            self.soap_client.set_options(wsse=security)
+
+        self.authObj = {
+            'oAuth': {'oAuthToken': self.internalAuthToken},
+            'attributes': {'oAuth': {'xmlns': 'http://exacttarget.com'}},
+        }
+        auth_header = Element('oAuth', ns=('etns', 'http://exacttarget.com'))
+        auth_header.append(Element('oAuthToken').setText(self.internalAuthToken))
+        self.soap_client.set_options(soapheaders=auth_header)
+
+    def cached_tokens(self):
+        """Return the tokens shared in the cache, or None"""
+        tokens = cache.get(self.token_cache_key)
+        if tokens and not isinstance(tokens, dict):
+            # something wrong was cached
+            cache.delete(self.token_cache_key)
+            return None
+
+        return tokens or None
+
+    def use_tokens(self, tokens):
+        for prop, value in tokens.items():
+            if prop in self.token_property_names:
+                setattr(self, prop, value)
+
+        # set the value so we can detect if it changed later
+        self._old_authToken = self.authToken
+        self.build_soap_client()
+
     def refresh_auth_tokens_from_cache(self):
         """Refresh the auth token and other values from cache"""
         if self.authToken is not None and time() + MAX_BUFFER < self.authTokenExpiration:
             # no need to refresh if the current tokens are still good
             return
 
-        tokens = cache.get(self.token_cache_key)
+        tokens = self.cached_tokens()
         if tokens:
-            if not isinstance(tokens, dict):
-                # something wrong was cached
-                cache.delete(self.token_cache_key)
-                return
-
-            for prop, value in tokens.items():
-                if prop in self.token_property_names:
-                    setattr(self, prop, value)
-
-            # set the value so we can detect if it changed later
-            self._old_authToken = self.authToken
-            self.build_soap_client()
+            self.use_tokens(tokens)
 
     def cache_auth_tokens(self):
         if self.authToken is not None and self.authToken != self._old_authToken:
@@ -85,7 +200,7 @@ class ETRefreshClient(ET_Client):
             cache.set(self.token_cache_key, new_tokens, self.authTokenExpiresIn + 600)
 
     def request_token(self, payload):
-        r = requests.post(self.auth_url, json=payload)
+        r = get_vendor_session('sfmc').post(self.auth_url, json=payload)
         try:
             token_response = r.json()
         except ValueError:
@@ -109,28 +224,96 @@ class ETRefreshClient(ET_Client):
         """
         Called from many different places right before executing a SOAP call
         """
+        with self._token_lock:
+            self._refresh_token(force_refresh)
+
+    def refresh_token_ahead(self, min_ttl):
+        """
+        Get a new token for all processes if the shared one expires within `min_ttl` seconds.
+
+        Run periodically so that the token is replaced before requests need a new one.
+
+        @return: True if a new token was requested
+        """
+        with self._token_lock:
+            tokens = self.cached_tokens()
+            if tokens:
+                if time() + min_ttl < tokens['authTokenExpiration']:
+                    return False
+
+                # so that its refresh key is used
+                self.use_tokens(tokens)
+
+            self._request_token_single_flight(min_ttl=min_ttl)
+            return True
+
+    def _refresh_token(self, force_refresh=False):
         # If we don't already have a token or the token expires within 5 min(300 seconds), get one
         self.refresh_auth_tokens_from_cache()
         if force_refresh or self.authToken is None or self.token_is_expired():
-            payload = {
-                'clientId': self.client_id,
-                'clientSecret': self.client_secret,
-                'accessType': 'offline',
-            }
-            if self.refreshKey:
-                payload['refreshToken'] = self.refreshKey
+            self._request_token_single_flight(stale_token=self.authToken if force_refresh else None)
+
+    def _request_token_single_flight(self, stale_token=None, min_ttl=MAX_BUFFER):
+        """
+        Get a new token unless another process is already doing so.
+
+        Only the process that gets the lock requests a token. The others wait up to
+        TOKEN_WAIT_TIMEOUT seconds for its new token to show up in the cache, and
+        request one themselves only if it doesn't.
+
+        @param stale_token: a token that should not be used (e.g. SFMC rejected it)
+        @param min_ttl: seconds a token must still be good for to be used
+        """
+        def is_usable(tokens):
+            return (tokens is not None and tokens.get('authToken') is not None and
+                    (stale_token is None or tokens['authToken'] != stale_token) and
+                    time() + min_ttl < tokens['authTokenExpiration'])
+
+        if cache.add(TOKEN_LOCK_KEY, True, TOKEN_LOCK_TIMEOUT):
+            try:
+                # another process may have finished getting one just before we got the lock
+                tokens = self.cached_tokens()
+                if is_usable(tokens):
+                    self.use_tokens(tokens)
+                else:
+                    self._request_new_token()
+            finally:
+                cache.delete(TOKEN_LOCK_KEY)
+
+            return
+
+        statsd.incr('news.backends.sfmc.auth_token_refresh_wait')
+        give_up = time() + TOKEN_WAIT_TIMEOUT
+        while time() < give_up:
+            sleep(TOKEN_WAIT_INTERVAL)
+            tokens = self.cached_tokens()
+            if is_usable(tokens):
+                self.use_tokens(tokens)
+                return
+
+        statsd.incr('news.backends.sfmc.auth_token_refresh_wait_timeout')
+        self._request_new_token()
+
+    def _request_new_token(self):
+        payload = {
+            'clientId': self.client_id,
+            'clientSecret': self.client_secret,
+            'accessType': 'offline',
+        }
+        if self.refreshKey:
+            payload['refreshToken'] = self.refreshKey
 
-            token_response = self.request_token(payload)
-            statsd.incr('news.backends.sfmc.auth_token_refresh')
-            self.authToken = token_response['accessToken']
-            self.authTokenExpiresIn = token_response['expiresIn']
-            self.authTokenExpiration = time() + self.authTokenExpiresIn
-            self.internalAuthToken = token_response['legacyToken']
-            if 'refreshToken' in token_response:
-                self.refreshKey = token_response['refreshToken']
+        token_response = self.request_token(payload)
+        statsd.incr('news.backends.sfmc.auth_token_refresh')
+        self.authToken = token_response['accessToken']
+        self.authTokenExpiresIn = token_response['expiresIn']
+        self.authTokenExpiration = time() + self.authTokenExpiresIn
+        self.internalAuthToken = token_response['legacyToken']
+        if 'refreshToken' in token_response:
+            self.refreshKey = token_response['refreshToken']
 
-            self.build_soap_client()
-            self.cache_auth_tokens()
+        self.build_soap_client()
+        self.cache_auth_tokens()
 
 
 def assert_response(resp):
@@ -148,8 +331,74 @@ def build_attributes(data):
     return [{'Name': key, 'Value': value} for key, value in data.items()]
 
 
+def row_errors(resp, count):
+    """
+    Return the error for each object of a SOAP request that sent several, in order.
+
+    @param resp: the response
+    @param count: the number of objects sent
+    @return: list with None for each object that was saved, or a NewsletterException
+    """
+    results = resp.results or []
+    if len(results) != count:
+        # the request as a whole failed
+        assert_response(resp)
+        raise NewsletterException('Expected {} row results, got {}'.format(count, len(results)))
+
+    errors = [None] * count
+    for i, result in enumerate(results):
+        # OrdinalID is the position of the object in the request
+        i = int(getattr(result, 'OrdinalID', i))
+        if getattr(result, 'StatusCode', 'OK') != 'OK':
+            errors[i] = NewsletterException(getattr(result, 'StatusMessage', None) or
+                                            'SFMC row error')
+
+    return errors
+
+
+def subscriber_errors(resp, subscribers):
+    """
+    Return the error for each subscriber of a Triggered Send to several, in order.
+
+    @param resp: the response
+    @param subscribers: the subscriber dicts sent
+    @return: list with None for each subscriber the message was sent to, or a NewsletterException
+    """
+    if not resp.results:
+        assert_response(resp)
+        raise NewsletterException('No result for the Triggered Send')
+
+    result = resp.results[0]
+    if getattr(result, 'StatusCode', 'OK') == 'OK':
+        return [None] * len(subscribers)
+
+    failures = getattr(result, 'SubscriberFailures', None) or []
+    if not failures:
+        # nobody got it, e.g. because of an Invalid Customer Key
+        error = NewsletterException(getattr(result, 'StatusMessage', None) or
+                                    str(resp.results))
+        return [error] * len(subscribers)
+
+    failed = {}
+    for failure in failures:
+        error = NewsletterException(getattr(failure, 'ErrorDescription', None) or
+                                    'SFMC subscriber error')
+        subscriber = getattr(failure, 'Subscriber', None)
+        for key in ('SubscriberKey', 'EmailAddress'):
+            value = getattr(subscriber, key, None)
+            if value:
+                failed[key, value] = error
+
+    return [failed.get(('SubscriberKey', sub['SubscriberKey']),
+                       failed.get(('EmailAddress', sub['EmailAddress'])))
+            for sub in subscribers]
+
+
 class SFMC(object):
     _client = None
+    _row_batcher = None
+    _send_batcher = None
+    _sms_batcher = None
     sms_api_url = 'https://www.exacttargetapis.com/sms/v1/messageContact/{}/send'
 
     @property
@@ -164,6 +413,34 @@ class SFMC(object):
         self.client.refresh_token()
         return {'Authorization': 'Bearer {0}'.format(self.client.authToken)}
 
+    @property
+    def row_batcher(self):
+        if self._row_batcher is None:
+            self._row_batcher = Batcher('news.backends.sfmc.rows', self._send_row_batch,
+                                        settings.SFMC_BATCH_SIZE, settings.SFMC_BATCH_WAIT)
+
+        return self._row_batcher
+
+    @property
+    def send_batcher(self):
+        if self._send_batcher is None:
+            self._send_batcher = Batcher('news.backends.sfmc.send_mail', self._send_mail_batch,
+                                         settings.SFMC_SEND_BATCH_SIZE, settings.SFMC_BATCH_WAIT)
+
+        return self._send_batcher
+
+    @property
+    def sms_batcher(self):
+        if self._sms_batcher is None:
+            self._sms_batcher = Batcher('news.backends.sfmc.send_sms', self._send_sms_batch,
+                                        settings.SFMC_SMS_BATCH_SIZE, settings.SFMC_BATCH_WAIT)
+
+        return self._sms_batcher
+
+    def _send_row_batch(self, key, rows):
+        method, de_name = key
+        return self._write_rows(method, de_name, rows)
+
     def _get_row_obj(self, de_name, props):
         row = ET_DataExtension_Row()
         row.auth_stub = self.client
@@ -171,6 +448,29 @@ class SFMC(object):
         row.props = props
         return row
 
+    def _write_rows(self, method, de_name, rows):
+        """Add ('add') or upsert ('upsert') rows in one request and return the error for each"""
+        row = self._get_row_obj(de_name, rows)
+        resp = row.post() if method == 'add' else row.patch(True)
+        errors = row_errors(resp, len(rows))
+        failed = len([e for e in errors if e is not None])
+        if failed:
+            statsd.incr('news.backends.sfmc.rows.failure', failed)
+
+        return errors
+
+    def _write_row(self, method, de_name, values):
+        if settings.SFMC_BATCH_WRITES:
+            # raises the error for this row if it failed
+            self.row_batcher.submit((method, de_name), values)
+            return
+
+        row = self._get_row_obj(de_name, values)
+        resp = row.post() if method == 'add' else row.patch(True)
+        assert_response(resp)
+
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def get_row(self, de_name, fields, token=None, email=None):
         """
@@ -203,6 +503,8 @@ class SFMC(object):
         return dict((p.Name, p.Value)
                     for p in resp.results[0].Properties.Property)
 
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def add_row(self, de_name, values):
         """
@@ -212,10 +514,24 @@ class SFMC(object):
         @param values: dict containing the COLUMN: VALUE pairs
         @return: None
         """
-        row = self._get_row_obj(de_name, values)
-        resp = row.post()
-        assert_response(resp)
+        self._write_row('add', de_name, values)
 
+    @limit_concurrency
+    @circuit_breaker
+    @time_request
+    def add_rows(self, de_name, rows):
+        """
+        Add several rows to a data extension in one request.
+
+        @param de_name: name of the data extension
+        @param rows: list of dicts containing the COLUMN: VALUE pairs
+        @return: list with None for each row that was added, or the NewsletterException
+            for why it wasn't, in the same order as `rows`
+        """
+        return self._write_rows('add', de_name, rows)
+
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def update_row(self, de_name, values):
         """
@@ -230,6 +546,8 @@ class SFMC(object):
         resp = row.patch()
         assert_response(resp)
 
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def upsert_row(self, de_name, values):
         """
@@ -240,10 +558,25 @@ class SFMC(object):
             Must contain TOKEN or EMAIL_ADDRESS_.
         @return: None
         """
-        row = self._get_row_obj(de_name, values)
-        resp = row.patch(True)
-        assert_response(resp)
+        self._write_row('upsert', de_name, values)
+
+    @limit_concurrency
+    @circuit_breaker
+    @time_request
+    def upsert_rows(self, de_name, rows):
+        """
+        Add or update several rows in a data extension in one request.
+
+        @param de_name: name of the data extension
+        @param rows: list of dicts containing the COLUMN: VALUE pairs.
+            Each must contain the data extension's primary key.
+        @return: list with None for each row that was saved, or the NewsletterException
+            for why it wasn't, in the same order as `rows`
+        """
+        return self._write_rows('upsert', de_name, rows)
 
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def delete_row(self, de_name, token=None, email=None):
         """
@@ -264,11 +597,16 @@ class SFMC(object):
         resp = row.delete()
         assert_response(resp)
 
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def send_mail(self, ts_name, email, subscriber_key, token=None):
         """
         Send an email message to a user (Triggered Send).
 
+        With SFMC_BATCH_SENDS, messages with the same `ts_name` sent at the same time
+        in this process go out together in one request.
+
         @param ts_name: the name of the message to send
         @param email: the email address of the user
         @param subscriber_key: the key for the user in SFMC
@@ -276,24 +614,54 @@ class SFMC(object):
         @param token: optional token if a recovery message
         @return: None
         """
-        ts = ET_TriggeredSend()
-        ts.auth_stub = self.client
-        ts.props = {'CustomerKey': ts_name}
         subscriber = {
             'EmailAddress': email,
             'SubscriberKey': subscriber_key,
         }
         if token:
-            ts.attributes = build_attributes({
+            subscriber['Attributes'] = build_attributes({
                 'Token__c': token,
             })
-            subscriber['Attributes'] = ts.attributes
+
+        if settings.SFMC_BATCH_SENDS:
+            # raises the error for this subscriber if the send to them failed
+            self.send_batcher.submit(ts_name, subscriber)
+            return
+
+        ts = ET_TriggeredSend()
+        ts.auth_stub = self.client
+        ts.props = {'CustomerKey': ts_name}
+        if token:
+            ts.attributes = subscriber['Attributes']
         ts.subscribers = [subscriber]
         resp = ts.send()
         assert_response(resp)
 
+    def _send_mail_batch(self, ts_name, subscribers):
+        """Send a message to several subscribers in one request and return the error for each"""
+        ts = ET_TriggeredSend()
+        ts.auth_stub = self.client
+        ts.props = {'CustomerKey': ts_name}
+        ts.subscribers = subscribers
+        errors = subscriber_errors(ts.send(), subscribers)
+        failed = len([e for e in errors if e is not None])
+        if failed:
+            statsd.incr('news.backends.sfmc.send_mail.subscriber_failure', failed)
+
+        return errors
+
+    @limit_concurrency
+    @circuit_breaker
     @time_request
     def send_sms(self, phone_numbers, message_id):
+        if settings.SFMC_BATCH_SMS and len(phone_numbers) == 1:
+            # raises the error for this number if the send to it failed
+            self.sms_batcher.submit(message_id, phone_numbers[0])
+            return
+
+        self._post_sms(phone_numbers, message_id)
+
+    def _post_sms(self, phone_numbers, message_id):
         data = {
             'mobileNumbers': phone_numbers,
             'Subscribe': True,
@@ -301,14 +669,44 @@ class SFMC(object):
             'keyword': 'FFDROID',  # TODO: Set keyword in arguments.
         }
         url = self.sms_api_url.format(message_id)
-        response = requests.post(url, json=data, headers=self.auth_header)
+        response = get_vendor_session('sfmc').post(url, json=data, headers=self.auth_header)
+        retry_after = response.headers.get('Retry-After')
         if response.status_code >= 500:
             raise NewsletterException('SFMC Server Error: {}'.format(response.content),
-                                      status_code=response.status_code)
+                                      status_code=response.status_code,
+                                      retry_after=retry_after)
 
         if response.status_code >= 400:
             errors = response.json()['errors']
-            raise NewsletterException(errors, status_code=response.status_code)
+            raise NewsletterException(errors, status_code=response.status_code,
+                                      retry_after=retry_after)
 
+    def _send_sms_batch(self, message_id, phone_numbers):
+        """Send a message to several numbers in one request and return the error for each"""
+        try:
+            self._post_sms(phone_numbers, message_id)
+        except NewsletterException as e:
+            if len(phone_numbers) == 1 or not e.status_code or e.status_code >= 500:
+                return [e] * len(phone_numbers)
+        else:
+            return [None] * len(phone_numbers)
+
+        # the request was rejected because of some of the numbers. send them one
+        # at a time so that only those fail.
+        statsd.incr('news.backends.sfmc.send_sms.batch_rejected')
+        errors = []
+        for number in phone_numbers:
+            try:
+                self._post_sms([number], message_id)
+            except NewsletterException as e:
+                errors.append(e)
+            else:
+                errors.append(None)
+
+        failed = len([error for error in errors if error is not None])
+        if failed:
+            statsd.incr('news.backends.sfmc.send_sms.number_failure', failed)
+
+        return errors
 
 sfmc = SFMC()
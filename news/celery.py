@@ -11,6 +11,8 @@ import celery
 from raven.contrib.celery import register_signal, register_logger_signal
 from raven.contrib.django.raven_compat.models import client
 
+from news.routers import declared_queues
+
 
 class Celery(celery.Celery):
     def on_configure(self):
@@ -26,6 +28,8 @@ app = Celery('basket')
 # Using a string here means the worker will not have to
 # pickle the object when using Windows.
 app.config_from_object('django.conf:settings')
+if settings.TASK_QUEUES_ENABLE:
+    app.conf.CELERY_QUEUES = declared_queues()
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
 
@@ -0,0 +1,115 @@
+from __future__ import print_function, unicode_literals
+
+from multiprocessing.pool import ThreadPool
+from threading import Thread
+from time import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from news.backends.common import _vendor_sessions
+from news.backends.fake_sfdc import FakeSFDC, FakeSFDCServer
+from news.backends.sfdc import _local_session, SFDC
+
+
+LOAD_TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'load_test_sfdc',
+    },
+}
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = ('Measure contact lookups per second through the SFDC backend at increasing '
+            'concurrency against the fake SFDC server. Run it with '
+            '`python -m gevent.monkey manage.py load_test_sfdc` to use greenlets '
+            'as gevent workers do.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-n', '--num-requests', type=int, default=500,
+                            help='Lookups at each concurrency level (500)')
+        parser.add_argument('-c', '--concurrency', default='1,10,50,100,200',
+                            help='Comma separated concurrency levels (1,10,50,100,200)')
+        parser.add_argument('--latency', type=float, default=0.1,
+                            help='Seconds the fake server takes per request (0.1)')
+        parser.add_argument('--url',
+                            help='Use a fake server that is already running at this URL '
+                                 'instead of starting one')
+
+    def handle(self, *args, **options):
+        try:
+            levels = [int(c) for c in options['concurrency'].split(',')]
+        except ValueError:
+            raise CommandError('Concurrency levels must be numbers')
+
+        url = options['url']
+        if not url:
+            server = FakeSFDCServer(('127.0.0.1', 0), FakeSFDC(latency=options['latency']))
+            thread = Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            url = server.url
+
+        try:
+            from gevent import monkey
+            use_gevent = monkey.is_module_patched('socket')
+        except ImportError:
+            use_gevent = False
+
+        print('Using {} against {}'.format('greenlets' if use_gevent else 'threads', url))
+        sfdc_settings = dict(settings.SFDC_SETTINGS, login_url=url, username='load',
+                             password='test')
+        # a cache of its own so that the run can't use or replace the real SFDC session,
+        # and no contact cache or Id index so that nothing is written to the database
+        with override_settings(SFDC_SETTINGS=sfdc_settings,
+                               CACHES=LOAD_TEST_CACHES,
+                               SFDC_CONTACT_CACHE_TIMEOUT=0,
+                               SFDC_CONTACT_ID_INDEX=False,
+                               SFDC_REPLICA_READS=False,
+                               VENDOR_HTTP_POOL_SIZE=max(levels),
+                               VENDOR_MAX_CONCURRENCY=0):
+            # the vendor session and SFDC login are shared by the process, so start with
+            # new ones built with these settings
+            _vendor_sessions.pop('sfdc', None)
+            _local_session['info'] = None
+            try:
+                self.run_levels(levels, options['num_requests'], use_gevent)
+            finally:
+                _vendor_sessions.pop('sfdc', None)
+                _local_session['info'] = None
+
+    def run_levels(self, levels, num_requests, use_gevent):
+        if use_gevent:
+            from gevent.pool import Pool
+
+        sfdc = SFDC()
+        sfdc.add({'email': 'load-test@example.com', 'token': 'load-test-token'})
+
+        def lookup(i):
+            start = time()
+            try:
+                sfdc.get(token='load-test-token')
+            except Exception:
+                return None
+
+            return time() - start
+
+        print('concurrency  lookups/s  p50 ms  p95 ms  errors')
+        for level in levels:
+            pool = Pool(level) if use_gevent else ThreadPool(level)
+            start = time()
+            timings = pool.map(lookup, range(num_requests))
+            elapsed = time() - start
+            ok = [t for t in timings if t is not None]
+            print('{:>11}  {:>9.1f}  {:>6.0f}  {:>6.0f}  {:>6}'.format(
+                level, len(timings) / elapsed,
+                percentile(ok, 50) * 1000 if ok else 0,
+                percentile(ok, 95) * 1000 if ok else 0,
+                len(timings) - len(ok)))
@@ -0,0 +1,46 @@
+from __future__ import print_function, unicode_literals
+
+from django.core.management import BaseCommand
+
+from news.backends.fake_sfdc import FakeSFDC, FakeSFDCServer
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for the Salesforce.com REST API (set SFDC_LOGIN_URL to use it)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-a', '--address', default='127.0.0.1',
+                            help='Address to listen on (127.0.0.1)')
+        parser.add_argument('-p', '--port', type=int, default=8500,
+                            help='Port to listen on (8500)')
+        parser.add_argument('--latency', type=float, default=0,
+                            help='Seconds to delay every API request (0)')
+        parser.add_argument('--latency-jitter', type=float, default=0,
+                            help='Up to this many more seconds to delay at random (0)')
+        parser.add_argument('--error-rate', type=float, default=0,
+                            help='Fraction of API requests that fail with a 503 (0)')
+        parser.add_argument('--session-timeout', type=int, default=0,
+                            help='Seconds before a session expires. 0 for never (0)')
+        parser.add_argument('--api-limit', type=int, default=1000000,
+                            help='Daily API request limit (1000000)')
+        parser.add_argument('--api-used', type=int, default=0,
+                            help='API requests already used today (0)')
+        parser.add_argument('--verbose-requests', action='store_true',
+                            help='Log every request')
+
+    def handle(self, *args, **options):
+        fake = FakeSFDC(latency=options['latency'],
+                        latency_jitter=options['latency_jitter'],
+                        error_rate=options['error_rate'],
+                        session_timeout=options['session_timeout'],
+                        api_limit=options['api_limit'],
+                        api_used=options['api_used'])
+        server = FakeSFDCServer((options['address'], options['port']), fake,
+                                verbose=options['verbose_requests'])
+        print('Fake SFDC listening. Set SFDC_LOGIN_URL={} to use it.'.format(server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import BaseCommand, CommandError
+
+from news.models import ContactReplica
+from news.replica import SYNC_CURSOR_CACHE_KEY, SYNC_STATE_CACHE_KEY, sync_contact_replica
+
+
+class Command(BaseCommand):
+    help = 'Copy contacts changed in SFDC into the local replica'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n', '--max-records',
+            type=int,
+            default=settings.SFDC_REPLICA_SYNC_MAX_RECORDS,
+            help='Stop after about this many contacts ({})'.format(
+                settings.SFDC_REPLICA_SYNC_MAX_RECORDS))
+        parser.add_argument('--full', action='store_true',
+                            help='Delete the replica and copy every contact again')
+
+    def handle(self, *args, **options):
+        if settings.MAINTENANCE_MODE:
+            raise CommandError('Command unavailable in maintenance mode')
+
+        if options['full']:
+            cache.delete_many([SYNC_STATE_CACHE_KEY, SYNC_CURSOR_CACHE_KEY])
+            ContactReplica.objects.all().delete()
+
+        count = sync_contact_replica(options['max_records'] or None)
+        print '{} contacts copied. {} in the replica.'.format(count,
+                                                              ContactReplica.objects.count())
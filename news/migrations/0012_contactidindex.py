@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0011_auto_20160607_1203'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactIdIndex',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('token', models.CharField(unique=True, max_length=100)),
+                ('email', models.EmailField(max_length=255, db_index=True)),
+                ('sfdc_id', models.CharField(max_length=18, db_index=True)),
+                ('modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
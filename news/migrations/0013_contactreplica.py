@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0012_contactidindex'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactReplica',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sfdc_id', models.CharField(unique=True, max_length=18)),
+                ('token', models.CharField(max_length=100, db_index=True)),
+                ('email', models.EmailField(max_length=255, db_index=True)),
+                ('data', jsonfield.fields.JSONField(default=dict)),
+                ('last_modified', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
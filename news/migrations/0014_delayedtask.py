@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0013_contactreplica'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DelayedTask',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('due', models.DateTimeField(db_index=True)),
+                ('task_id', models.CharField(max_length=255)),
+                ('name', models.CharField(max_length=255)),
+                ('args', jsonfield.fields.JSONField(default=list)),
+                ('kwargs', jsonfield.fields.JSONField(default=dict)),
+                ('retries', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['due'],
+            },
+        ),
+    ]
@@ -139,6 +139,85 @@ class APIUser(models.Model):
         return cls.objects.filter(api_key=api_key, enabled=True).exists()
 
 
+class ContactIdIndex(models.Model):
+    """
+    The Salesforce Contact Id for a token and email, so that tasks can write to a
+    contact without looking it up first.
+    """
+    token = models.CharField(max_length=100, unique=True)
+    email = models.EmailField(max_length=255, db_index=True)
+    sfdc_id = models.CharField(max_length=18, db_index=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_contact(cls, token=None, email=None):
+        """
+        Return the Contact Id and email recorded for the token or email as a tuple, or
+        None if not known (or ambiguous). The email is empty if the contact had none.
+        """
+        if token:
+            contacts = cls.objects.filter(token=token)
+        else:
+            contacts = cls.objects.filter(email=email.lower())
+
+        contacts = list(contacts.values_list('sfdc_id', 'email')[:2])
+        return contacts[0] if len(contacts) == 1 else None
+
+    @classmethod
+    def get_id(cls, token=None, email=None):
+        """Return the Contact Id for the token or email, or None if not known (or ambiguous)"""
+        contact = cls.get_contact(token, email)
+        return contact[0] if contact else None
+
+    @classmethod
+    def set_id(cls, sfdc_id, token, email, replace_email=False):
+        """
+        Record the Contact Id for the token and email if it isn't already.
+
+        With `replace_email` any other contacts recorded for the email are removed.
+        """
+        email = (email or '').lower()
+        if replace_email and email:
+            cls.objects.filter(email=email).exclude(token=token).delete()
+
+        current = cls.objects.filter(token=token).values_list('sfdc_id', 'email').first()
+        if current == (sfdc_id, email):
+            return
+
+        cls.objects.update_or_create(token=token, defaults={'sfdc_id': sfdc_id, 'email': email})
+
+    @classmethod
+    def remove(cls, sfdc_id):
+        cls.objects.filter(sfdc_id=sfdc_id).delete()
+
+
+class ContactReplica(models.Model):
+    """
+    A local copy of a Salesforce Contact in the form `from_vendor` returns, kept up to
+    date by `news.replica.sync_contact_replica`.
+    """
+    sfdc_id = models.CharField(max_length=18, unique=True)
+    token = models.CharField(max_length=100, db_index=True)
+    email = models.EmailField(max_length=255, db_index=True)
+    data = JSONField(default=dict)
+    last_modified = models.DateTimeField(db_index=True)
+
+    @classmethod
+    def remove(cls, *records):
+        """Delete the copies of the contacts with the ids, tokens, or emails in records"""
+        query = models.Q()
+        for record in records:
+            if record.get('id'):
+                query |= models.Q(sfdc_id=record['id'])
+            if record.get('token'):
+                query |= models.Q(token=record['token'])
+            if record.get('email'):
+                query |= models.Q(email=record['email'].lower())
+
+        if query:
+            cls.objects.filter(query).delete()
+
+
 def _is_query_dict(arg):
     """Returns boolean True if arg appears to have been a QueryDict."""
     if not isinstance(arg, dict):
@@ -162,6 +241,24 @@ class QueuedTask(models.Model):
         self.delete()
 
 
+class DelayedTask(models.Model):
+    """A task retry waiting to be queued again when it's due (see TASK_RETRY_STORE)"""
+    due = models.DateTimeField(db_index=True)
+    task_id = models.CharField(max_length=255)
+    name = models.CharField(max_length=255)
+    args = JSONField(null=False, default=list)
+    kwargs = JSONField(null=False, default=dict)
+    retries = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['due']
+
+    def release(self):
+        celery_app.send_task(self.name, args=self.args, kwargs=self.kwargs,
+                             task_id=self.task_id, retries=self.retries)
+        self.delete()
+
+
 class FailedTask(models.Model):
     when = models.DateTimeField(editable=False, default=now)
     task_id = models.CharField(max_length=255)
@@ -4,6 +4,8 @@ backend-specific data for working with them in the email provider.
 It's used to lookup the backend-specific newsletter name from a
 generic one passed by the user. This decouples the API from any
 specific email provider."""
+from uuid import uuid4
+
 from django.db.models.signals import post_save
 from django.db.models.signals import post_delete
 from django.core.cache import cache
@@ -16,6 +18,7 @@ __all__ = ('clear_newsletter_cache', 'get_sms_messages', 'newsletter_field',
 
 
 CACHE_KEY = "newsletters_cache_data"
+VERSION_CACHE_KEY = "newsletters_cache_version"
 SMS_CACHE_KEY = "sms_messages_cache_data"
 TRANSACTIONAL_CACHE_KEY = "transactional_messages_cache_data"
 # TODO remove after initial deployment. These values should be added to
@@ -74,18 +77,37 @@ def _newsletters():
             'groups': {
                 'group_slug': a list of newsletter slugs,
                 ...
-            }
+            },
+            'version': a string that changes every time this data is rebuilt,
         }
     """
     data = cache.get(CACHE_KEY)
-    if data is None:
+    # also rebuild data cached before it had a version
+    if data is None or 'version' not in data:
         data = _get_newsletters_data()
         data['groups'] = _get_newsletter_groups_data()
+        data['version'] = uuid4().hex
         cache.set(CACHE_KEY, data)
+        cache.set(VERSION_CACHE_KEY, data['version'])
 
     return data
 
 
+def newsletters_version():
+    """Return the version of the cached newsletter data.
+
+    It changes whenever the data is rebuilt, so it can be used to know when
+    to rebuild anything derived from the newsletters. Much cheaper than
+    loading the data itself.
+    """
+    version = cache.get(VERSION_CACHE_KEY)
+    if version is None:
+        version = _newsletters()['version']
+        cache.set(VERSION_CACHE_KEY, version)
+
+    return version
+
+
 def _get_newsletter_groups_data():
     groups = NewsletterGroup.objects.filter(active=True)
     return dict((nlg.slug, nlg.newsletter_slugs()) for nlg in groups)
@@ -198,7 +220,7 @@ def is_supported_newsletter_language(code):
 
 
 def clear_newsletter_cache(*args, **kwargs):
-    cache.delete(CACHE_KEY)
+    cache.delete_many([CACHE_KEY, VERSION_CACHE_KEY])
 
 
 def clear_sms_cache(*args, **kwargs):
@@ -0,0 +1,174 @@
+"""
+A local copy of the Salesforce contacts for answering lookups without calling SFDC.
+
+Contacts changed since the last sync are found by their LastModifiedDate and copied
+into the ContactReplica table in the same form `from_vendor` returns. A sync that stops
+early continues after the (LastModifiedDate, Id) of the last contact it copied. Reads are only
+served from the copy if it was synced recently enough (see SFDC_REPLICA_MAX_AGE).
+"""
+from __future__ import absolute_import
+
+from datetime import datetime, timedelta
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DatabaseError, transaction
+from django.db.models import Max
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import now, utc
+
+from django_statsd.clients import statsd
+
+from news.backends.sfdc import contact_query_fields, from_vendor, sfdc
+from news.models import ContactReplica
+
+
+# when the last complete sync started, shared by all processes
+SYNC_STATE_CACHE_KEY = 'sfdc:replica:sync'
+# LastModifiedDate and Id of the last contact copied by an incomplete sync
+SYNC_CURSOR_CACHE_KEY = 'sfdc:replica:cursor'
+# changes committed while a sync was running can have an earlier LastModifiedDate
+# than the newest contact it copied, so each sync looks back this much further
+SYNC_OVERLAP = timedelta(minutes=1)
+# contacts saved per transaction
+SAVE_CHUNK_SIZE = 500
+# Salesforce keeps deleted records for about 30 days
+DELETED_MAX_AGE = timedelta(days=29)
+
+
+def soql_datetime(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def replica_age():
+    """Return the seconds since the last complete sync started, or None if never synced"""
+    state = cache.get(SYNC_STATE_CACHE_KEY)
+    if not state:
+        return None
+
+    return time() - state['synced']
+
+
+def save_contacts(contacts):
+    """Copy contact records from a SOQL query into the replica, committing each chunk"""
+    for start in range(0, len(contacts), SAVE_CHUNK_SIZE):
+        save_contacts_chunk(contacts[start:start + SAVE_CHUNK_SIZE])
+
+
+def save_contacts_chunk(contacts):
+    copies = {}
+    for contact in contacts:
+        data = from_vendor(contact)
+        # the newest wins if a contact is in the results twice
+        copies[data['id']] = ContactReplica(
+            sfdc_id=data['id'],
+            token=data.get('token') or '',
+            email=(data.get('email') or '').lower(),
+            data=data,
+            last_modified=parse_datetime(contact['LastModifiedDate']),
+        )
+
+    # replacing the existing copies is one query, where updating them is one each
+    with transaction.atomic():
+        ContactReplica.objects.filter(sfdc_id__in=list(copies)).delete()
+        ContactReplica.objects.bulk_create(copies.values())
+
+
+def remove_deleted_contacts(since):
+    """Remove the copies of contacts deleted in SFDC since the given time"""
+    end = now()
+    start = max(since, end - DELETED_MAX_AGE)
+    deleted_ids = sfdc.deleted(start, end)
+    if deleted_ids:
+        ContactReplica.objects.filter(sfdc_id__in=deleted_ids).delete()
+
+    return len(deleted_ids)
+
+
+def sync_contact_replica(max_records=None):
+    """
+    Copy the contacts changed in SFDC since the last sync into the replica.
+
+    @param max_records: stop after copying about this many. The next sync continues
+        from there, but the replica isn't considered synced until one finishes.
+    @return: number of contacts copied
+    """
+    started = time()
+    state = cache.get(SYNC_STATE_CACHE_KEY)
+    cursor = cache.get(SYNC_CURSOR_CACHE_KEY)
+    since = ContactReplica.objects.aggregate(since=Max('last_modified'))['since']
+    soql = u'SELECT {} FROM Contact'.format(', '.join(contact_query_fields()))
+    if cursor:
+        # many contacts can share a LastModifiedDate, so the Id breaks the tie
+        modified = soql_datetime(parse_datetime(cursor['modified']))
+        soql += u" WHERE LastModifiedDate >= {0} AND (LastModifiedDate > {0} OR Id > '{1}')".format(
+            modified, cursor['id'])
+    elif since:
+        soql += u' WHERE LastModifiedDate >= {}'.format(soql_datetime(since - SYNC_OVERLAP))
+    soql += u' ORDER BY LastModifiedDate, Id'
+
+    copied = 0
+    result = sfdc.query(soql)
+    while True:
+        save_contacts(result['records'])
+        copied += len(result['records'])
+        if result['records']:
+            last = result['records'][-1]
+            cache.set(SYNC_CURSOR_CACHE_KEY, {'modified': last['LastModifiedDate'],
+                                              'id': last['Id']}, None)
+
+        if result.get('done', True):
+            break
+
+        if max_records and copied >= max_records:
+            break
+
+        result = sfdc.query_more(result['nextRecordsUrl'])
+
+    statsd.incr('news.replica.sync.copied', copied)
+    if not result.get('done', True):
+        statsd.incr('news.replica.sync.incomplete')
+        return copied
+
+    if state and since:
+        last_synced = datetime.fromtimestamp(state['synced'], utc)
+        deleted = remove_deleted_contacts(last_synced - SYNC_OVERLAP)
+        statsd.incr('news.replica.sync.deleted', deleted)
+
+    cache.set(SYNC_STATE_CACHE_KEY, {'synced': started}, None)
+    cache.delete(SYNC_CURSOR_CACHE_KEY)
+    return copied
+
+
+def get_replica_contact(token=None, email=None, max_age=None):
+    """
+    Return the replica copy of a contact, or None if replica reads are disabled, the
+    replica wasn't synced within `max_age` seconds, or the contact isn't in it.
+    """
+    if not settings.SFDC_REPLICA_READS:
+        return None
+
+    age = replica_age()
+    if age is None or (max_age is not None and age > max_age):
+        statsd.incr('news.replica.stale')
+        return None
+
+    try:
+        if token:
+            contacts = ContactReplica.objects.filter(token=token)
+        else:
+            contacts = ContactReplica.objects.filter(email=email.lower())
+
+        contacts = [copy.data for copy in contacts.only('data')[:2]]
+    except DatabaseError:
+        statsd.incr('news.replica.error')
+        return None
+
+    if len(contacts) != 1:
+        # unknown, or more than one so let SFDC decide what to do
+        statsd.incr('news.replica.miss')
+        return None
+
+    statsd.incr('news.replica.hit')
+    return contacts[0]
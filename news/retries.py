@@ -0,0 +1,198 @@
+"""
+How long a failed task waits before it's tried again, by what it failed with.
+"""
+from __future__ import absolute_import
+
+from email.utils import mktime_tz, parsedate_tz
+from random import uniform
+from time import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from django_statsd.clients import statsd
+
+
+def status_code(exc):
+    """Return the HTTP status of the vendor response an exception was raised for, or None"""
+    for attr in ('status_code', 'status'):
+        status = getattr(exc, attr, None)
+        if isinstance(status, int):
+            return status
+
+    response = getattr(exc, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def retry_after(exc):
+    """Return the seconds the vendor asked to wait in a Retry-After header, or None"""
+    value = getattr(exc, 'retry_after', None)
+    if value is None:
+        response = getattr(exc, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        value = headers.get('Retry-After')
+
+    if isinstance(value, (int, float)):
+        return max(0, value)
+
+    if not isinstance(value, basestring):
+        return None
+
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+
+    return max(0, mktime_tz(date) - time())
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter.
+
+    The wait before retry n (from 0) is random between 0 and `base * 2 ** n` seconds, up
+    to `cap`, so that tasks that failed together don't all retry together. It's never
+    less than what the vendor asked for in a Retry-After header, up to `cap`.
+    """
+    def __init__(self, name, base, cap):
+        self.name = name
+        self.base = base
+        self.cap = cap
+
+    def countdown(self, retries, exc):
+        countdown = int(uniform(0, min(self.cap, self.base * 2 ** retries)))
+        wait = retry_after(exc)
+        if wait is not None:
+            statsd.incr('news.tasks.retry_policy.retry_after')
+            countdown = max(countdown, min(int(wait), self.cap))
+
+        return max(1, countdown)
+
+
+class RetryPolicies(object):
+    """
+    Pick the policy for an error by its class and the HTTP status of the vendor response.
+
+    Policies are checked in the order they were added, and the default is used if none
+    match.
+    """
+    def __init__(self, default):
+        self.default = default
+        self._policies = []
+
+    def add(self, policy, exc_classes=Exception, statuses=None):
+        """
+        @param policy: RetryPolicy
+        @param exc_classes: exception class, or tuple of them, the policy is for
+        @param statuses: HTTP statuses the policy is for, or None for any
+        """
+        self._policies.append((policy, exc_classes, statuses))
+
+    def get_policy(self, exc):
+        status = status_code(exc)
+        for policy, exc_classes, statuses in self._policies:
+            if isinstance(exc, exc_classes) and (statuses is None or status in statuses):
+                return policy
+
+        return self.default
+
+    def countdown(self, retries, exc):
+        """Return the seconds to wait before retrying a task that failed with `exc`"""
+        policy = self.get_policy(exc)
+        countdown = policy.countdown(retries, exc)
+        statsd.incr('news.tasks.retry_policy.{}'.format(policy.name))
+        statsd.timing('news.tasks.retry_policy.{}.countdown'.format(policy.name),
+                      countdown * 1000)
+        return countdown
+
+
+class RetryBudget(object):
+    """
+    Limit the retries across all workers to a percentage of the first tries.
+
+    First tries and retries are counted in the cache over the last
+    TASK_RETRY_BUDGET_WINDOW seconds, in RETRY_BUDGET_BUCKETS buckets so old counts
+    fall out of the window a piece at a time. At least TASK_RETRY_BUDGET_MIN retries
+    are allowed per window so that a quiet hour doesn't leave none.
+    """
+    cache_prefix = 'tasks:retry_budget:'
+    buckets = 6
+
+    @property
+    def enabled(self):
+        return bool(settings.TASK_RETRY_BUDGET)
+
+    def _bucket_size(self):
+        return max(1, settings.TASK_RETRY_BUDGET_WINDOW // self.buckets)
+
+    def _key(self, kind, bucket):
+        return '{}{}:{}'.format(self.cache_prefix, kind, bucket)
+
+    def _incr(self, key):
+        """Add one to a bucket and return its new count, or None if that failed"""
+        cache.add(key, 0, self._bucket_size() * (self.buckets + 1))
+        try:
+            return cache.incr(key)
+        except ValueError:
+            # expired between add and incr
+            return None
+
+    def _count(self, kind, previous_only=False):
+        current = int(time() / self._bucket_size())
+        last = current if previous_only else current + 1
+        keys = [self._key(kind, bucket) for bucket in range(current - self.buckets + 1, last)]
+        return sum(cache.get_many(keys).values())
+
+    def _current_key(self, kind):
+        return self._key(kind, int(time() / self._bucket_size()))
+
+    def record_attempt(self):
+        """Count the first try of a task"""
+        if self.enabled:
+            self._incr(self._current_key('attempts'))
+
+    def allowed(self):
+        """Return the number of retries allowed in the current window"""
+        attempts = self._count('attempts')
+        return max(settings.TASK_RETRY_BUDGET_MIN,
+                   int(attempts * settings.TASK_RETRY_BUDGET / 100.0))
+
+    def spend(self):
+        """
+        Count a retry if there's room for it in the budget.
+
+        @return: True if the retry is within the budget, False if not
+        """
+        if not self.enabled:
+            return True
+
+        allowed = self.allowed()
+        # count the retry first so that workers spending at the same time can't all fit
+        # in the last of the budget, then take it back if it didn't fit
+        key = self._current_key('retries')
+        current = self._incr(key)
+        if current is None:
+            return True
+
+        retries = self._count('retries', previous_only=True) + current
+        # percent of the budget used
+        statsd.gauge('news.tasks.retry_budget.used',
+                     int(min(retries, allowed) * 100.0 / max(1, allowed)))
+        if retries > allowed:
+            try:
+                cache.decr(key)
+            except ValueError:
+                pass
+
+            statsd.incr('news.tasks.retry_budget.exhausted')
+            return False
+
+        return True
+
+    def delay(self):
+        """Return the seconds a retry over the budget waits, at least"""
+        delay = settings.TASK_RETRY_BUDGET_DELAY
+        return int(uniform(delay, delay * 1.5))
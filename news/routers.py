@@ -0,0 +1,158 @@
+"""
+Celery queues and routers for news.tasks.
+"""
+from __future__ import absolute_import
+
+import json
+from hashlib import sha256
+from time import time
+
+from django.conf import settings
+
+from kombu import Exchange, Queue
+
+
+AFFINITY_QUEUE_NAME = 'basket-affinity-{}'
+DEFAULT_QUEUE = 'celery'
+INTERACTIVE_SFDC_QUEUE = 'basket-interactive-sfdc'
+INTERACTIVE_SFMC_QUEUE = 'basket-interactive-sfmc'
+BULK_SFDC_QUEUE = 'basket-bulk-sfdc'
+BULK_SFMC_QUEUE = 'basket-bulk-sfmc'
+DONATIONS_QUEUE = 'basket-donations-sfdc'
+# tasks users are waiting on go to the interactive queues, and tasks for each backend to
+# queues of their own so that one being down or slow doesn't hold up the other.
+# anything not listed uses the default queue.
+TASK_QUEUES = {
+    'news.tasks.confirm_user': INTERACTIVE_SFDC_QUEUE,
+    'news.tasks.send_recovery_message_task': INTERACTIVE_SFDC_QUEUE,
+    'news.tasks.upsert_user': INTERACTIVE_SFDC_QUEUE,
+    'news.tasks.add_sms_user': INTERACTIVE_SFMC_QUEUE,
+    'news.tasks.refresh_sfmc_token': INTERACTIVE_SFMC_QUEUE,
+    'news.tasks.send_message': INTERACTIVE_SFMC_QUEUE,
+    'news.tasks.sfdc_add_update': BULK_SFDC_QUEUE,
+    'news.tasks.sync_contact_replica': BULK_SFDC_QUEUE,
+    'news.tasks.update_contact_low_priority': BULK_SFDC_QUEUE,
+    'news.tasks.update_custom_unsub': BULK_SFDC_QUEUE,
+    'news.tasks.add_fxa_activity': BULK_SFMC_QUEUE,
+    'news.tasks.add_sms_user_optin': BULK_SFMC_QUEUE,
+    'news.tasks.record_source_url': BULK_SFMC_QUEUE,
+    'news.tasks.update_fxa_info': BULK_SFMC_QUEUE,
+    'news.tasks.process_donation': DONATIONS_QUEUE,
+}
+# message header with the time a task was queued
+SENT_HEADER = 'basket_sent'
+
+
+def task_arg(args, kwargs, index, name):
+    if name in kwargs:
+        return kwargs[name]
+
+    if len(args) > index:
+        return args[index]
+
+    return None
+
+
+def upsert_user_key(args, kwargs):
+    data = task_arg(args, kwargs, 1, 'data') or {}
+    return data.get('email') or data.get('token')
+
+
+def token_key(args, kwargs):
+    return task_arg(args, kwargs, 0, 'token')
+
+
+def donation_key(args, kwargs):
+    data = task_arg(args, kwargs, 0, 'data') or {}
+    return data.get('data', {}).get('email')
+
+
+# the key each task locks with get_lock, by task name
+AFFINITY_KEYS = {
+    'news.tasks.confirm_user': token_key,
+    'news.tasks.process_donation': donation_key,
+    'news.tasks.update_custom_unsub': token_key,
+    'news.tasks.upsert_user': upsert_user_key,
+}
+
+
+def affinity_queue(key):
+    """Return the name of the queue for tasks locking this key"""
+    key_hash = int(sha256(key.lower().encode('utf-8')).hexdigest(), 16)
+    return AFFINITY_QUEUE_NAME.format(key_hash % settings.TASK_AFFINITY_QUEUES)
+
+
+class AffinityRouter(object):
+    """
+    Send the tasks for an email address or token to the same queue.
+
+    With TASK_AFFINITY_QUEUES set, the key a task would lock with get_lock is hashed
+    onto that many queues. Each must be consumed by a worker with a concurrency of 1,
+    so the tasks for a key run one at a time, in order, without the lock.
+    """
+    def route_for_task(self, task, args=None, kwargs=None):
+        if not settings.TASK_AFFINITY_QUEUES or task not in AFFINITY_KEYS:
+            return None
+
+        key = AFFINITY_KEYS[task](args or (), kwargs or {})
+        if not key:
+            return None
+
+        return {'queue': affinity_queue(key)}
+
+
+class QueueRouter(object):
+    """
+    Send tasks to the queue for their priority and backend if TASK_QUEUES_ENABLE is set.
+
+    AffinityRouter is consulted first, so tasks it routes don't use these queues.
+    """
+    def route_for_task(self, task, args=None, kwargs=None):
+        if not settings.TASK_QUEUES_ENABLE or task not in TASK_QUEUES:
+            return None
+
+        return {'queue': TASK_QUEUES[task]}
+
+
+def declared_queues():
+    """
+    Return the queues a worker consumes from when not given any.
+
+    The affinity queues are left out since each needs a worker of its own.
+    """
+    names = [DEFAULT_QUEUE] + sorted(set(TASK_QUEUES.values()))
+    return [Queue(name, Exchange(name), routing_key=name) for name in names]
+
+
+def queue_names():
+    """Return the names of all of the queues tasks can be sent to"""
+    names = [DEFAULT_QUEUE]
+    if settings.TASK_QUEUES_ENABLE:
+        names.extend(sorted(set(TASK_QUEUES.values())))
+
+    names.extend(AFFINITY_QUEUE_NAME.format(i) for i in range(settings.TASK_AFFINITY_QUEUES))
+    return names
+
+
+def queue_stats(channel, name):
+    """
+    Return the number of messages waiting in a queue, and the age in seconds of the
+    oldest one, or None if that isn't known.
+    """
+    client = getattr(channel, 'client', None)
+    if client is None:
+        # not Redis. only the depth is available.
+        return channel.queue_declare(queue=name, passive=True).message_count, None
+
+    depth = client.llen(name)
+    # messages are pushed on the left and taken from the right
+    oldest = client.lindex(name, -1)
+    if not oldest:
+        return depth, None
+
+    try:
+        sent = json.loads(oldest)['headers'][SENT_HEADER]
+    except (ValueError, KeyError, TypeError):
+        return depth, None
+
+    return depth, max(0, time() - sent)
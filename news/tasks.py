@@ -9,19 +9,30 @@ from time import mktime, time
 
 from django.conf import settings
 from django.core.cache import cache, caches
+from django.db import DatabaseError
+from django.utils.timezone import now
 
 import requests
 import simple_salesforce as sfapi
 import user_agents
-from celery.signals import task_failure, task_retry, task_success
+from celery import current_task
+from celery.exceptions import Retry
+from celery.signals import before_task_publish, task_failure, task_retry, task_success
 from django_statsd.clients import statsd
 from raven.contrib.django.raven_compat.models import client as sentry_client
 
-from news.backends.common import NewsletterException, NewsletterNoResultsException
-from news.backends.sfdc import sfdc
+from news.backends.common import (CircuitOpenException, NewsletterException,
+                                  NewsletterNoResultsException)
+from news.backends.sfdc import (api_call_allowed, index_fetched_contact, indexed_contact,
+                                indexed_contact_id, is_stale_id_error, sfdc, unindex_contact,
+                                PRIORITY_LOW, PRIORITY_NORMAL)
 from news.backends.sfmc import sfmc
 from news.celery import app as celery_app
-from news.models import FailedTask, Newsletter, Interest, QueuedTask, TransactionalEmailMessage
+from news.replica import get_replica_contact, sync_contact_replica as sync_replica
+from news.retries import RetryBudget, RetryPolicies, RetryPolicy
+from news.routers import affinity_queue, queue_names, queue_stats as get_queue_stats, SENT_HEADER
+from news.models import (DelayedTask, FailedTask, Newsletter, Interest, QueuedTask,
+                         TransactionalEmailMessage)
 from news.newsletters import get_sms_messages, get_transactional_message_ids, newsletter_map
 from news.utils import (generate_token, get_user_data,
                         parse_newsletters, parse_newsletters_csv, SUBSCRIBE, UNSUBSCRIBE)
@@ -30,6 +41,17 @@ from news.utils import (generate_token, get_user_data,
 log = logging.getLogger(__name__)
 
 BAD_MESSAGE_ID_CACHE = caches['bad_message_ids']
+# only one replica sync runs at a time. expires in case a worker dies mid-sync.
+REPLICA_SYNC_LOCK_KEY = 'basket-task-sync-contact-replica'
+REPLICA_SYNC_LOCK_TIMEOUT = 60 * 60
+# changes queued by queue_upsert_user, and the ids of those applied, are kept this long
+UPSERT_COALESCE_TIMEOUT = 60 * 60 * 24
+# most queued changes for one email or token applied together
+UPSERT_COALESCE_MAX_OPS = 50
+UPSERT_DONE_KEY = 'basket-upsert-done-{}'
+# only one release of delayed retries runs at a time
+RETRY_RELEASE_LOCK_KEY = 'basket-task-release-delayed-tasks'
+RETRY_RELEASE_LOCK_TIMEOUT = 60 * 5
 
 # Base message ID for confirmation email
 CONFIRMATION_MESSAGE = "confirmation_email"
@@ -69,6 +91,15 @@ def ignore_error_post_retry(exc):
     return ignore_error(exc, IGNORE_ERROR_MSGS_POST_RETRY)
 
 
+def current_queue():
+    """Return the name of the queue the running task came from, or None"""
+    if not current_task:
+        return None
+
+    delivery_info = getattr(current_task.request, 'delivery_info', None) or {}
+    return delivery_info.get('routing_key')
+
+
 def get_lock(key, prefix='task'):
     """Get a lock for a specific key (usually email address)
 
@@ -76,17 +107,33 @@ def get_lock(key, prefix='task'):
     indexes before the duplicate protection works and queries will return results.
     Releasing the lock right after the task was run still allowed dupes.
 
-    Does nothing if you get the lock, and raises RetryTask if not.
+    Does nothing if you get the lock, and raises RetryTask if not. Also does nothing
+    if the task came from the affinity queue for the key (see news.routers), since
+    only one worker runs the tasks from that queue, one at a time.
     """
     if not settings.TASK_LOCKING_ENABLE:
         return
 
+    if settings.TASK_AFFINITY_QUEUES and current_queue() == affinity_queue(key):
+        statsd.incr('news.tasks.get_lock.affinity')
+        return
+
     lock_key = 'basket-{}-{}'.format(prefix, key)
     lock_key = sha256(lock_key).hexdigest()
     got_lock = cache.add(lock_key, True, settings.TASK_LOCK_TIMEOUT)
     if not got_lock:
         statsd.incr('news.tasks.get_lock.no_lock_retry')
-        raise RetryTask('Could not acquire lock')
+        raise TaskLocked('Could not acquire lock')
+
+
+def check_api_limit(priority):
+    """Defer a task of this priority if the SFDC daily API limit is close.
+
+    Does nothing if there is room for the work, and raises APILimitReached if not.
+    """
+    if not api_call_allowed(priority):
+        statsd.incr('news.tasks.check_api_limit.{}_deferred'.format(priority))
+        raise APILimitReached('SFDC API limit nearly reached')
 
 
 class BasketError(Exception):
@@ -103,6 +150,37 @@ class RetryTask(Exception):
     """an exception to raise within a task if you just want to retry"""
 
 
+class TaskLocked(RetryTask):
+    """another task is working on the same email address or token"""
+
+
+class APILimitReached(RetryTask):
+    """there isn't room for the task under the SFDC daily API limit"""
+
+
+# how long to wait before retrying a task, by what it failed with
+retry_policies = RetryPolicies(RetryPolicy('default', base=120, cap=2 ** 8 * 60))
+# the other task is usually done within seconds
+retry_policies.add(RetryPolicy('locked', base=5, cap=120), TaskLocked)
+# the API usage is checked every API_USAGE_CACHE_TIMEOUT seconds
+retry_policies.add(RetryPolicy('api_limit', base=15 * 60, cap=2 * 60 * 60),
+                   (APILimitReached, sfapi.SalesforceRefusedRequest))
+# calls fail right away until the circuit closes
+retry_policies.add(RetryPolicy('circuit_open', base=60, cap=30 * 60), CircuitOpenException)
+retry_policies.add(RetryPolicy('throttled', base=60, cap=30 * 60), statuses=(429, 503))
+retry_policies.add(RetryPolicy('server_error', base=120, cap=2 ** 8 * 60),
+                   statuses=range(500, 600))
+# retries shared by all workers, so an outage doesn't multiply the load on the vendor
+retry_budget = RetryBudget()
+
+
+@before_task_publish.connect
+def on_before_task_publish(headers=None, **kwargs):
+    # for the age of the oldest message in each queue
+    if headers is not None:
+        headers[SENT_HEADER] = time()
+
+
 @task_failure.connect
 def on_task_failure(sender, task_id, exception, einfo, args, kwargs, **skwargs):
     statsd.incr(sender.name + '.failure')
@@ -134,6 +212,73 @@ def on_task_success(sender, **kwargs):
         statsd.incr('news.tasks.success_total')
 
 
+def park_retry(task, countdown, exc):
+    """
+    Keep a retry in the DelayedTask table until it's due instead of in a worker's memory.
+
+    release_delayed_tasks queues it again then. Raises MaxRetriesExceededError like
+    Task.retry.
+
+    @return: the Retry exception to raise
+    """
+    request = task.request
+    if task.max_retries is not None and request.retries >= task.max_retries:
+        raise task.MaxRetriesExceededError(
+            "Can't retry {0}[{1}] args:{2} kwargs:{3}".format(
+                task.name, request.id, request.args, request.kwargs))
+
+    try:
+        DelayedTask.objects.create(
+            due=now() + datetime.timedelta(seconds=countdown),
+            task_id=request.id,
+            name=task.name,
+            args=list(request.args or []),
+            kwargs=request.kwargs or {},
+            retries=request.retries + 1,
+        )
+    except DatabaseError:
+        statsd.incr('news.tasks.park_retry.error')
+        # raises Retry
+        task.retry(countdown=countdown)
+
+    statsd.incr(task.name + '.retry_parked')
+    return Retry(exc=exc, when=countdown)
+
+
+def defer_task(task, countdown, exc):
+    """
+    Queue a task to run again later without counting it as a retry.
+
+    For work waiting for room under the SFDC API limit, which can take hours, so that
+    it isn't dropped once it has been deferred max_retries times.
+
+    @return: the Retry exception to raise
+    """
+    request = task.request
+    # the next run isn't a first try to count in the retry budget
+    kwargs = dict(request.kwargs or {}, deferred=True)
+    if settings.TASK_RETRY_STORE:
+        try:
+            DelayedTask.objects.create(
+                due=now() + datetime.timedelta(seconds=countdown),
+                task_id=request.id,
+                name=task.name,
+                args=list(request.args or []),
+                kwargs=kwargs,
+                retries=request.retries,
+            )
+        except DatabaseError:
+            statsd.incr('news.tasks.park_retry.error')
+        else:
+            statsd.incr(task.name + '.deferred')
+            return Retry(exc=exc, when=countdown)
+
+    task.subtask_from_request(request, kwargs=kwargs, countdown=countdown,
+                              retries=request.retries).apply_async()
+    statsd.incr(task.name + '.deferred')
+    return Retry(exc=exc, when=countdown)
+
+
 def et_task(func):
     """Decorator to standardize ET Celery tasks."""
     @celery_app.task(bind=True,
@@ -142,11 +287,14 @@ def et_task(func):
     @wraps(func)
     def wrapped(self, *args, **kwargs):
         start_time = kwargs.pop('start_time', None)
+        deferred = kwargs.pop('deferred', False)
         if start_time and not self.request.retries:
             total_time = int((time() - start_time) * 1000)
             statsd.timing(self.name + '.timing', total_time)
         statsd.incr(self.name + '.total')
         statsd.incr('news.tasks.all_total')
+        if not (self.request.retries or deferred):
+            retry_budget.record_attempt()
         if settings.MAINTENANCE_MODE and self.name not in MAINTENANCE_EXEMPT:
             if not settings.READ_ONLY_MODE:
                 # record task for later
@@ -170,11 +318,30 @@ def et_task(func):
             if ignore_error(e):
                 return
 
+            if isinstance(e, APILimitReached) and not (self.request.called_directly or
+                                                       self.request.is_eager):
+                raise defer_task(self, retry_policies.countdown(self.request.retries, e), e)
+
             try:
-                if not (isinstance(e, RetryTask) or ignore_error_post_retry(e)):
+                # a final attempt won't be retried, so it mustn't use up the budget
+                will_retry = self.max_retries is None or self.request.retries < self.max_retries
+                within_budget = not will_retry or retry_budget.spend()
+                # an open circuit was already reported by the calls that failed, and
+                # over the budget there are too many failures to report each
+                if not (isinstance(e, (RetryTask, CircuitOpenException)) or
+                        ignore_error_post_retry(e) or not within_budget):
                     sentry_client.captureException(tags={'action': 'retried'})
 
-                raise self.retry(countdown=2 ** (self.request.retries + 1) * 60)
+                countdown = retry_policies.countdown(self.request.retries, e)
+                if not within_budget:
+                    statsd.incr(self.name + '.retry_over_budget')
+                    countdown = max(countdown, retry_budget.delay())
+
+                if settings.TASK_RETRY_STORE and not (self.request.called_directly or
+                                                      self.request.is_eager):
+                    raise park_retry(self, countdown, e)
+
+                raise self.retry(countdown=countdown)
             except self.MaxRetriesExceededError:
                 statsd.incr(self.name + '.retry_max')
                 statsd.incr('news.tasks.retry_max_total')
@@ -242,21 +409,116 @@ def update_get_involved(interest_id, lang, name, email, country, email_format,
     interest.notify_stewards(name, email, lang, message)
 
 
+def upsert_cache_prefix(key):
+    return 'basket-upsert-{}-'.format(sha256(key.encode('utf-8')).hexdigest())
+
+
+def queue_upsert_user(api_call_type, data):
+    """
+    Queue an upsert_user task that also applies the other changes for the same contact
+    queued before it runs.
+
+    The task runs UPSERT_COALESCE_WINDOW seconds later. The change is kept in the cache
+    under its email or token with the time it was queued. The first task for the contact
+    to run collects the changes queued under its email and its token, and applies them
+    in the order they were queued with one contact read and write. The tasks for changes
+    it already applied then do nothing.
+    """
+    key = data.get('email') or data.get('token')
+    prefix = upsert_cache_prefix(key)
+    op_id = generate_token()
+    cache.add(prefix + 'count', 0, UPSERT_COALESCE_TIMEOUT)
+    try:
+        slot = cache.incr(prefix + 'count')
+    except ValueError:
+        # expired between add and incr. the task will apply only this change.
+        pass
+    else:
+        cache.set(prefix + str(slot), (op_id, api_call_type, data, time()),
+                  UPSERT_COALESCE_TIMEOUT)
+
+    upsert_user.apply_async((api_call_type, data), {'start_time': time(), 'op_id': op_id},
+                            countdown=settings.UPSERT_COALESCE_WINDOW)
+
+
+def upsert_keys(data, user_data):
+    """Return the emails and tokens that changes to the contact could be queued under"""
+    keys = []
+    for record in (data, user_data or {}):
+        for field in ('email', 'token'):
+            if record.get(field) and record[field] not in keys:
+                keys.append(record[field])
+
+    return keys
+
+
+def pending_upserts(keys, op_id, api_call_type, data):
+    """
+    Return the changes queued for any of the emails or tokens of a contact that haven't
+    been applied, in the order they were queued, and their ids.
+    """
+    slot_keys = []
+    for key in keys:
+        prefix = upsert_cache_prefix(key)
+        count = cache.get(prefix + 'count') or 0
+        slot_keys.extend(prefix + str(slot) for slot in
+                         range(max(1, count - UPSERT_COALESCE_MAX_OPS + 1), count + 1))
+
+    slots = cache.get_many(slot_keys)
+    pending = sorted((slots[slot_key] for slot_key in slot_keys if slot_key in slots),
+                     key=lambda slot: slot[3])
+    done = cache.get_many([UPSERT_DONE_KEY.format(slot[0]) for slot in pending])
+    operations = []
+    op_ids = []
+    for pending_id, pending_type, pending_data, _ in pending:
+        if UPSERT_DONE_KEY.format(pending_id) not in done and pending_id not in op_ids:
+            operations.append((pending_type, pending_data))
+            op_ids.append(pending_id)
+
+    if op_id not in op_ids:
+        # the cache lost it
+        operations.append((api_call_type, data))
+        op_ids.append(op_id)
+
+    return operations, op_ids
+
+
 @et_task
-def upsert_user(api_call_type, data):
+def upsert_user(api_call_type, data, op_id=None):
     """
     Update or insert (upsert) a contact record in SFDC
 
     @param int api_call_type: What kind of API call it was. Could be
         SUBSCRIBE, UNSUBSCRIBE, or SET.
     @param dict data: POST data from the form submission
+    @param str op_id: id of the change if it was queued with queue_upsert_user
     @return:
     """
+    if op_id and cache.get(UPSERT_DONE_KEY.format(op_id)):
+        # applied by the task for another change to this contact
+        statsd.incr('news.tasks.upsert_user.coalesced')
+        return
+
+    check_api_limit(PRIORITY_NORMAL)
     key = data.get('email') or data.get('token')
     get_lock(key)
-    upsert_contact(api_call_type, data,
-                   get_user_data(data.get('token'), data.get('email'),
-                                 extra_fields=['id']))
+    # only changes are sent, so this must not be a stale cached copy
+    user_data = get_user_data(data.get('token'), data.get('email'), extra_fields=['id'],
+                              use_cache=False)
+    if user_data:
+        index_fetched_contact(user_data, by_email=not data.get('token'))
+
+    if not op_id:
+        upsert_contact(api_call_type, data, user_data)
+        return
+
+    # the same contact can have changes queued under its email and under its token
+    operations, op_ids = pending_upserts(upsert_keys(data, user_data), op_id,
+                                         api_call_type, data)
+    statsd.incr('news.tasks.upsert_user.operations', len(operations))
+    upsert_contact_operations(operations, user_data)
+    cache.set_many({UPSERT_DONE_KEY.format(done_id): True for done_id in op_ids},
+                   UPSERT_COALESCE_TIMEOUT)
 
 
 def upsert_contact(api_call_type, data, user_data):
@@ -269,6 +531,73 @@ def upsert_contact(api_call_type, data, user_data):
     @param dict user_data: existing contact data from SFDC
     @return: token, created
     """
+    update_data = contact_update_data(api_call_type, data, user_data)
+    if update_data is None:
+        # no regular newsletters
+        return None, None
+
+    return save_contact_update(update_data, user_data)
+
+
+def upsert_contact_operations(operations, user_data):
+    """
+    Apply several upserts to a contact in order, with one write to SFDC.
+
+    Each change is worked out from the contact as the ones before it would have
+    left it, and what is saved is the difference between the contact at the end and
+    the one in SFDC, so the result is the same as applying them one at a time.
+
+    @param list operations: (api_call_type, data) tuples in the order they were made
+    @param dict user_data: existing contact data from SFDC
+    @return: token, created
+    """
+    changed = set()
+    cur_data = user_data
+    for api_call_type, data in operations:
+        update_data = contact_update_data(api_call_type, data.copy(), cur_data)
+        if update_data is None:
+            continue
+
+        changed.update(update_data)
+        cur_data = updated_user_data(cur_data, update_data)
+
+    if not changed:
+        return None, None
+
+    net_data = {name: cur_data[name] for name in changed if name != 'newsletters'}
+    old_newsletters = set((user_data or {}).get('newsletters') or [])
+    new_newsletters = set(cur_data['newsletters'])
+    net_data['newsletters'] = dict([(newsletter, True) for newsletter in
+                                    new_newsletters - old_newsletters] +
+                                   [(newsletter, False) for newsletter in
+                                    old_newsletters - new_newsletters])
+    return save_contact_update(net_data, user_data)
+
+
+def updated_user_data(user_data, update_data):
+    """Return the user data as it will be once the update is saved"""
+    new_data = dict(user_data or {})
+    new_data.update((name, value) for name, value in update_data.items()
+                    if name != 'newsletters')
+    newsletters = set(new_data.get('newsletters') or [])
+    for newsletter, subscribed in update_data['newsletters'].items():
+        if subscribed:
+            newsletters.add(newsletter)
+        else:
+            newsletters.discard(newsletter)
+
+    new_data['newsletters'] = list(newsletters)
+    new_data['optin'] = bool((user_data and user_data.get('optin')) or update_data.get('optin'))
+    return new_data
+
+
+def contact_update_data(api_call_type, data, user_data):
+    """
+    Return the changes to save for a contact, or None if there are none.
+
+    Sends any transactional messages subscribed to, and records the source URL
+    of newsletter subscriptions.
+    """
     update_data = data.copy()
     forced_optin = data.pop('optin', False)
     if 'format' in data:
@@ -291,7 +620,7 @@ def upsert_contact(api_call_type, data, user_data):
             send_transactional_messages(update_data, user_data, list(transactionals))
             if not newsletters:
                 # no regular newsletters
-                return None, None
+                return None
 
     # Set the newsletter flags in the record by comparing to their
     # current subscriptions.
@@ -318,6 +647,29 @@ def upsert_contact(api_call_type, data, user_data):
                 record_source_url.delay(update_data['email'], update_data['source_url'],
                                         nl_map[nlid])
 
+    if user_data is None:
+        return update_data
+
+    if forced_optin and not user_data.get('optin'):
+        update_data['optin'] = True
+
+    # they opted out of email before, but are subscribing again
+    # clear the optout flag
+    if api_call_type != UNSUBSCRIBE and user_data.get('optout'):
+        update_data['optout'] = False
+
+    if not user_data.get('token'):
+        update_data['token'] = generate_token()
+
+    return update_data
+
+
+def save_contact_update(update_data, user_data):
+    """
+    Create the contact, or save the changes to the existing one.
+
+    @return: token, created
+    """
     if user_data is None:
         # no user found. create new one.
         update_data['token'] = generate_token()
@@ -329,24 +681,13 @@ def upsert_contact(api_call_type, data, user_data):
 
         return update_data['token'], True
 
-    if forced_optin and not user_data.get('optin'):
-        update_data['optin'] = True
-
-    # they opted out of email before, but are subscribing again
-    # clear the optout flag
-    if api_call_type != UNSUBSCRIBE and user_data.get('optout'):
-        update_data['optout'] = False
-
     # update record
-    if user_data and user_data.get('token'):
-        token = user_data['token']
-    else:
-        token = update_data['token'] = generate_token()
-
+    token = user_data.get('token') or update_data['token']
     if settings.MAINTENANCE_MODE:
         sfdc_add_update.delay(update_data, user_data)
     else:
-        sfdc.update(user_data, update_data)
+        # repeat submissions often change nothing, so only send what does
+        sfdc.update(user_data, update_data, diff=True)
 
     return token, False
 
@@ -355,6 +696,7 @@ def upsert_contact(api_call_type, data, user_data):
 def sfdc_add_update(update_data, user_data=None):
     # for use with maintenance mode only
     # TODO remove after maintenance is over and queue is processed
+    check_api_limit(PRIORITY_NORMAL)
     if user_data:
         sfdc.update(user_data, update_data)
     else:
@@ -534,8 +876,33 @@ def confirm_user(token):
     :raises: BasketError for fatal errors, NewsletterException for retryable
         errors.
     """
+    check_api_limit(PRIORITY_NORMAL)
     get_lock(token)
+    contact = indexed_contact(token=token)
+    if contact:
+        # a known contact needn't be looked up first. the replica copy, if any, tells
+        # whether it's confirmed already, and confirming again changes nothing.
+        copy = get_replica_contact(token=token, max_age=settings.SFDC_REPLICA_MAX_AGE)
+        if copy and copy.get('optin'):
+            return
+
+        if not contact['email']:
+            raise BasketError('token has no email in ET')
+
+        contact_id = contact['id']
+        try:
+            sfdc.update({'id': contact_id, 'token': token}, {'optin': True})
+            return
+        except (sfapi.SalesforceResourceNotFound, sfapi.SalesforceMalformedRequest) as e:
+            if not is_stale_id_error(e):
+                raise
+
+            # deleted or merged since it was indexed
+            unindex_contact(contact_id)
+
     user_data = get_user_data(token=token)
+    if user_data:
+        index_fetched_contact(user_data)
 
     if user_data is None:
         user = get_sfmc_doi_user(token)
@@ -583,6 +950,7 @@ def add_sms_user_optin(mobile_number):
 @et_task
 def update_custom_unsub(token, reason):
     """Record a user's custom unsubscribe reason."""
+    check_api_limit(PRIORITY_LOW)
     get_lock(token)
     try:
         sfdc.update({'token': token}, {'reason': reason})
@@ -633,8 +1001,30 @@ DONATION_OPTIONAL_FIELDS = {
 }
 
 
+def donation_opportunity(data, timestamp):
+    """Return the vendor fields for the Opportunity of a donation"""
+    donation = {
+        'RecordTypeId': settings.DONATE_OPP_RECORD_TYPE,
+        'Name': 'Foundation Donation',
+        'StageName': 'Closed Won',
+        'CloseDate': timestamp,
+        'Amount': float(data['donation_amount']),
+        'Currency__c': data['currency'].upper(),
+        'Payment_Source__c': data['service'],
+        'PMT_Transaction_ID__c': data['transaction_id'],
+        'Payment_Type__c': 'Recurring' if data['recurring'] else 'One-Time',
+    }
+    for dest_name, source_name in DONATION_OPTIONAL_FIELDS.items():
+        value = data.get(source_name)
+        if value:
+            donation[dest_name] = value
+
+    return donation
+
+
 @et_task
 def process_donation(data):
+    check_api_limit(PRIORITY_NORMAL)
     timestamp = data['timestamp']
     data = data['data']
     get_lock(data['email'])
@@ -656,45 +1046,119 @@ def process_donation(data):
         if last:
             contact_data['last_name'] = last
 
+    donation = donation_opportunity(data, timestamp)
+    contact_id = indexed_contact_id(email=data['email'])
+    if contact_id:
+        # send any names along with the donation instead of looking the contact up to
+        # see whether they changed. near the API limit they wait for a later update.
+        update_names = api_call_allowed(PRIORITY_LOW)
+        try:
+            sfdc.add_donation(donation, {'id': contact_id, 'email': data['email']},
+                              contact_data if update_names else None)
+        except (sfapi.SalesforceResourceNotFound, sfapi.SalesforceMalformedRequest) as e:
+            if not is_stale_id_error(e):
+                raise
+
+            # deleted or merged since it was indexed. nothing was saved.
+            unindex_contact(contact_id)
+        else:
+            if not update_names and len(contact_data) > 1:
+                update_contact_low_priority.delay({'id': contact_id}, contact_data)
+            return
+
     user_data = get_user_data(email=data['email'],
-                              extra_fields=['id'])
+                              extra_fields=['id'], use_cache=False)
     if user_data:
-        if contact_data and (
-                ('first_name' in contact_data and contact_data['first_name'] != user_data['first_name']) or
+        index_fetched_contact(user_data, by_email=True)
+        if not (('first_name' in contact_data and contact_data['first_name'] != user_data['first_name']) or
                 ('last_name' in contact_data and contact_data['last_name'] != user_data['last_name'])):
-            sfdc.update(user_data, contact_data)
+            contact_data = None
+        elif not api_call_allowed(PRIORITY_LOW):
+            # names can wait until there is room under the API limit
+            update_contact_low_priority.delay({'id': user_data['id']}, contact_data)
+            contact_data = None
     else:
         contact_data['token'] = generate_token()
         contact_data['email'] = data['email']
         contact_data['record_type'] = settings.DONATE_CONTACT_RECORD_TYPE
 
-        sfdc.add(contact_data)
-        # fetch again to get ID
-        user_data = get_user_data(email=data.get('email'),
-                                  extra_fields=['id'])
-        if not user_data:
-            # retry here to make sure we associate the donation data with the proper account
-            raise RetryTask('User not yet available')
+    # creates or updates the contact and adds the donation for it in one request
+    sfdc.add_donation(donation, user_data, contact_data)
+
+
+@et_task
+def update_contact_low_priority(record, data):
+    """Update a contact when there is room under the SFDC API limit for low priority work."""
+    check_api_limit(PRIORITY_LOW)
+    sfdc.update(record, data)
 
-    # add opportunity
-    donation = {
-        'RecordTypeId': settings.DONATE_OPP_RECORD_TYPE,
-        'Name': 'Foundation Donation',
-        'Donation_Contact__c': user_data['id'],
-        'StageName': 'Closed Won',
-        'CloseDate': timestamp,
-        'Amount': float(data['donation_amount']),
-        'Currency__c': data['currency'].upper(),
-        'Payment_Source__c': data['service'],
-        'PMT_Transaction_ID__c': data['transaction_id'],
-        'Payment_Type__c': 'Recurring' if data['recurring'] else 'One-Time',
-    }
-    for dest_name, source_name in DONATION_OPTIONAL_FIELDS.items():
-        value = data.get(source_name)
-        if value:
-            donation[dest_name] = value
 
-    sfdc.opportunity.create(donation)
+@celery_app.task()
+def sync_contact_replica():
+    """Copy the contacts changed in SFDC since the last run into the local replica."""
+    if settings.MAINTENANCE_MODE or not api_call_allowed(PRIORITY_LOW):
+        # the next run catches up
+        statsd.incr('news.tasks.sync_contact_replica.skipped')
+        return
+
+    if not cache.add(REPLICA_SYNC_LOCK_KEY, True, REPLICA_SYNC_LOCK_TIMEOUT):
+        # the previous run is still going
+        statsd.incr('news.tasks.sync_contact_replica.locked')
+        return
+
+    try:
+        sync_replica(settings.SFDC_REPLICA_SYNC_MAX_RECORDS)
+    finally:
+        cache.delete(REPLICA_SYNC_LOCK_KEY)
+
+
+@celery_app.task()
+def refresh_sfmc_token():
+    """Replace the SFMC token shared by all processes before they would need a new one."""
+    if sfmc.client is None:
+        return
+
+    if sfmc.client.refresh_token_ahead(settings.SFMC_TOKEN_REFRESH_AHEAD):
+        statsd.incr('news.tasks.refresh_sfmc_token.refreshed')
+
+
+@celery_app.task()
+def release_delayed_tasks():
+    """Queue the task retries that are due, at most TASK_RETRY_RELEASE_MAX per run."""
+    if not cache.add(RETRY_RELEASE_LOCK_KEY, True, RETRY_RELEASE_LOCK_TIMEOUT):
+        # the previous run is still going
+        statsd.incr('news.tasks.release_delayed_tasks.locked')
+        return
+
+    try:
+        released = 0
+        for delayed_task in DelayedTask.objects.filter(
+                due__lte=now())[:settings.TASK_RETRY_RELEASE_MAX]:
+            delayed_task.release()
+            released += 1
+
+        statsd.incr('news.tasks.release_delayed_tasks.released', released)
+        statsd.gauge('news.tasks.delayed_tasks', DelayedTask.objects.count())
+    finally:
+        cache.delete(RETRY_RELEASE_LOCK_KEY)
+
+
+@celery_app.task()
+def queue_stats():
+    """Report the number of tasks waiting in each queue and how long the oldest has waited."""
+    with celery_app.connection_or_acquire() as conn:
+        channel = conn.default_channel
+        for name in queue_names():
+            try:
+                depth, age = get_queue_stats(channel, name)
+            except Exception:
+                # e.g. the queue hasn't been used yet
+                statsd.incr('news.tasks.queue_stats.error')
+                continue
+
+            statsd.gauge('news.queues.{}.depth'.format(name), depth)
+            if age is not None:
+                statsd.gauge('news.queues.{}.age'.format(name), int(age))
 
 
 @celery_app.task()
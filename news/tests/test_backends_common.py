@@ -0,0 +1,211 @@
+from threading import Thread
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from mock import Mock, patch
+from requests.packages.urllib3.exceptions import ProtocolError
+
+from news.backends.common import (Batcher, CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN,
+                                  CircuitBreaker, CircuitOpenException, ConcurrencyLimit,
+                                  get_vendor_session,
+                                  NewsletterException, VendorRetry, VendorSession)
+
+
+class BatcherTests(TestCase):
+    def test_single_value(self):
+        """Without a wait a value is sent on its own"""
+        flush = Mock(return_value=['result'])
+        batcher = Batcher('test', flush, max_size=10, max_wait=0)
+        self.assertEqual(batcher.submit('key', 'value'), 'result')
+        flush.assert_called_once_with('key', ['value'])
+
+    def test_per_value_errors(self):
+        """An exception result should only be raised for its own value"""
+        error = NewsletterException('bad value')
+        flush = Mock(return_value=['good', error])
+        batcher = Batcher('test', flush, max_size=2, max_wait=5)
+        results = {}
+
+        def submit(value):
+            try:
+                results[value] = batcher.submit('key', value)
+            except NewsletterException as e:
+                results[value] = e
+
+        first = Thread(target=submit, args=('first',))
+        first.start()
+        # filling the batch sends it without waiting for max_wait
+        submit('second')
+        first.join(1)
+        self.assertEqual(flush.call_count, 1)
+        self.assertEqual(flush.call_args[0][0], 'key')
+        self.assertEqual(sorted(flush.call_args[0][1]), ['first', 'second'])
+        values = flush.call_args[0][1]
+        self.assertEqual(results[values[0]], 'good')
+        self.assertIs(results[values[1]], error)
+
+    def test_flush_error(self):
+        """An exception from the flush function should be raised for every value"""
+        flush = Mock(side_effect=NewsletterException('down'))
+        batcher = Batcher('test', flush, max_size=10, max_wait=0)
+        with self.assertRaises(NewsletterException):
+            batcher.submit('key', 'value')
+
+    def test_result_count_mismatch(self):
+        flush = Mock(return_value=[])
+        batcher = Batcher('test', flush, max_size=10, max_wait=0)
+        with self.assertRaises(NewsletterException):
+            batcher.submit('key', 'value')
+
+    def test_keys_batched_separately(self):
+        flush = Mock(side_effect=lambda key, values: values)
+        batcher = Batcher('test', flush, max_size=10, max_wait=0)
+        self.assertEqual(batcher.submit('POST', 'a'), 'a')
+        self.assertEqual(batcher.submit('PATCH', 'b'), 'b')
+        self.assertEqual(flush.call_count, 2)
+
+
+@override_settings(VENDOR_HTTP_CONNECT_TIMEOUT=2, VENDOR_HTTP_READ_TIMEOUT=10,
+                   VENDOR_HTTP_POOL_SIZE=3, VENDOR_HTTP_RETRIES=1, VENDOR_HTTP_KEEP_ALIVE=False)
+class VendorSessionTests(TestCase):
+    def test_settings(self):
+        session = VendorSession('test')
+        self.assertEqual(session.timeout, (2, 10))
+        self.assertEqual(session.headers['Connection'], 'close')
+        adapter = session.get_adapter('https://example.com/')
+        self.assertEqual(adapter.max_retries.connect, 1)
+        self.assertEqual(adapter._pool_maxsize, 3)
+
+    @patch('requests.Session.request')
+    def test_default_timeout(self, request_mock):
+        session = VendorSession('test')
+        session.get('https://example.com/')
+        self.assertEqual(request_mock.call_args[1]['timeout'], (2, 10))
+        session.get('https://example.com/', timeout=1)
+        self.assertEqual(request_mock.call_args[1]['timeout'], 1)
+
+    def test_shared_session(self):
+        self.assertIs(get_vendor_session('sfdc'), get_vendor_session('sfdc'))
+        self.assertIsNot(get_vendor_session('sfdc'), get_vendor_session('sfmc'))
+
+    def test_no_read_retry_for_post(self):
+        """A connection reset after sending a POST should not send it again"""
+        retry = VendorRetry(total=2, connect=2, read=2)
+        error = ProtocolError('Connection aborted.')
+        with self.assertRaises(ProtocolError):
+            retry.increment('POST', '/', error=error)
+
+        # SFDC updates aren't safe to send twice either
+        with self.assertRaises(ProtocolError):
+            retry.increment('PATCH', '/', error=error)
+
+        self.assertEqual(retry.increment('GET', '/', error=error).read, 1)
+
+
+@override_settings(VENDOR_CIRCUIT_BREAKER_ENABLE=True,
+                   VENDOR_CIRCUIT_BREAKER_THRESHOLD=2,
+                   VENDOR_CIRCUIT_BREAKER_WINDOW=60,
+                   VENDOR_CIRCUIT_BREAKER_RESET_TIMEOUT=30)
+class CircuitBreakerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.breaker = CircuitBreaker('test', (IOError,))
+        self.func = Mock(side_effect=self.vendor_down)
+        self.wrapped = self.breaker(lambda: self.func())
+
+    def vendor_down(self):
+        raise IOError('down')
+
+    def fail(self, times):
+        for i in range(times):
+            with self.assertRaises(IOError):
+                self.wrapped()
+
+    def test_opens_after_threshold(self):
+        self.fail(2)
+        self.assertEqual(self.breaker.state(), CIRCUIT_OPEN)
+        with self.assertRaises(CircuitOpenException):
+            self.wrapped()
+
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_other_errors_do_not_count(self):
+        self.func.side_effect = ValueError
+        for i in range(3):
+            with self.assertRaises(ValueError):
+                self.wrapped()
+
+        self.assertEqual(self.breaker.state(), CIRCUIT_CLOSED)
+
+    @patch('news.backends.common.time')
+    def test_half_open_trial_closes(self, time_mock):
+        time_mock.return_value = 1000
+        self.fail(2)
+        time_mock.return_value = 1031
+        self.assertEqual(self.breaker.state(), CIRCUIT_HALF_OPEN)
+        self.func.side_effect = None
+        self.func.return_value = 'ok'
+        self.assertEqual(self.wrapped(), 'ok')
+        self.assertEqual(self.breaker.state(), CIRCUIT_CLOSED)
+
+    @patch('news.backends.common.time')
+    def test_half_open_trial_reopens(self, time_mock):
+        time_mock.return_value = 1000
+        self.fail(2)
+        time_mock.return_value = 1031
+        self.fail(1)
+        self.assertEqual(self.breaker.state(), CIRCUIT_OPEN)
+
+    @patch('news.backends.common.time')
+    def test_one_trial_at_a_time(self, time_mock):
+        time_mock.return_value = 1000
+        self.fail(2)
+        time_mock.return_value = 1031
+        self.breaker.before_call()
+        with self.assertRaises(CircuitOpenException):
+            self.breaker.before_call()
+
+    def test_batch_failure_counts_once(self):
+        """A failed batch raised to each of its callers is one failed call"""
+        error = IOError('down')
+        self.func.side_effect = error
+        self.fail(3)
+        self.assertEqual(self.breaker.state(), CIRCUIT_CLOSED)
+
+    @override_settings(VENDOR_HTTP_CONNECT_TIMEOUT=5, VENDOR_HTTP_READ_TIMEOUT=30,
+                       VENDOR_HTTP_RETRIES=1)
+    @patch('news.backends.common.cache')
+    def test_trial_lasts_for_all_retries(self, cache_mock):
+        cache_mock.get.return_value = 0
+        cache_mock.add.return_value = True
+        self.assertEqual(self.breaker.before_call(), CIRCUIT_HALF_OPEN)
+        cache_mock.add.assert_called_with(self.breaker._trial_key, True, 71)
+
+    @override_settings(VENDOR_CIRCUIT_BREAKER_ENABLE=False)
+    def test_disabled(self):
+        self.fail(3)
+        self.assertEqual(self.func.call_count, 3)
+
+
+@override_settings(VENDOR_MAX_CONCURRENCY=1, VENDOR_CONCURRENCY_WAIT=0.05)
+class ConcurrencyLimitTests(TestCase):
+    def test_waits_then_fails(self):
+        limit = ConcurrencyLimit('test')
+        limit.acquire()
+        with self.assertRaises(NewsletterException):
+            limit.acquire()
+
+        limit.release()
+        limit.acquire()
+        self.assertEqual(limit.active, 1)
+
+    def test_released_after_error(self):
+        limit = ConcurrencyLimit('test')
+        wrapped = limit(Mock(side_effect=IOError, __name__='call'))
+        for i in range(2):
+            with self.assertRaises(IOError):
+                wrapped()
+
+        self.assertEqual(limit.active, 0)
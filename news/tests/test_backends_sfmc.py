@@ -1,7 +1,12 @@
+from tempfile import NamedTemporaryFile
+from time import time
+
 from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 
 from mock import patch, call, Mock
+from suds.transport import Request, TransportError
 
 from news.backends.common import NewsletterException
 from news.backends import sfmc
@@ -32,6 +37,83 @@ class TestRefreshToken(TestCase):
         self.assertEqual(client.refreshKey, 'refresh-key')
 
 
+def token_response(token, expires_in=3600):
+    return {
+        'accessToken': token,
+        'expiresIn': expires_in,
+        'legacyToken': 'internal-' + token,
+        'refreshToken': 'refresh-' + token,
+    }
+
+
+def cache_tokens(token, expiration):
+    cache.set(sfmc.ETRefreshClient.token_cache_key, {
+        'authToken': token,
+        'authTokenExpiration': expiration,
+        'internalAuthToken': 'internal-' + token,
+        'refreshKey': 'refresh-' + token,
+    })
+
+
+@patch.object(sfmc.ETRefreshClient, 'build_soap_client', Mock())
+@patch.object(sfmc.ETRefreshClient, 'load_wsdl', Mock())
+@patch.object(sfmc.ETRefreshClient, 'request_token')
+class TokenSingleFlightTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get_client(self, request_mock):
+        request_mock.return_value = token_response('first-token')
+        client = sfmc.ETRefreshClient(params={'clientid': 'id', 'clientsecret': 'sssshhhh'})
+        request_mock.reset_mock()
+        return client
+
+    def test_token_shared(self, request_mock):
+        self.get_client(request_mock)
+        other_client = sfmc.ETRefreshClient(params={'clientid': 'id', 'clientsecret': 'ssh'})
+        self.assertFalse(request_mock.called)
+        self.assertEqual(other_client.authToken, 'first-token')
+
+    def test_wait_for_other_process(self, request_mock):
+        client = self.get_client(request_mock)
+        cache.add(sfmc.TOKEN_LOCK_KEY, True)
+
+        def other_process_done(seconds):
+            cache_tokens('new-token', time() + 3600)
+
+        with patch('news.backends.sfmc.sleep', side_effect=other_process_done):
+            client.refresh_token(force_refresh=True)
+
+        self.assertFalse(request_mock.called)
+        self.assertEqual(client.authToken, 'new-token')
+
+    @patch('news.backends.sfmc.TOKEN_WAIT_TIMEOUT', 0)
+    def test_wait_timeout(self, request_mock):
+        client = self.get_client(request_mock)
+        cache.add(sfmc.TOKEN_LOCK_KEY, True)
+        request_mock.return_value = token_response('new-token')
+        client.refresh_token(force_refresh=True)
+        self.assertEqual(client.authToken, 'new-token')
+
+    def test_rejected_token_not_reused(self, request_mock):
+        client = self.get_client(request_mock)
+        request_mock.return_value = token_response('new-token')
+        client.refresh_token(force_refresh=True)
+        self.assertEqual(request_mock.call_args[0][0]['refreshToken'], 'refresh-first-token')
+        self.assertEqual(client.authToken, 'new-token')
+        self.assertIsNone(cache.get(sfmc.TOKEN_LOCK_KEY))
+
+    def test_refresh_token_ahead(self, request_mock):
+        client = self.get_client(request_mock)
+        self.assertFalse(client.refresh_token_ahead(900))
+
+        cache_tokens('other-token', time() + 600)
+        request_mock.return_value = token_response('new-token')
+        self.assertTrue(client.refresh_token_ahead(900))
+        self.assertEqual(request_mock.call_args[0][0]['refreshToken'], 'refresh-other-token')
+        self.assertEqual(cache.get(client.token_cache_key)['authToken'], 'new-token')
+
+
 @patch.object(sfmc.ETRefreshClient, 'load_wsdl', Mock())
 @patch.object(sfmc.ETRefreshClient, 'build_soap_client', Mock())
 @patch.object(sfmc.ETRefreshClient, 'refresh_token', Mock())
@@ -97,12 +179,13 @@ class TestTokenIsExpired(TestCase):
 
 @patch.object(sfmc.ETRefreshClient, 'load_wsdl', Mock())
 @patch.object(sfmc.ETRefreshClient, 'refresh_token', Mock())
-@patch('news.backends.sfmc.requests')
+@patch('news.backends.sfmc.get_vendor_session')
 class TestRequestToken(TestCase):
     def setUp(self):
         cache.clear()
 
-    def test_request_token_success(self, req_mock):
+    def test_request_token_success(self, session_mock):
+        req_mock = session_mock.return_value
         client = sfmc.ETRefreshClient()
         req_mock.post.return_value.json.return_value = {'accessToken': 'good-token'}
         payload = {'refreshToken': 'token'}
@@ -110,10 +193,11 @@ class TestRequestToken(TestCase):
         # called once when first call is successful
         req_mock.post.assert_called_once_with(client.auth_url, json=payload)
 
-    def test_request_token_first_fail(self, req_mock):
+    def test_request_token_first_fail(self, session_mock):
         """
         If first call fails it should try again without refreshToken
         """
+        req_mock = session_mock.return_value
         client = sfmc.ETRefreshClient()
         req_mock.post.return_value.json.side_effect = [{}, {'accessToken': 'good-token'}]
         payload = {'refreshToken': 'token'}
@@ -127,8 +211,9 @@ class TestRequestToken(TestCase):
             call().json(),
         ])
 
-    def test_request_token_both_fail(self, req_mock):
+    def test_request_token_both_fail(self, session_mock):
         """If both calls fail it should raise an exception"""
+        req_mock = session_mock.return_value
         client = sfmc.ETRefreshClient()
         req_mock.post.return_value.json.return_value = {}
         payload = {'refreshToken': 'token'}
@@ -136,3 +221,248 @@ class TestRequestToken(TestCase):
             client.request_token(payload)
 
         self.assertEqual(req_mock.post.call_count, 2)
+
+
+@patch('news.backends.sfmc.suds.client.Client')
+class SOAPClientTests(TestCase):
+    def setUp(self):
+        patcher = patch.dict(sfmc._soap_clients, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_wsdl_parsed_once(self, client_mock):
+        first = sfmc.get_soap_client('https://example.com/etframework.wsdl')
+        second = sfmc.get_soap_client('https://example.com/etframework.wsdl')
+        self.assertEqual(client_mock.call_count, 1)
+        self.assertEqual(first, client_mock.return_value.clone.return_value)
+        self.assertEqual(second, first)
+
+    def test_calls_use_vendor_session(self, client_mock):
+        sfmc.get_soap_client('https://example.com/etframework.wsdl')
+        transport = client_mock.call_args[1]['transport']
+        self.assertIsInstance(transport, sfmc.VendorTransport)
+
+    @override_settings(SFMC_WSDL_CACHE_DIR='/tmp/suds-cache')
+    def test_cache_location_follows_wsdl_version(self, client_mock):
+        wsdl = NamedTemporaryFile()
+        wsdl.write('<definitions/>')
+        wsdl.flush()
+        url = 'file://' + wsdl.name
+        first = sfmc.wsdl_cache_location(url)
+        self.assertTrue(first.startswith('/tmp/suds-cache/'))
+        self.assertEqual(sfmc.wsdl_cache_location(url), first)
+        wsdl.write('<definitions></definitions>')
+        wsdl.flush()
+        self.assertNotEqual(sfmc.wsdl_cache_location(url), first)
+
+    @patch.object(sfmc.ETRefreshClient, 'load_wsdl', Mock(return_value='file:///et.wsdl'))
+    @patch.object(sfmc.ETRefreshClient, 'refresh_token', Mock())
+    def test_token_change_only_swaps_header(self, client_mock):
+        client = sfmc.ETRefreshClient()
+        client.internalAuthToken = 'first-token'
+        client.build_soap_client()
+        client.internalAuthToken = 'second-token'
+        client.build_soap_client()
+        self.assertEqual(client_mock.call_count, 1)
+        soap_client = client_mock.return_value.clone.return_value
+        header = soap_client.set_options.call_args[1]['soapheaders']
+        self.assertEqual(header.getChild('oAuthToken').getText(), 'second-token')
+
+
+@patch('news.backends.sfmc.get_vendor_session')
+class VendorTransportTests(TestCase):
+    def setUp(self):
+        self.transport = sfmc.VendorTransport()
+        self.request = Request('https://example.com/Service.asmx', '<Envelope/>')
+        self.request.headers = {'SOAPAction': 'Create'}
+
+    def test_send(self, session_mock):
+        response = session_mock.return_value.post.return_value
+        response.status_code = 200
+        response.headers = {'Content-Type': 'text/xml'}
+        response.content = '<Envelope>ok</Envelope>'
+        reply = self.transport.send(self.request)
+        session_mock.assert_called_with('sfmc')
+        session_mock.return_value.post.assert_called_with(
+            'https://example.com/Service.asmx', data='<Envelope/>',
+            headers={'SOAPAction': 'Create'})
+        self.assertEqual(reply.code, 200)
+        self.assertEqual(reply.message, '<Envelope>ok</Envelope>')
+
+    def test_fault(self, session_mock):
+        response = session_mock.return_value.post.return_value
+        response.status_code = 500
+        response.reason = 'Internal Server Error'
+        response.content = '<Envelope>fault</Envelope>'
+        with self.assertRaises(TransportError) as cm:
+            self.transport.send(self.request)
+
+        self.assertEqual(cm.exception.httpcode, 500)
+        self.assertEqual(cm.exception.fp.read(), '<Envelope>fault</Envelope>')
+
+
+def row_result(ordinal, status='OK', message=None):
+    return Mock(OrdinalID=ordinal, StatusCode=status, StatusMessage=message)
+
+
+@patch('news.backends.sfmc.ET_DataExtension_Row')
+class RowWriteTests(TestCase):
+    def setUp(self):
+        self.sfmc = sfmc.SFMC()
+        self.sfmc._client = Mock(name='client')
+
+    def test_add_rows(self, row_mock):
+        row = row_mock.return_value
+        row.post.return_value = Mock(status=False, results=[
+            row_result(0),
+            row_result(1, 'Error', 'Violation of PRIMARY KEY constraint'),
+        ])
+        errors = self.sfmc.add_rows('Mobile_Subscribers', [{'Phone': '1'}, {'Phone': '2'}])
+        self.assertEqual(row.props, [{'Phone': '1'}, {'Phone': '2'}])
+        self.assertEqual(row.CustomerKey, 'Mobile_Subscribers')
+        self.assertIsNone(errors[0])
+        self.assertIsInstance(errors[1], NewsletterException)
+        self.assertEqual(str(errors[1]), 'Violation of PRIMARY KEY constraint')
+
+    def test_upsert_rows_in_result_order(self, row_mock):
+        row = row_mock.return_value
+        row.patch.return_value = Mock(status=False, results=[
+            row_result(1, 'Error', 'bad'),
+            row_result(0),
+        ])
+        errors = self.sfmc.upsert_rows('FXA', [{'TOKEN': '1'}, {'TOKEN': '2'}])
+        row.patch.assert_called_with(True)
+        self.assertIsNone(errors[0])
+        self.assertIsNotNone(errors[1])
+
+    def test_request_failure_raises(self, row_mock):
+        row_mock.return_value.post.return_value = Mock(status=False, results=[])
+        with self.assertRaises(NewsletterException):
+            self.sfmc.add_rows('FXA', [{'TOKEN': '1'}])
+
+    @override_settings(SFMC_BATCH_WRITES=True, SFMC_BATCH_WAIT=0)
+    def test_batched_upsert_raises_row_error(self, row_mock):
+        row = row_mock.return_value
+        row.patch.return_value = Mock(status=False, results=[row_result(0, 'Error', 'bad')])
+        with self.assertRaises(NewsletterException):
+            self.sfmc.upsert_row('FXA', {'TOKEN': '1'})
+
+        row.patch.return_value = Mock(status=True, results=[row_result(0)])
+        self.sfmc.upsert_row('FXA', {'TOKEN': '1'})
+        self.assertEqual(row.props, [{'TOKEN': '1'}])
+
+    def test_unbatched_upsert(self, row_mock):
+        row = row_mock.return_value
+        row.patch.return_value = Mock(status=True, results=[row_result(0)])
+        self.sfmc.upsert_row('FXA', {'TOKEN': '1'})
+        self.assertEqual(row.props, {'TOKEN': '1'})
+
+
+def subscriber(email, key):
+    return {'EmailAddress': email, 'SubscriberKey': key}
+
+
+@patch('news.backends.sfmc.ET_TriggeredSend')
+class SendMailTests(TestCase):
+    def setUp(self):
+        self.sfmc = sfmc.SFMC()
+        self.sfmc._client = Mock(name='client')
+
+    def test_all_sent(self, ts_mock):
+        ts_mock.return_value.send.return_value = Mock(status=True, results=[
+            Mock(StatusCode='OK', SubscriberFailures=None),
+        ])
+        subscribers = [subscriber('dude@example.com', 'the-token'),
+                       subscriber('walter@example.com', 'other-token')]
+        errors = self.sfmc._send_mail_batch('the-message', subscribers)
+        self.assertEqual(errors, [None, None])
+        ts = ts_mock.return_value
+        self.assertEqual(ts.props, {'CustomerKey': 'the-message'})
+        self.assertEqual(ts.subscribers, subscribers)
+
+    def test_subscriber_failures(self, ts_mock):
+        failure = Mock(ErrorDescription='Subscriber is unsubscribed',
+                       Subscriber=Mock(SubscriberKey='other-token', EmailAddress=None))
+        ts_mock.return_value.send.return_value = Mock(status=False, results=[
+            Mock(StatusCode='Error', SubscriberFailures=[failure]),
+        ])
+        errors = self.sfmc._send_mail_batch('the-message', [
+            subscriber('dude@example.com', 'the-token'),
+            subscriber('walter@example.com', 'other-token'),
+        ])
+        self.assertIsNone(errors[0])
+        self.assertEqual(str(errors[1]), 'Subscriber is unsubscribed')
+
+    def test_message_failure(self, ts_mock):
+        ts_mock.return_value.send.return_value = Mock(status=False, results=[
+            Mock(StatusCode='Error', StatusMessage='Invalid Customer Key',
+                 SubscriberFailures=None),
+        ])
+        errors = self.sfmc._send_mail_batch('the-message', [
+            subscriber('dude@example.com', 'the-token'),
+            subscriber('walter@example.com', 'other-token'),
+        ])
+        self.assertEqual(len(errors), 2)
+        self.assertIn('Invalid Customer Key', str(errors[1]))
+
+    @override_settings(SFMC_BATCH_SENDS=True, SFMC_BATCH_WAIT=0)
+    def test_batched_send_raises_subscriber_error(self, ts_mock):
+        ts = ts_mock.return_value
+        ts.send.return_value = Mock(status=False, results=[
+            Mock(StatusCode='Error', StatusMessage='Invalid Customer Key',
+                 SubscriberFailures=None),
+        ])
+        with self.assertRaises(NewsletterException):
+            self.sfmc.send_mail('the-message', 'dude@example.com', 'the-token', 'the-token')
+
+        self.assertEqual(ts.subscribers[0]['SubscriberKey'], 'the-token')
+        self.assertIn('Attributes', ts.subscribers[0])
+
+
+def sms_response(status_code, errors=None):
+    return Mock(status_code=status_code, content='', headers={},
+                json=Mock(return_value={'errors': errors or []}))
+
+
+@patch('news.backends.sfmc.get_vendor_session')
+class SendSMSTests(TestCase):
+    def setUp(self):
+        self.sfmc = sfmc.SFMC()
+        self.sfmc._client = Mock(name='client', authToken='the-token')
+
+    def sent_numbers(self, session_mock):
+        post = session_mock.return_value.post
+        return [c[1]['json']['mobileNumbers'] for c in post.call_args_list]
+
+    def test_batch(self, session_mock):
+        session_mock.return_value.post.return_value = sms_response(202)
+        errors = self.sfmc._send_sms_batch('the-message', ['1', '2'])
+        self.assertEqual(errors, [None, None])
+        self.assertEqual(self.sent_numbers(session_mock), [['1', '2']])
+        url = session_mock.return_value.post.call_args[0][0]
+        self.assertTrue(url.endswith('/messageContact/the-message/send'))
+
+    def test_rejected_batch_sent_per_number(self, session_mock):
+        session_mock.return_value.post.side_effect = [
+            sms_response(400, ['bad number']),
+            sms_response(202),
+            sms_response(400, ['bad number']),
+        ]
+        errors = self.sfmc._send_sms_batch('the-message', ['1', '2'])
+        self.assertIsNone(errors[0])
+        self.assertEqual(errors[1].status_code, 400)
+        self.assertEqual(self.sent_numbers(session_mock), [['1', '2'], ['1'], ['2']])
+
+    def test_server_error_fails_all(self, session_mock):
+        session_mock.return_value.post.return_value = sms_response(503)
+        errors = self.sfmc._send_sms_batch('the-message', ['1', '2'])
+        self.assertEqual([e.status_code for e in errors], [503, 503])
+        self.assertEqual(session_mock.return_value.post.call_count, 1)
+
+    @override_settings(SFMC_BATCH_SMS=True, SFMC_BATCH_WAIT=0)
+    def test_batched_send_raises_number_error(self, session_mock):
+        session_mock.return_value.post.return_value = sms_response(400, ['bad number'])
+        with self.assertRaises(NewsletterException):
+            self.sfmc.send_sms(['1'], 'the-message')
+
+        self.assertEqual(self.sent_numbers(session_mock), [['1']])
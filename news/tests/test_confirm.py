@@ -1,9 +1,16 @@
+from time import time
+
+from django.core.cache import cache
 from django.test import TestCase
+from django.test.utils import override_settings
 
+import simple_salesforce as sfapi
 from mock import patch, Mock
 
 from news.backends.common import NewsletterException
-from news.tasks import confirm_user
+from news.models import ContactIdIndex, ContactReplica
+from news.replica import SYNC_STATE_CACHE_KEY
+from news.tasks import BasketError, confirm_user
 
 
 @patch('news.tasks.sfdc')
@@ -52,3 +59,52 @@ class TestConfirmTask(TestCase):
         doi_mock.assert_called_with(token)
         self.assertFalse(sfdc_mock.add.called)
         self.assertFalse(sfdc_mock.update.called)
+
+    @override_settings(SFDC_CONTACT_ID_INDEX=True)
+    def test_indexed_contact(self, get_user_data, sfdc_mock):
+        """A contact with a known Id is confirmed without looking it up"""
+        ContactIdIndex.set_id('1234', 'TOKEN', 'dude@example.com')
+        confirm_user('TOKEN')
+        self.assertFalse(get_user_data.called)
+        sfdc_mock.update.assert_called_with({'id': '1234', 'token': 'TOKEN'}, {'optin': True})
+
+    def test_no_email(self, get_user_data, sfdc_mock):
+        get_user_data.return_value = {'status': 'ok', 'optin': False, 'token': 'TOKEN'}
+        with self.assertRaises(BasketError):
+            confirm_user('TOKEN')
+
+        self.assertFalse(sfdc_mock.update.called)
+
+    @override_settings(SFDC_CONTACT_ID_INDEX=True)
+    def test_indexed_contact_no_email(self, get_user_data, sfdc_mock):
+        ContactIdIndex.set_id('1234', 'TOKEN', None)
+        with self.assertRaises(BasketError):
+            confirm_user('TOKEN')
+
+        self.assertFalse(sfdc_mock.update.called)
+
+    @override_settings(SFDC_CONTACT_ID_INDEX=True, SFDC_REPLICA_READS=True,
+                       SFDC_REPLICA_MAX_AGE=60)
+    def test_indexed_contact_already_confirmed(self, get_user_data, sfdc_mock):
+        ContactIdIndex.set_id('1234', 'TOKEN', 'dude@example.com')
+        ContactReplica.objects.create(sfdc_id='1234', token='TOKEN', email='dude@example.com',
+                                      last_modified='2017-06-01T12:00Z',
+                                      data={'id': '1234', 'token': 'TOKEN', 'optin': True})
+        cache.set(SYNC_STATE_CACHE_KEY, {'synced': time()})
+        self.addCleanup(cache.delete, SYNC_STATE_CACHE_KEY)
+        confirm_user('TOKEN')
+        self.assertFalse(get_user_data.called)
+        self.assertFalse(sfdc_mock.update.called)
+
+    @override_settings(SFDC_CONTACT_ID_INDEX=True)
+    def test_stale_index(self, get_user_data, sfdc_mock):
+        """A contact missing from SFDC is forgotten and looked up as usual"""
+        ContactIdIndex.set_id('1234', 'TOKEN', 'dude@example.com')
+        sfdc_mock.update.side_effect = [
+            sfapi.SalesforceResourceNotFound('url', 404, 'Contact', ''), None]
+        user_data = {'status': 'ok', 'optin': False, 'email': 'dude@example.com',
+                     'token': 'TOKEN'}
+        get_user_data.return_value = user_data
+        confirm_user('TOKEN')
+        sfdc_mock.update.assert_called_with(user_data, {'optin': True})
+        self.assertIsNone(ContactIdIndex.get_id(token='TOKEN'))
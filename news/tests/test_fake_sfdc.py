@@ -0,0 +1,157 @@
+from threading import Thread
+
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+import simple_salesforce as sfapi
+from mock import patch
+
+from news.backends import sfdc
+from news.backends.fake_sfdc import FakeSFDC, FakeSFDCServer
+from news.models import ContactReplica
+from news.replica import SYNC_CURSOR_CACHE_KEY, sync_contact_replica
+
+
+class FakeSFDCTests(TestCase):
+    """Exercise the SFDC backend over HTTP against the fake server"""
+    def setUp(self):
+        cache.clear()
+        self.fake = FakeSFDC()
+        self.server = FakeSFDCServer(('127.0.0.1', 0), self.fake)
+        thread = Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        sfdc_settings = dict(settings.SFDC_SETTINGS, username='dude', password='abides',
+                             login_url=self.server.url)
+        settings_override = override_settings(SFDC_SETTINGS=sfdc_settings)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        patcher = patch.dict(sfdc._local_session, {'info': None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.sfdc = sfdc.SFDC()
+
+    def add_contact(self):
+        self.sfdc.add({
+            'email': 'dude@example.com',
+            'token': 'the-token',
+            'country': 'us',
+        })
+
+    def test_contact_lifecycle(self):
+        self.add_contact()
+        contact = self.sfdc.get(token='the-token')
+        self.assertEqual(contact['email'], 'dude@example.com')
+        self.assertEqual(contact['last_name'], sfdc.LAST_NAME_DEFAULT_VALUE)
+        self.assertTrue(contact['id'].startswith('003'))
+
+        self.sfdc.update(contact, {'first_name': 'The'})
+        self.assertEqual(self.sfdc.get(email='dude@example.com')['first_name'], 'The')
+
+        self.sfdc.delete(contact)
+        with self.assertRaises(sfapi.SalesforceResourceNotFound):
+            self.sfdc.get(token='the-token')
+
+    @override_settings(SFDC_QUERY_LOOKUPS=True)
+    def test_query_lookup(self):
+        self.add_contact()
+        self.assertEqual(self.sfdc.get(email='dude@example.com')['token'], 'the-token')
+        with self.assertRaises(sfapi.SalesforceResourceNotFound):
+            self.sfdc.get(email="walter's@example.com")
+
+    def test_opportunity_create(self):
+        self.add_contact()
+        contact = self.sfdc.get(token='the-token')
+        result = self.sfdc.opportunity.create({'ContactId__c': contact['id'], 'Amount': 10})
+        self.assertTrue(result['id'].startswith('006'))
+
+    def test_collection(self):
+        results = self.sfdc.contact.collection('POST', [
+            {'Email': 'dude@example.com', 'Token__c': 'the-token'},
+            {'Email': 'walter@example.com', 'Token__c': 'the-token'},
+        ])
+        self.assertTrue(results[0]['success'])
+        self.assertFalse(results[1]['success'])
+
+    def test_expired_session_refreshed(self):
+        self.add_contact()
+        session_id = self.sfdc.contact.session_id
+        self.fake.expire_sessions()
+        self.assertEqual(self.sfdc.get(token='the-token')['email'], 'dude@example.com')
+        self.assertNotEqual(self.sfdc.contact.session_id, session_id)
+
+    def test_api_limit(self):
+        self.fake.api_limit = 10
+        self.add_contact()
+        self.assertEqual(sfdc.api_percent_used(), 10)
+        self.fake.api_used = 10
+        with self.assertRaises(sfapi.SalesforceRefusedRequest):
+            self.sfdc.get(token='the-token')
+
+    def test_donation_new_contact(self):
+        self.sfdc.add_donation({'Amount': 10}, None, {
+            'email': 'dude@example.com',
+            'token': 'the-token',
+        })
+        contact = self.sfdc.get(token='the-token')
+        opportunity, = self.fake.records['Opportunity'].values()
+        self.assertEqual(opportunity['Donation_Contact__c'], contact['id'])
+        self.assertEqual(self.fake.api_used, 2)
+
+    def test_donation_existing_contact(self):
+        self.add_contact()
+        contact = self.sfdc.get(token='the-token')
+        self.sfdc.add_donation({'Amount': 10}, contact, {'first_name': 'The'})
+        self.assertEqual(self.sfdc.get(token='the-token')['first_name'], 'The')
+        opportunity, = self.fake.records['Opportunity'].values()
+        self.assertEqual(opportunity['Donation_Contact__c'], contact['id'])
+
+    def test_donation_failure_saves_nothing(self):
+        self.add_contact()
+        with self.assertRaises(sfapi.SalesforceMalformedRequest):
+            # same token as the existing contact
+            self.sfdc.add_donation({'Amount': 10}, None, {
+                'email': 'walter@example.com',
+                'token': 'the-token',
+            })
+
+        self.assertEqual(len(self.fake.records['Contact']), 1)
+        self.assertEqual(len(self.fake.records['Opportunity']), 0)
+
+    def test_replica_sync(self):
+        self.add_contact()
+        self.assertEqual(sync_contact_replica(), 1)
+        copy = ContactReplica.objects.get(token='the-token')
+        self.assertEqual(copy.data['email'], 'dude@example.com')
+
+        # changes since the newest copy, and deletions since the last sync
+        self.sfdc.update(copy.data, {'first_name': 'The'})
+        sync_contact_replica()
+        self.assertEqual(ContactReplica.objects.get().data['first_name'], 'The')
+        self.sfdc.delete(copy.data)
+        sync_contact_replica()
+        self.assertFalse(ContactReplica.objects.exists())
+
+    @patch('news.replica.sfdc')
+    def test_replica_sync_continues_after_cursor(self, sfdc_mock):
+        # the module instance keeps the session of the first test that used it
+        sfdc_mock.query = self.sfdc.query
+        for i in range(3):
+            self.sfdc.add({'email': 'dude{}@example.com'.format(i), 'token': 'token-{}'.format(i)})
+
+        contacts = sorted(self.fake.records['Contact'].values(), key=lambda c: c['Id'])
+        for record in contacts:
+            record['LastModifiedDate'] = '2017-06-01T12:00:00.000+0000'
+
+        # as if a sync stopped after the first of the contacts modified together
+        cache.set(SYNC_CURSOR_CACHE_KEY, {'modified': contacts[0]['LastModifiedDate'],
+                                          'id': contacts[0]['Id']})
+        self.assertEqual(sync_contact_replica(), 2)
+        self.assertEqual(set(ContactReplica.objects.values_list('token', flat=True)),
+                         {'token-1', 'token-2'})
+        self.assertIsNone(cache.get(SYNC_CURSOR_CACHE_KEY))
@@ -104,3 +104,11 @@ class TestNewsletterUtils(TestCase):
         subs = utils.parse_newsletters(utils.UNSUBSCRIBE, ['bowling'],
                                        ['bowling', 'surfing', 'extorting'])
         self.assertDictEqual(subs, {'bowling': False})
+
+    def test_newsletters_version(self):
+        """Version should stay the same until the newsletter data changes"""
+        version = newsletters.newsletters_version()
+        self.assertEqual(newsletters.newsletters_version(), version)
+        self.newsies[0].title = 'Bowling, Dude'
+        self.newsies[0].save()
+        self.assertNotEqual(newsletters.newsletters_version(), version)
@@ -0,0 +1,222 @@
+from time import time
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from mock import Mock, patch
+
+from news import replica
+from news.backends.common import NewsletterException
+from news.backends.sfdc import SFDC
+from news.models import ContactReplica
+from news.tasks import sync_contact_replica
+from news.utils import get_user, get_user_data
+
+
+def contact(contact_id, token, email, modified='2017-06-01T12:00:00.000+0000'):
+    return {
+        'Id': contact_id,
+        'Token__c': token,
+        'Email': email,
+        'LastModifiedDate': modified,
+    }
+
+
+@patch('news.replica.from_vendor', lambda c: {'id': c['Id'], 'token': c['Token__c'],
+                                               'email': c['Email']})
+@patch('news.replica.contact_query_fields', Mock(return_value=['Id', 'Email']))
+@patch('news.replica.sfdc')
+class SyncContactReplicaTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_first_sync_copies_everything(self, sfdc_mock):
+        sfdc_mock.query.return_value = {
+            'done': False,
+            'nextRecordsUrl': '/next',
+            'records': [contact('1', 'the-token', 'Dude@example.com')],
+        }
+        sfdc_mock.query_more.return_value = {
+            'done': True,
+            'records': [contact('2', 'other-token', 'walter@example.com')],
+        }
+        self.assertEqual(replica.sync_contact_replica(), 2)
+        sfdc_mock.query.assert_called_with(
+            'SELECT Id, Email FROM Contact ORDER BY LastModifiedDate, Id')
+        sfdc_mock.query_more.assert_called_with('/next')
+        self.assertFalse(sfdc_mock.deleted.called)
+        copy = ContactReplica.objects.get(sfdc_id='1')
+        self.assertEqual(copy.email, 'dude@example.com')
+        self.assertEqual(copy.data['email'], 'Dude@example.com')
+        self.assertLess(replica.replica_age(), 5)
+
+    def test_next_sync_copies_changes(self, sfdc_mock):
+        sfdc_mock.query.return_value = {
+            'done': True,
+            'records': [contact('1', 'the-token', 'dude@example.com')],
+        }
+        replica.sync_contact_replica()
+        sfdc_mock.query.return_value = {
+            'done': True,
+            'records': [contact('1', 'the-token', 'walter@example.com',
+                                '2017-06-01T12:05:00.000+0000')],
+        }
+        sfdc_mock.deleted.return_value = ['2']
+        ContactReplica.objects.create(sfdc_id='2', token='other-token', email='',
+                                      last_modified='2017-05-01T00:00Z')
+        replica.sync_contact_replica()
+        # looks back a minute before the newest copy
+        sfdc_mock.query.assert_called_with(
+            'SELECT Id, Email FROM Contact WHERE LastModifiedDate >= 2017-06-01T11:59:00Z '
+            'ORDER BY LastModifiedDate, Id')
+        self.assertEqual(ContactReplica.objects.get().email, 'walter@example.com')
+        self.assertTrue(sfdc_mock.deleted.called)
+
+    @patch('news.replica.SAVE_CHUNK_SIZE', 2)
+    def test_saved_in_chunks(self, sfdc_mock):
+        ContactReplica.objects.create(sfdc_id='2', token='other-token', email='',
+                                      last_modified='2017-05-01T00:00Z')
+        sfdc_mock.query.return_value = {
+            'done': True,
+            'records': [contact(str(i), 'token-{}'.format(i), 'dude{}@example.com'.format(i))
+                        for i in range(5)],
+        }
+        self.assertEqual(replica.sync_contact_replica(), 5)
+        self.assertEqual(ContactReplica.objects.count(), 5)
+        self.assertEqual(ContactReplica.objects.get(sfdc_id='2').token, 'token-2')
+
+    def test_incomplete_sync_is_not_fresh(self, sfdc_mock):
+        sfdc_mock.query.return_value = {
+            'done': False,
+            'nextRecordsUrl': '/next',
+            'records': [contact('1', 'the-token', 'dude@example.com')],
+        }
+        self.assertEqual(replica.sync_contact_replica(max_records=1), 1)
+        self.assertFalse(sfdc_mock.query_more.called)
+        self.assertIsNone(replica.replica_age())
+        self.assertEqual(ContactReplica.objects.count(), 1)
+
+    def test_incomplete_sync_continues_after_equal_timestamps(self, sfdc_mock):
+        """A sync stopped in a page of contacts modified together continues after the last Id"""
+        sfdc_mock.query.return_value = {
+            'done': False,
+            'nextRecordsUrl': '/next',
+            'records': [contact(str(i), 'token-{}'.format(i), 'dude{}@example.com'.format(i))
+                        for i in range(3)],
+        }
+        replica.sync_contact_replica(max_records=3)
+        sfdc_mock.query.return_value = {
+            'done': True,
+            'records': [contact('3', 'token-3', 'dude3@example.com')],
+        }
+        self.assertEqual(replica.sync_contact_replica(max_records=3), 1)
+        sfdc_mock.query.assert_called_with(
+            "SELECT Id, Email FROM Contact WHERE LastModifiedDate >= 2017-06-01T12:00:00Z "
+            "AND (LastModifiedDate > 2017-06-01T12:00:00Z OR Id > '2') "
+            "ORDER BY LastModifiedDate, Id")
+        self.assertEqual(ContactReplica.objects.count(), 4)
+        self.assertLess(replica.replica_age(), 5)
+
+        # a complete sync goes back to looking back from the newest copy
+        sfdc_mock.query.return_value = {'done': True, 'records': []}
+        sfdc_mock.deleted.return_value = []
+        replica.sync_contact_replica()
+        sfdc_mock.query.assert_called_with(
+            'SELECT Id, Email FROM Contact WHERE LastModifiedDate >= 2017-06-01T11:59:00Z '
+            'ORDER BY LastModifiedDate, Id')
+
+
+@override_settings(SFDC_REPLICA_READS=True, SFDC_REPLICA_MAX_AGE=60,
+                   SFDC_REPLICA_OUTAGE_MAX_AGE=3600)
+@patch('news.utils.sfdc')
+class ReplicaReadTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        ContactReplica.objects.create(sfdc_id='1', token='the-token', email='dude@example.com',
+                                      last_modified='2017-06-01T12:00Z', data={
+                                          'id': '1',
+                                          'token': 'the-token',
+                                          'email': 'dude@example.com',
+                                      })
+
+    def synced(self, seconds_ago):
+        cache.set(replica.SYNC_STATE_CACHE_KEY, {'synced': time() - seconds_ago})
+
+    def test_fresh_replica(self, sfdc_mock):
+        self.synced(10)
+        user = get_user_data(email='Dude@example.com', use_replica=True)
+        self.assertEqual(user['token'], 'the-token')
+        self.assertEqual(user['status'], 'ok')
+        self.assertFalse(sfdc_mock.get.called)
+
+    def test_stale_replica(self, sfdc_mock):
+        self.synced(120)
+        sfdc_mock.get.return_value = {'token': 'the-token', 'email': 'walter@example.com'}
+        user = get_user_data(token='the-token', use_replica=True)
+        self.assertEqual(user['email'], 'walter@example.com')
+
+    def test_not_in_replica(self, sfdc_mock):
+        self.synced(10)
+        sfdc_mock.get.return_value = {'token': 'new-token'}
+        self.assertEqual(get_user_data(token='new-token', use_replica=True)['token'],
+                         'new-token')
+
+    def test_replica_not_used_by_default(self, sfdc_mock):
+        self.synced(10)
+        sfdc_mock.get.return_value = {'token': 'the-token', 'email': 'walter@example.com'}
+        self.assertEqual(get_user_data(token='the-token')['email'], 'walter@example.com')
+
+    def test_outage_fallback(self, sfdc_mock):
+        self.synced(120)
+        sfdc_mock.get.side_effect = NewsletterException('down')
+        self.assertEqual(get_user_data(token='the-token', use_replica=True)['email'],
+                         'dude@example.com')
+
+        self.synced(7200)
+        with self.assertRaises(NewsletterException):
+            get_user_data(token='the-token', use_replica=True)
+
+    @override_settings(MAINTENANCE_MODE=True, MAINTENANCE_READ_ONLY=False)
+    def test_maintenance_mode(self, sfdc_mock):
+        self.synced(120)
+        self.assertEqual(get_user(token='the-token').status_code, 200)
+        self.assertEqual(get_user(token='new-token').status_code, 400)
+        self.assertFalse(sfdc_mock.get.called)
+
+    def test_basket_writes_remove_copies(self, sfdc_mock):
+        backend = SFDC()
+        backend._contact = Mock(name='Contact')
+        backend.update({'id': '1', 'email': 'dude@example.com'}, {'first_name': 'The'})
+        self.assertFalse(ContactReplica.objects.exists())
+
+    @override_settings(SFDC_REPLICA_READS=False)
+    def test_disabled(self, sfdc_mock):
+        self.synced(10)
+        sfdc_mock.get.side_effect = NewsletterException('down')
+        with self.assertRaises(NewsletterException):
+            get_user_data(token='the-token', use_replica=True)
+
+
+@override_settings(SFDC_REPLICA_SYNC_MAX_RECORDS=100)
+@patch('news.tasks.sync_replica')
+class SyncContactReplicaTaskTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_sync(self, sync_mock):
+        sync_contact_replica()
+        sync_mock.assert_called_with(100)
+        # lock released
+        sync_contact_replica()
+        self.assertEqual(sync_mock.call_count, 2)
+
+    def test_one_at_a_time(self, sync_mock):
+        cache.add('basket-task-sync-contact-replica', True)
+        sync_contact_replica()
+        self.assertFalse(sync_mock.called)
+
+    @override_settings(MAINTENANCE_MODE=True)
+    def test_maintenance_mode(self, sync_mock):
+        sync_contact_replica()
+        self.assertFalse(sync_mock.called)
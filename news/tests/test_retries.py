@@ -0,0 +1,133 @@
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+
+import simple_salesforce as sfapi
+from mock import Mock, patch
+
+from news.backends.common import CircuitOpenException, NewsletterException
+from news.retries import retry_after, RetryBudget, RetryPolicies, RetryPolicy
+from news.tasks import retry_policies, TaskLocked
+
+
+@patch('news.retries.uniform', lambda low, high: high)
+class RetryPolicyTests(TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy('test', base=10, cap=100)
+
+    def test_exponential_with_cap(self):
+        self.assertEqual(self.policy.countdown(0, Exception()), 10)
+        self.assertEqual(self.policy.countdown(3, Exception()), 80)
+        self.assertEqual(self.policy.countdown(4, Exception()), 100)
+
+    def test_full_jitter(self):
+        with patch('news.retries.uniform', return_value=3.7) as uniform_mock:
+            self.assertEqual(self.policy.countdown(2, Exception()), 3)
+
+        uniform_mock.assert_called_with(0, 40)
+
+    def test_retry_after(self):
+        exc = NewsletterException('slow down', status_code=429, retry_after='60')
+        self.assertEqual(self.policy.countdown(0, exc), 60)
+        # never sooner than the policy would
+        exc.retry_after = '5'
+        self.assertEqual(self.policy.countdown(1, exc), 20)
+        # nor later than its longest wait
+        exc.retry_after = '86400'
+        self.assertEqual(self.policy.countdown(0, exc), 100)
+
+
+class RetryAfterTests(TestCase):
+    def test_response_header(self):
+        exc = Exception()
+        exc.response = Mock(headers={'Retry-After': '120'})
+        self.assertEqual(retry_after(exc), 120)
+
+    @patch('news.retries.time', Mock(return_value=1500000000))
+    def test_http_date(self):
+        exc = NewsletterException(retry_after='Fri, 14 Jul 2017 02:41:00 GMT')
+        self.assertEqual(retry_after(exc), 60)
+
+    def test_missing_or_bad(self):
+        self.assertIsNone(retry_after(NewsletterException()))
+        self.assertIsNone(retry_after(NewsletterException(retry_after='soon')))
+
+
+class RetryPoliciesTests(TestCase):
+    def test_policy_order(self):
+        policies = RetryPolicies(RetryPolicy('default', 1, 1))
+        policies.add(RetryPolicy('first', 1, 1), NewsletterException, statuses=[429])
+        policies.add(RetryPolicy('second', 1, 1), statuses=range(500, 600))
+        get_name = lambda exc: policies.get_policy(exc).name  # noqa
+        self.assertEqual(get_name(NewsletterException(status_code=429)), 'first')
+        self.assertEqual(get_name(NewsletterException(status_code=502)), 'second')
+        self.assertEqual(get_name(NewsletterException(status_code=400)), 'default')
+        self.assertEqual(get_name(IOError()), 'default')
+
+    def test_task_policies(self):
+        get_name = lambda exc: retry_policies.get_policy(exc).name  # noqa
+        self.assertEqual(get_name(TaskLocked()), 'locked')
+        self.assertEqual(get_name(CircuitOpenException('sfmc')), 'circuit_open')
+        self.assertEqual(get_name(sfapi.SalesforceRefusedRequest('url', 403, 'Contact', [])),
+                         'api_limit')
+        self.assertEqual(get_name(NewsletterException(status_code=503)), 'throttled')
+        self.assertEqual(get_name(sfapi.SalesforceGeneralError('url', 500, 'Contact', [])),
+                         'server_error')
+        self.assertEqual(get_name(IOError()), 'default')
+
+
+@override_settings(TASK_RETRY_BUDGET=20, TASK_RETRY_BUDGET_WINDOW=600,
+                   TASK_RETRY_BUDGET_MIN=2)
+@patch('news.retries.time')
+class RetryBudgetTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.budget = RetryBudget()
+
+    def test_percent_of_attempts(self, time_mock):
+        time_mock.return_value = 1000
+        for i in range(20):
+            self.budget.record_attempt()
+
+        self.assertEqual(self.budget.allowed(), 4)
+        self.assertEqual([self.budget.spend() for i in range(5)],
+                         [True, True, True, True, False])
+
+    def test_minimum(self, time_mock):
+        time_mock.return_value = 1000
+        self.budget.record_attempt()
+        self.assertTrue(self.budget.spend())
+        self.assertTrue(self.budget.spend())
+        self.assertFalse(self.budget.spend())
+
+    def test_over_budget_not_counted(self, time_mock):
+        """Each spend is counted before it's compared, and taken back if over the budget"""
+        time_mock.return_value = 1000
+        self.budget.record_attempt()
+        self.assertTrue(self.budget.spend())
+        # another worker spent the last of the budget at the same time
+        cache.incr('tasks:retry_budget:retries:10')
+        self.assertFalse(self.budget.spend())
+        self.assertEqual(cache.get('tasks:retry_budget:retries:10'), 2)
+
+    def test_sliding_window(self, time_mock):
+        time_mock.return_value = 1000
+        for i in range(20):
+            self.budget.record_attempt()
+        for i in range(4):
+            self.budget.spend()
+
+        # the counts fall out of the window a bucket at a time
+        time_mock.return_value = 1550
+        self.assertFalse(self.budget.spend())
+        time_mock.return_value = 1700
+        self.assertEqual(self.budget.allowed(), 2)
+        self.assertTrue(self.budget.spend())
+
+    @override_settings(TASK_RETRY_BUDGET=0)
+    def test_disabled(self, time_mock):
+        time_mock.return_value = 1000
+        self.budget.record_attempt()
+        self.assertFalse(cache.get('tasks:retry_budget:attempts:10'))
+        for i in range(5):
+            self.assertTrue(self.budget.spend())
@@ -0,0 +1,94 @@
+import json
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from mock import Mock, patch
+
+from news.routers import AffinityRouter, affinity_queue, queue_names, queue_stats, QueueRouter
+from news.utils import SUBSCRIBE
+
+
+@override_settings(TASK_AFFINITY_QUEUES=8)
+class AffinityRouterTests(TestCase):
+    def setUp(self):
+        self.router = AffinityRouter()
+
+    def route(self, task, *args, **kwargs):
+        return self.router.route_for_task(task, args, kwargs)
+
+    def test_same_key_same_queue(self):
+        route = self.route('news.tasks.upsert_user', SUBSCRIBE, {'email': 'Dude@example.com'})
+        self.assertEqual(route, {'queue': affinity_queue('dude@example.com')})
+        self.assertEqual(self.route('news.tasks.upsert_user', SUBSCRIBE,
+                                    {'email': 'dude@example.com', 'token': 'the-token'},
+                                    start_time=0), route)
+
+    def test_keys_spread_over_queues(self):
+        queues = set(affinity_queue('dude{}@example.com'.format(i)) for i in range(100))
+        self.assertEqual(queues, set('basket-affinity-{}'.format(i) for i in range(8)))
+
+    def test_task_keys(self):
+        self.assertEqual(self.route('news.tasks.confirm_user', 'the-token'),
+                         {'queue': affinity_queue('the-token')})
+        self.assertEqual(self.route('news.tasks.update_custom_unsub', token='the-token',
+                                    reason='bored'),
+                         {'queue': affinity_queue('the-token')})
+        self.assertEqual(self.route('news.tasks.process_donation',
+                                    {'data': {'email': 'dude@example.com'}}),
+                         {'queue': affinity_queue('dude@example.com')})
+
+    def test_other_tasks_not_routed(self):
+        self.assertIsNone(self.route('news.tasks.send_message', 'the-message'))
+        self.assertIsNone(self.route('news.tasks.upsert_user', SUBSCRIBE, {}))
+
+    @override_settings(TASK_AFFINITY_QUEUES=0)
+    def test_disabled(self):
+        self.assertIsNone(self.route('news.tasks.confirm_user', 'the-token'))
+
+
+@override_settings(TASK_QUEUES_ENABLE=True)
+class QueueRouterTests(TestCase):
+    def setUp(self):
+        self.router = QueueRouter()
+
+    def test_priority_and_backend(self):
+        route = self.router.route_for_task
+        self.assertEqual(route('news.tasks.send_message'), {'queue': 'basket-interactive-sfmc'})
+        self.assertEqual(route('news.tasks.confirm_user'), {'queue': 'basket-interactive-sfdc'})
+        self.assertEqual(route('news.tasks.add_fxa_activity'), {'queue': 'basket-bulk-sfmc'})
+        self.assertEqual(route('news.tasks.process_donation'),
+                         {'queue': 'basket-donations-sfdc'})
+        self.assertIsNone(route('news.tasks.snitch'))
+
+    @override_settings(TASK_QUEUES_ENABLE=False)
+    def test_disabled(self):
+        self.assertIsNone(self.router.route_for_task('news.tasks.send_message'))
+
+    @override_settings(TASK_AFFINITY_QUEUES=2)
+    def test_queue_names(self):
+        names = queue_names()
+        self.assertEqual(names[0], 'celery')
+        self.assertIn('basket-bulk-sfdc', names)
+        self.assertEqual(names[-2:], ['basket-affinity-0', 'basket-affinity-1'])
+
+
+@patch('news.routers.time', Mock(return_value=1000))
+class QueueStatsTests(TestCase):
+    def test_redis(self):
+        channel = Mock()
+        channel.client.llen.return_value = 5
+        channel.client.lindex.return_value = json.dumps({'headers': {'basket_sent': 970}})
+        self.assertEqual(queue_stats(channel, 'celery'), (5, 30))
+        channel.client.lindex.assert_called_with('celery', -1)
+
+    def test_empty(self):
+        channel = Mock()
+        channel.client.llen.return_value = 0
+        channel.client.lindex.return_value = None
+        self.assertEqual(queue_stats(channel, 'celery'), (0, None))
+
+    def test_not_redis(self):
+        channel = Mock(spec=['queue_declare'])
+        channel.queue_declare.return_value = Mock(message_count=3)
+        self.assertEqual(queue_stats(channel, 'celery'), (3, None))
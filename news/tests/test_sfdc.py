@@ -1,12 +1,20 @@
+from time import time
+
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.utils import override_settings
 
+import simple_salesforce as sfapi
 from mock import patch, Mock
 
-from news.backends.sfdc import to_vendor, from_vendor
+from news.backends import sfdc
+from news.backends.sfdc import (SFDC, contact_query_fields, from_vendor, from_vendor_many,
+                                get_translator, soql_quote, to_vendor, to_vendor_many)
+from news.models import ContactIdIndex
 
 
-@patch('news.backends.sfdc.is_supported_newsletter_language', Mock(return_value=True))
+@patch('news.backends.sfdc.newsletter_languages', Mock(return_value=['en', 'es']))
+@patch('news.backends.sfdc._translator', None)
 class VendorConversionTests(TestCase):
     @patch('news.backends.sfdc.newsletter_map')
     def test_to_vendor(self, nm_mock):
@@ -125,13 +133,13 @@ class VendorConversionTests(TestCase):
         }
         self.assertDictEqual(to_vendor(data), contact)
 
-    @patch('news.backends.sfdc.newsletter_inv_map')
+    @patch('news.backends.sfdc.newsletter_map')
     def test_from_vendor(self, nm_mock):
         nm_mock.return_value = {
-            'Sub_Bowlin__c': 'bowlin',
-            'Sub_Caucasians__c': 'white-russian-recipes',
-            'Sub_Chillin__c': 'chillin',
-            'Sub_Fightin__c': 'fightin'
+            'bowlin': 'Sub_Bowlin__c',
+            'white-russian-recipes': 'Sub_Caucasians__c',
+            'chillin': 'Sub_Chillin__c',
+            'fightin': 'Sub_Fightin__c',
         }
         data = {
             'id': 'vendor-id',
@@ -226,3 +234,456 @@ class VendorConversionTests(TestCase):
             'Double_Opt_In__c': True,
         }
         self.assertDictEqual(to_vendor(data), contact)
+
+
+@override_settings(SFDC_BATCH_WRITES=True, SFDC_BATCH_WAIT=0)
+@patch('news.backends.sfdc.to_vendor', lambda data: data.copy())
+class BatchedWritesTests(TestCase):
+    def setUp(self):
+        self.sfdc = SFDC()
+        self.sfdc._contact = Mock(name='Contact')
+        self.sfdc._contact.name = 'Contact'
+
+    def test_add_uses_collections(self):
+        self.sfdc.contact.collection.return_value = [{'id': 'new-id', 'success': True}]
+        self.sfdc.add({'email': 'dude@example.com'})
+        self.sfdc.contact.collection.assert_called_with('POST', [{
+            'email': 'dude@example.com',
+            'last_name': '_',
+        }])
+        self.assertFalse(self.sfdc.contact.create.called)
+
+    def test_update_by_id_uses_collections(self):
+        self.sfdc.contact.collection.return_value = [{'id': 'the-id', 'success': True}]
+        self.sfdc.update({'id': 'the-id'}, {'first_name': 'The'})
+        self.sfdc.contact.collection.assert_called_with('PATCH', [{
+            'id': 'the-id',
+            'first_name': 'The',
+        }])
+        self.assertFalse(self.sfdc.contact.update.called)
+
+    def test_update_by_token_not_batched(self):
+        """Collections can't update by external ID"""
+        self.sfdc.update({'token': 'the-token'}, {'first_name': 'The'})
+        self.sfdc.contact.update.assert_called_with('Token__c/the-token', {'first_name': 'The'})
+        self.assertFalse(self.sfdc.contact.collection.called)
+
+    def test_record_failure_raises(self):
+        """Failures should raise the same error as a single request would"""
+        self.sfdc.contact.collection.return_value = [{
+            'success': False,
+            'errors': [{'statusCode': 'DUPLICATES_DETECTED', 'message': 'dupe'}],
+        }]
+        with self.assertRaises(sfapi.SalesforceMalformedRequest):
+            self.sfdc.add({'email': 'dude@example.com'})
+
+
+@override_settings(SFDC_CONTACT_CACHE_TIMEOUT=30)
+@patch('news.backends.sfdc.from_vendor', lambda contact: contact.copy())
+@patch('news.backends.sfdc.to_vendor', lambda data: data.copy())
+class ContactCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.sfdc = SFDC()
+        self.sfdc._contact = Mock(name='Contact')
+        self.sfdc.contact.get_by_custom_id.return_value = {
+            'token': 'the-token',
+            'email': 'dude@example.com',
+        }
+        self.sfdc.contact.create.return_value = {'id': 'the-id'}
+
+    def test_get_cached_by_token_and_email(self):
+        self.sfdc.get(token='the-token')
+        self.assertEqual(self.sfdc.contact.get_by_custom_id.call_count, 1)
+        self.assertEqual(self.sfdc.get(token='the-token')['email'], 'dude@example.com')
+        self.assertEqual(self.sfdc.get(email='Dude@example.com')['token'], 'the-token')
+        self.assertEqual(self.sfdc.contact.get_by_custom_id.call_count, 1)
+
+    def test_uncached_read(self):
+        self.sfdc.get(token='the-token')
+        self.sfdc.contact.get_by_custom_id.return_value = {
+            'token': 'the-token',
+            'email': 'walter@example.com',
+        }
+        self.assertEqual(self.sfdc.get(token='the-token', use_cache=False)['email'],
+                         'walter@example.com')
+        self.assertEqual(self.sfdc.contact.get_by_custom_id.call_count, 2)
+
+    @override_settings(SFDC_CONTACT_CACHE_TIMEOUT=0)
+    def test_cache_disabled(self):
+        self.sfdc.get(token='the-token')
+        self.sfdc.get(token='the-token')
+        self.assertEqual(self.sfdc.contact.get_by_custom_id.call_count, 2)
+
+    def test_update_invalidates(self):
+        record = self.sfdc.get(token='the-token')
+        self.sfdc.update(record, {'email': 'walter@example.com'})
+        self.sfdc.get(email='dude@example.com')
+        self.assertEqual(self.sfdc.contact.get_by_custom_id.call_count, 2)
+
+    def test_failed_update_invalidates(self):
+        record = self.sfdc.get(token='the-token')
+        self.sfdc.contact.update.side_effect = sfapi.SalesforceGeneralError('url', 500, 'Contact', '')
+        with self.assertRaises(sfapi.SalesforceGeneralError):
+            self.sfdc.update(record, {'first_name': 'The'})
+
+        self.sfdc.get(token='the-token')
+        self.assertEqual(self.sfdc.contact.get_by_custom_id.call_count, 2)
+
+    def test_add_and_delete_invalidate(self):
+        self.sfdc.get(email='dude@example.com')
+        self.sfdc.add({'email': 'dude@example.com'})
+        self.sfdc.get(email='dude@example.com')
+        self.assertEqual(self.sfdc.contact.get_by_custom_id.call_count, 2)
+        self.sfdc.delete({'id': 'the-id', 'token': 'the-token'})
+        self.sfdc.get(token='the-token')
+        self.assertEqual(self.sfdc.contact.get_by_custom_id.call_count, 3)
+
+
+@override_settings(SFDC_CONTACT_CACHE_TIMEOUT=0, SFDC_CONTACT_ID_INDEX=True)
+@patch('news.backends.sfdc.from_vendor', lambda contact: contact.copy())
+@patch('news.backends.sfdc.to_vendor', lambda data: data.copy())
+class ContactIdIndexTests(TestCase):
+    def setUp(self):
+        self.sfdc = SFDC()
+        self.sfdc._contact = Mock(name='Contact')
+        self.sfdc.contact.get_by_custom_id.return_value = {
+            'id': 'the-id',
+            'token': 'the-token',
+            'email': 'Dude@example.com',
+        }
+
+    def test_get_does_not_index(self):
+        """Lookups for the web views don't write to the index"""
+        self.sfdc.get(token='the-token')
+        self.assertFalse(ContactIdIndex.objects.exists())
+
+    def test_index_fetched_contact(self):
+        sfdc.index_fetched_contact(self.sfdc.get(token='the-token'))
+        self.assertEqual(ContactIdIndex.get_id(token='the-token'), 'the-id')
+        self.assertEqual(ContactIdIndex.get_id(email='dude@example.com'), 'the-id')
+
+    def test_changed_email_replaced(self):
+        ContactIdIndex.set_id('the-id', 'the-token', 'walter@example.com')
+        ContactIdIndex.set_id('old-id', 'old-token', 'dude@example.com')
+        sfdc.index_fetched_contact(self.sfdc.get(email='dude@example.com'), by_email=True)
+        self.assertIsNone(ContactIdIndex.get_id(email='walter@example.com'))
+        self.assertIsNone(ContactIdIndex.get_id(token='old-token'))
+        self.assertEqual(ContactIdIndex.get_id(email='dude@example.com'), 'the-id')
+
+    def test_add_indexes(self):
+        self.sfdc.contact.create.return_value = {'id': 'new-id'}
+        self.sfdc.add({'token': 'new-token', 'email': 'walter@example.com'})
+        self.assertEqual(ContactIdIndex.get_id(token='new-token'), 'new-id')
+
+    def test_update_by_indexed_id(self):
+        ContactIdIndex.set_id('the-id', 'the-token', 'dude@example.com')
+        self.sfdc.update({'token': 'the-token'}, {'email': 'walter@example.com'})
+        self.sfdc.contact.update.assert_called_with('the-id', {
+            'email': 'walter@example.com',
+        })
+        self.assertEqual(ContactIdIndex.get_id(email='walter@example.com'), 'the-id')
+
+    def test_update_without_index(self):
+        self.sfdc.update({'token': 'the-token'}, {'first_name': 'The'})
+        self.sfdc.contact.update.assert_called_with('Token__c/the-token', {'first_name': 'The'})
+
+    def test_stale_index_falls_back_to_external_id(self):
+        ContactIdIndex.set_id('the-id', 'the-token', 'dude@example.com')
+        self.sfdc.contact.update.side_effect = [
+            sfapi.SalesforceResourceNotFound('url', 404, 'Contact', ''), None]
+        self.sfdc.update({'token': 'the-token'}, {'first_name': 'The'})
+        self.sfdc.contact.update.assert_called_with('Token__c/the-token', {'first_name': 'The'})
+        self.assertIsNone(ContactIdIndex.get_id(token='the-token'))
+
+    def test_deleted_contact_falls_back_to_external_id(self):
+        ContactIdIndex.set_id('the-id', 'the-token', 'dude@example.com')
+        self.sfdc.contact.update.side_effect = [
+            sfapi.SalesforceMalformedRequest('url', 400, 'Contact', [{
+                'errorCode': 'ENTITY_IS_DELETED',
+                'message': 'entity is deleted',
+            }]), None]
+        self.sfdc.update({'token': 'the-token'}, {'first_name': 'The'})
+        self.sfdc.contact.update.assert_called_with('Token__c/the-token', {'first_name': 'The'})
+        self.assertIsNone(ContactIdIndex.get_id(token='the-token'))
+
+    def test_other_errors_not_stale_index(self):
+        ContactIdIndex.set_id('the-id', 'the-token', 'dude@example.com')
+        self.sfdc.contact.update.side_effect = sfapi.SalesforceMalformedRequest(
+            'url', 400, 'Contact', [{
+                'errorCode': 'FIELD_CUSTOM_VALIDATION_EXCEPTION',
+                'message': 'nope',
+            }])
+        with self.assertRaises(sfapi.SalesforceMalformedRequest):
+            self.sfdc.update({'token': 'the-token'}, {'first_name': 'The'})
+
+        self.assertEqual(self.sfdc.contact.update.call_count, 1)
+        self.assertEqual(ContactIdIndex.get_id(token='the-token'), 'the-id')
+
+    def test_delete_unindexes(self):
+        ContactIdIndex.set_id('the-id', 'the-token', 'dude@example.com')
+        self.sfdc.delete({'id': 'the-id', 'token': 'the-token'})
+        self.assertIsNone(ContactIdIndex.get_id(token='the-token'))
+
+    @override_settings(READ_ONLY_MODE=True)
+    def test_read_only_mode(self):
+        sfdc.index_fetched_contact(self.sfdc.get(token='the-token'))
+        self.assertFalse(ContactIdIndex.objects.exists())
+
+    @override_settings(SFDC_CONTACT_ID_INDEX=False)
+    def test_disabled(self):
+        ContactIdIndex.set_id('the-id', 'the-token', 'dude@example.com')
+        self.sfdc.update({'token': 'the-token'}, {'first_name': 'The'})
+        self.sfdc.contact.update.assert_called_with('Token__c/the-token', {'first_name': 'The'})
+
+
+@patch('news.backends.sfdc.newsletter_languages', Mock(return_value=['en']))
+@patch('news.backends.sfdc.newsletter_map', Mock(return_value={'bowlin': 'Sub_Bowlin__c'}))
+@patch('news.backends.sfdc.newsletters_version')
+class TranslatorTests(TestCase):
+    def setUp(self):
+        patcher = patch('news.backends.sfdc._translator', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_rebuilt_only_on_version_change(self, version_mock):
+        version_mock.return_value = 'v1'
+        translator = get_translator()
+        self.assertIs(get_translator(), translator)
+        version_mock.return_value = 'v2'
+        self.assertIsNot(get_translator(), translator)
+
+    def test_many(self, version_mock):
+        version_mock.return_value = 'v1'
+        contacts = to_vendor_many([
+            {'email': 'dude@example.com', 'newsletters': ['bowlin']},
+            {'email': 'walter@example.com', 'lang': 'he'},
+        ])
+        self.assertEqual(contacts, [
+            {'Email': 'dude@example.com', 'Sub_Bowlin__c': True, 'Subscriber__c': True},
+            {'Email': 'walter@example.com', 'Email_Language__c': 'en', 'Subscriber__c': True},
+        ])
+        self.assertEqual(from_vendor_many(contacts), [
+            {'email': 'dude@example.com', 'newsletters': ['bowlin']},
+            {'email': 'walter@example.com', 'lang': 'en', 'newsletters': []},
+        ])
+
+
+@patch('news.backends.sfdc.newsletter_languages', Mock(return_value=['en']))
+@patch('news.backends.sfdc.newsletter_map', Mock(return_value={'bowlin': 'Sub_Bowlin__c',
+                                                               'chillin': 'Sub_Chillin__c'}))
+@patch('news.backends.sfdc._translator', None)
+class DiffUpdateTests(TestCase):
+    record = {
+        'id': 'the-id',
+        'token': 'the-token',
+        'email': 'dude@example.com',
+        'lang': 'en',
+        'format': 'H',
+        'country': 'us',
+        'optin': True,
+        'newsletters': ['bowlin'],
+    }
+
+    def setUp(self):
+        self.sfdc = SFDC()
+        self.sfdc._contact = Mock(name='Contact')
+
+    @patch('news.backends.sfdc.statsd')
+    def test_no_changes_skipped(self, statsd_mock):
+        self.sfdc.update(self.record, {
+            'email': 'dude@example.com',
+            'lang': 'en-US',
+            'format': 'H',
+            'country': 'US',
+            'optin': True,
+            'newsletters': {'bowlin': True, 'chillin': False},
+        }, diff=True)
+        self.assertFalse(self.sfdc.contact.update.called)
+        statsd_mock.incr.assert_any_call('news.backends.sfdc.update_skipped')
+
+    def test_only_changes_sent(self):
+        self.sfdc.update(self.record, {
+            'email': 'dude@example.com',
+            'format': 'T',
+            'newsletters': {'bowlin': True, 'chillin': True},
+        }, diff=True)
+        self.sfdc.contact.update.assert_called_with('the-id', {
+            'Email_Format__c': 'T',
+            'Sub_Chillin__c': True,
+        })
+
+    def test_subscriber_flag_set_for_non_subscribers(self):
+        record = dict(self.record, newsletters=[])
+        self.sfdc.update(record, {'newsletters': {'bowlin': True}}, diff=True)
+        self.sfdc.contact.update.assert_called_with('the-id', {
+            'Sub_Bowlin__c': True,
+            'Subscriber__c': True,
+        })
+
+    def test_record_with_null_fields(self):
+        """Empty fields of real SFDC records are None"""
+        record = from_vendor({
+            'Id': 'the-id',
+            'Token__c': 'the-token',
+            'Email': 'dude@example.com',
+            'FirstName': None,
+            'LastName': '_',
+            'Email_Format__c': None,
+            'MailingCountryCode': None,
+            'Email_Language__c': None,
+            'Signup_Source_URL__c': None,
+            'Unsubscribe_Reason__c': None,
+            'MailingCity': None,
+            'Sub_Bowlin__c': True,
+            'Sub_Chillin__c': False,
+        })
+        self.sfdc.update(record, {
+            'first_name': 'The',
+            'source_url': 'https://example.com/',
+            'newsletters': {'bowlin': True},
+        }, diff=True)
+        self.sfdc.contact.update.assert_called_with('the-id', {
+            'FirstName': 'The',
+            'Signup_Source_URL__c': 'https://example.com/',
+        })
+
+    def test_full_update_without_diff(self):
+        self.sfdc.update(self.record, {'format': 'H'})
+        self.sfdc.contact.update.assert_called_with('the-id', {
+            'Email_Format__c': 'H',
+            'Subscriber__c': True,
+        })
+
+
+class SOQLTests(TestCase):
+    def test_soql_quote(self):
+        self.assertEqual(soql_quote(u"dude's@example.com"), u"'dude\\'s@example.com'")
+        self.assertEqual(soql_quote(u'back\\slash'), u"'back\\\\slash'")
+
+    @patch('news.backends.sfdc._translator', None)
+    @patch('news.backends.sfdc.newsletter_map')
+    @patch('news.backends.sfdc.newsletters_version')
+    def test_query_fields_per_version(self, version_mock, nm_mock):
+        version_mock.return_value = 'v1'
+        nm_mock.return_value = {'bowlin': 'Sub_Bowlin__c'}
+        fields = contact_query_fields()
+        self.assertIn('Sub_Bowlin__c', fields)
+        self.assertIn('Token__c', fields)
+        nm_mock.return_value = {'chillin': 'Sub_Chillin__c'}
+        self.assertEqual(contact_query_fields(), fields)
+        version_mock.return_value = 'v2'
+        fields = contact_query_fields()
+        self.assertIn('Sub_Chillin__c', fields)
+        self.assertNotIn('Sub_Bowlin__c', fields)
+
+
+@override_settings(SFDC_QUERY_LOOKUPS=True, SFDC_CONTACT_CACHE_TIMEOUT=0)
+@patch('news.backends.sfdc.contact_query_fields', Mock(return_value=['Email', 'Token__c']))
+@patch('news.backends.sfdc.from_vendor', lambda contact: contact.copy())
+class QueryLookupTests(TestCase):
+    def setUp(self):
+        self.sfdc = SFDC()
+        self.sfdc._contact = Mock(name='Contact')
+
+    def test_get_queries_fields(self):
+        self.sfdc.contact.query.return_value = {'records': [{'Token__c': 'the-token'}]}
+        self.assertEqual(self.sfdc.get(email='dude@example.com'), {'Token__c': 'the-token'})
+        self.sfdc.contact.query.assert_called_with(
+            u"SELECT Email, Token__c FROM Contact WHERE Email = 'dude@example.com' LIMIT 2")
+        self.assertFalse(self.sfdc.contact.get_by_custom_id.called)
+
+    def test_get_not_found(self):
+        self.sfdc.contact.query.return_value = {'records': []}
+        with self.assertRaises(sfapi.SalesforceResourceNotFound):
+            self.sfdc.get(token='the-token')
+
+    def test_get_duplicates(self):
+        self.sfdc.contact.query.return_value = {'records': [{}, {}]}
+        with self.assertRaises(sfapi.SalesforceMoreThanOneRecord):
+            self.sfdc.get(email='dude@example.com')
+
+
+@override_settings(SFDC_API_LIMIT_LOW_PRIORITY_PERCENT=80,
+                   SFDC_API_LIMIT_NORMAL_PRIORITY_PERCENT=95)
+class APILimitTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def set_usage(self, used):
+        cache.set(sfdc.API_USAGE_CACHE_KEY, {'used': used, 'limit': 1000})
+
+    def test_unknown_usage_allowed(self):
+        self.assertTrue(sfdc.api_call_allowed(sfdc.PRIORITY_LOW))
+
+    def test_thresholds(self):
+        self.set_usage(500)
+        self.assertTrue(sfdc.api_call_allowed(sfdc.PRIORITY_LOW))
+        self.set_usage(850)
+        self.assertFalse(sfdc.api_call_allowed(sfdc.PRIORITY_LOW))
+        self.assertTrue(sfdc.api_call_allowed(sfdc.PRIORITY_NORMAL))
+        self.set_usage(990)
+        self.assertFalse(sfdc.api_call_allowed(sfdc.PRIORITY_NORMAL))
+        self.assertTrue(sfdc.api_call_allowed(sfdc.PRIORITY_INTERACTIVE))
+
+
+@patch('news.backends.sfdc.sleep', Mock())
+@patch('news.backends.sfdc.sf_login')
+class SessionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        patcher = patch.dict(sfdc._local_session, {'info': None})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def session(self, session_id, expires_in=3600):
+        return {
+            'id': session_id,
+            'instance': 'na1.salesforce.com',
+            'expires': time() + expires_in,
+        }
+
+    def test_local_session_used(self, login_mock):
+        """Should not check the cache while the process has a good session"""
+        sfdc._local_session['info'] = self.session('local')
+        cache.set(sfdc.SFDC_SESSION_CACHE_KEY, self.session('shared'))
+        self.assertEqual(sfdc.get_sf_session()['id'], 'local')
+        self.assertFalse(login_mock.called)
+
+    def test_shared_session_used(self, login_mock):
+        cache.set(sfdc.SFDC_SESSION_CACHE_KEY, self.session('shared'))
+        self.assertEqual(sfdc.get_sf_session()['id'], 'shared')
+        self.assertEqual(sfdc._local_session['info']['id'], 'shared')
+        self.assertFalse(login_mock.called)
+
+    def test_stale_session_logs_in(self, login_mock):
+        login_mock.return_value = self.session('new')
+        cache.set(sfdc.SFDC_SESSION_CACHE_KEY, self.session('shared'))
+        self.assertEqual(sfdc.get_sf_session(stale_id='shared')['id'], 'new')
+        login_mock.assert_called_once_with()
+        # lock is released
+        self.assertIsNone(cache.get(sfdc.SFDC_SESSION_LOCK_KEY))
+
+    def test_expiring_session_logs_in(self, login_mock):
+        login_mock.return_value = self.session('new')
+        sfdc._local_session['info'] = self.session('old', expires_in=60)
+        self.assertEqual(sfdc.get_sf_session()['id'], 'new')
+
+    def test_waits_for_other_login(self, login_mock):
+        """Should use the session from the process holding the lock"""
+        cache.add(sfdc.SFDC_SESSION_LOCK_KEY, True)
+        new_session = self.session('new')
+        with patch('news.backends.sfdc.cache') as cache_mock:
+            cache_mock.add.return_value = False
+            cache_mock.get.side_effect = [None, None, new_session]
+            self.assertEqual(sfdc.get_sf_session()['id'], 'new')
+
+        self.assertFalse(login_mock.called)
+
+    @patch('news.backends.sfdc.SESSION_WAIT_TIMEOUT', 0)
+    def test_logs_in_after_waiting(self, login_mock):
+        """Should log in if the lock holder never shares a session"""
+        login_mock.return_value = self.session('new')
+        cache.add(sfdc.SFDC_SESSION_LOCK_KEY, True)
+        self.assertEqual(sfdc.get_sf_session()['id'], 'new')
+        login_mock.assert_called_once_with()
@@ -1,23 +1,31 @@
 from copy import deepcopy
+from datetime import timedelta
 from urllib2 import URLError
 
 from django.core.cache import cache
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils.timezone import now
 
+import simple_salesforce as sfapi
+from celery.exceptions import Retry
 from mock import ANY, Mock, patch
 
+from news.backends.sfdc import PRIORITY_LOW
 from news.celery import app as celery_app
-from news.models import FailedTask
+from news.models import ContactIdIndex, DelayedTask, FailedTask
 from news.newsletters import clear_sms_cache
+from news.routers import affinity_queue
 from news.tasks import (
     add_fxa_activity,
     add_sms_user,
+    check_api_limit,
     et_task,
     mogrify_message_id,
     NewsletterException,
     process_donation,
     RECOVERY_MESSAGE_ID,
+    release_delayed_tasks,
     send_recovery_message_task,
     send_message,
     get_lock,
@@ -25,7 +33,7 @@ from news.tasks import (
 )
 
 
-@override_settings(TASK_LOCKING_ENABLE=False)
+@override_settings(TASK_LOCKING_ENABLE=False, SFDC_CONTACT_ID_INDEX=True)
 @patch('news.tasks.get_user_data')
 @patch('news.tasks.sfdc')
 class ProcessDonationTests(TestCase):
@@ -56,7 +64,7 @@ class ProcessDonationTests(TestCase):
         del data['data']['first_name']
         data['data']['last_name'] = 'Donnie'
         process_donation(data)
-        sfdc_mock.update.assert_called_with(gud_mock(), {
+        sfdc_mock.add_donation.assert_called_with(ANY, gud_mock(), {
             '_set_subscriber': False,
             'last_name': 'Donnie',
         })
@@ -66,10 +74,11 @@ class ProcessDonationTests(TestCase):
         gud_mock.return_value = None
         del data['data']['first_name']
         data['data']['last_name'] = 'Theodore Donald Kerabatsos'
-        with self.assertRaises(RetryTask):
-            # raises retry b/c the 2nd call to get_user_data returns None
-            process_donation(data)
-        sfdc_mock.add.assert_called_with({
+        process_donation(data)
+        # a single call to get_user_data; the contact is created with the donation
+        gud_mock.assert_called_once_with(email='dude@example.com', extra_fields=['id'],
+                                         use_cache=False)
+        sfdc_mock.add_donation.assert_called_with(ANY, None, {
             '_set_subscriber': False,
             'token': ANY,
             'record_type': ANY,
@@ -86,7 +95,7 @@ class ProcessDonationTests(TestCase):
             'last_name': '_',
         }
         process_donation(data)
-        sfdc_mock.update.assert_called_with(gud_mock(), {
+        sfdc_mock.add_donation.assert_called_with(ANY, gud_mock(), {
             '_set_subscriber': False,
             'first_name': 'Jeffery',
             'last_name': 'Lebowski',
@@ -100,7 +109,27 @@ class ProcessDonationTests(TestCase):
             'last_name': 'Lebowski',
         }
         process_donation(data)
-        sfdc_mock.update.assert_not_called()
+        sfdc_mock.add_donation.assert_called_with(ANY, gud_mock(), None)
+
+    @patch('news.tasks.update_contact_low_priority')
+    @patch('news.tasks.api_call_allowed')
+    def test_name_update_deferred_near_api_limit(self, allowed_mock, update_mock, sfdc_mock,
+                                                 gud_mock):
+        """Name changes should wait while low priority work is throttled"""
+        allowed_mock.side_effect = lambda priority: priority != PRIORITY_LOW
+        data = deepcopy(self.donate_data)
+        gud_mock.return_value = {
+            'id': '1234',
+            'first_name': '',
+            'last_name': '_',
+        }
+        process_donation(data)
+        sfdc_mock.add_donation.assert_called_with(ANY, gud_mock(), None)
+        update_mock.delay.assert_called_with({'id': '1234'}, {
+            '_set_subscriber': False,
+            'first_name': 'Jeffery',
+            'last_name': 'Lebowski',
+        })
 
     def test_donation_data(self, sfdc_mock, gud_mock):
         data = deepcopy(self.donate_data)
@@ -110,10 +139,9 @@ class ProcessDonationTests(TestCase):
             'last_name': 'Lebowski',
         }
         process_donation(data)
-        sfdc_mock.opportunity.create.assert_called_with({
+        sfdc_mock.add_donation.assert_called_with({
             'RecordTypeId': ANY,
             'Name': 'Foundation Donation',
-            'Donation_Contact__c': '1234',
             'StageName': 'Closed Won',
             'CloseDate': data['timestamp'],
             'Amount': float(data['data']['donation_amount']),
@@ -123,8 +151,81 @@ class ProcessDonationTests(TestCase):
             'Payment_Type__c': 'Recurring',
             'SourceURL__c': data['data']['source_url'],
             'Project__c': data['data']['project'],
+        }, gud_mock(), None)
+
+    def test_indexed_contact_not_looked_up(self, sfdc_mock, gud_mock):
+        ContactIdIndex.set_id('1234', 'the-token', 'dude@example.com')
+        process_donation(deepcopy(self.donate_data))
+        self.assertFalse(gud_mock.called)
+        sfdc_mock.add_donation.assert_called_with(ANY, {
+            'id': '1234',
+            'email': 'dude@example.com',
+        }, {
+            '_set_subscriber': False,
+            'first_name': 'Jeffery',
+            'last_name': 'Lebowski',
+        })
+
+    @patch('news.tasks.update_contact_low_priority')
+    @patch('news.tasks.api_call_allowed', lambda priority: priority != PRIORITY_LOW)
+    def test_indexed_contact_near_api_limit(self, update_mock, sfdc_mock, gud_mock):
+        """Near the API limit the donation is still saved in one call, and the names later"""
+        ContactIdIndex.set_id('1234', 'the-token', 'dude@example.com')
+        process_donation(deepcopy(self.donate_data))
+        self.assertFalse(gud_mock.called)
+        sfdc_mock.add_donation.assert_called_with(ANY, {
+            'id': '1234',
+            'email': 'dude@example.com',
+        }, None)
+        update_mock.delay.assert_called_with({'id': '1234'}, {
+            '_set_subscriber': False,
+            'first_name': 'Jeffery',
+            'last_name': 'Lebowski',
         })
 
+    def test_stale_index_looks_contact_up(self, sfdc_mock, gud_mock):
+        ContactIdIndex.set_id('1234', 'the-token', 'dude@example.com')
+        sfdc_mock.add_donation.side_effect = [
+            sfapi.SalesforceMalformedRequest('url', 400, 'newDonation', [{
+                'errorCode': 'ENTITY_IS_DELETED',
+                'message': 'entity is deleted',
+            }]), None]
+        gud_mock.return_value = {
+            'id': '5678',
+            'first_name': 'Jeffery',
+            'last_name': 'Lebowski',
+        }
+        process_donation(deepcopy(self.donate_data))
+        sfdc_mock.add_donation.assert_called_with(ANY, gud_mock(), None)
+        self.assertIsNone(ContactIdIndex.get_id(email='dude@example.com'))
+
+    def test_other_errors_not_stale_index(self, sfdc_mock, gud_mock):
+        """A donation that fails for another reason isn't tried again with a lookup"""
+        ContactIdIndex.set_id('1234', 'the-token', 'dude@example.com')
+        sfdc_mock.add_donation.side_effect = sfapi.SalesforceMalformedRequest(
+            'url', 400, 'newDonation', [{
+                'errorCode': 'DUPLICATE_VALUE',
+                'message': 'duplicate value found: PMT_Transaction_ID__c',
+            }])
+        with self.assertRaises(sfapi.SalesforceMalformedRequest):
+            process_donation(deepcopy(self.donate_data))
+
+        self.assertEqual(sfdc_mock.add_donation.call_count, 1)
+        self.assertFalse(gud_mock.called)
+        self.assertEqual(ContactIdIndex.get_id(email='dude@example.com'), '1234')
+
+
+class CheckAPILimitTests(TestCase):
+    @patch('news.tasks.api_call_allowed')
+    def test_check_api_limit(self, allowed_mock):
+        allowed_mock.return_value = True
+        check_api_limit(PRIORITY_LOW)
+        allowed_mock.return_value = False
+        with self.assertRaises(RetryTask):
+            check_api_limit(PRIORITY_LOW)
+
+        allowed_mock.assert_called_with(PRIORITY_LOW)
+
 
 @override_settings(TASK_LOCKING_ENABLE=True)
 class TaskDuplicationLockingTests(TestCase):
@@ -153,6 +254,18 @@ class TaskDuplicationLockingTests(TestCase):
         key = cache_mock.add.call_args[0][0]
         self.assertNotIn(email, key)
 
+    @override_settings(TASK_AFFINITY_QUEUES=4)
+    def test_affinity_queue_needs_no_lock(self):
+        queue = affinity_queue('dude@example.com')
+        with patch('news.tasks.current_queue', return_value=queue):
+            get_lock('dude@example.com')
+            get_lock('dude@example.com')
+
+        with patch('news.tasks.current_queue', return_value=None):
+            get_lock('dude@example.com')
+            with self.assertRaises(RetryTask):
+                get_lock('dude@example.com')
+
 
 class FailedTaskTest(TestCase):
     """Test that failed tasks are logged in our FailedTask table"""
@@ -295,9 +408,10 @@ class AddSMSUserTests(TestCase):
 
 
 class ETTaskTests(TestCase):
+    @patch('news.retries.uniform', lambda low, high: high)
     def test_retry_increase(self):
         """
-        The delay for retrying a task should increase geometrically by a
+        The longest delay for retrying a task should increase geometrically by a
         power of 2. I really hope I said that correctly.
         """
         error = URLError(reason=Exception('foo bar!'))
@@ -314,6 +428,136 @@ class ETTaskTests(TestCase):
 
         myfunc.retry.assert_called_with(countdown=32 * 60)
 
+    @override_settings(TASK_RETRY_BUDGET=10, TASK_RETRY_BUDGET_MIN=0,
+                       TASK_RETRY_BUDGET_DELAY=3600)
+    @patch('news.tasks.sentry_client')
+    def test_retry_over_budget(self, sentry_mock):
+        """Retries over the budget should wait longer and not be reported"""
+        cache.clear()
+        error = URLError(reason=Exception('foo bar!'))
+
+        @et_task
+        def myfunc():
+            raise error
+
+        myfunc.push_request(retries=1)
+        myfunc.retry = Mock(side_effect=Exception)
+        with patch('news.retries.uniform', lambda low, high: low):
+            with self.assertRaises(Exception):
+                myfunc.run()
+
+        myfunc.retry.assert_called_with(countdown=3600)
+        self.assertFalse(sentry_mock.captureException.called)
+
+    @override_settings(TASK_RETRY_BUDGET=10)
+    @patch('news.tasks.retry_budget')
+    def test_final_attempt_not_budgeted(self, budget_mock):
+        """A task that won't be retried again shouldn't use up the retry budget"""
+        error = URLError(reason=Exception('foo bar!'))
+
+        @et_task
+        def final_task():
+            raise error
+
+        final_task.push_request(retries=8)
+        with self.assertRaises(URLError):
+            final_task.run()
+
+        self.assertFalse(budget_mock.spend.called)
+
+    @patch('news.tasks.api_call_allowed', Mock(return_value=False))
+    def test_api_limit_deferral_not_counted(self):
+        """Waiting for room under the API limit doesn't use up the task's retries"""
+        @et_task
+        def low_priority_task():
+            check_api_limit(PRIORITY_LOW)
+
+        low_priority_task.push_request(id='the-task-id', retries=8, args=[], kwargs={},
+                                       called_directly=False)
+        low_priority_task.retry = Mock(side_effect=Exception('should be deferred'))
+        with patch.object(low_priority_task, 'subtask_from_request') as subtask_mock:
+            with self.assertRaises(Retry):
+                low_priority_task.run()
+
+        subtask_mock.assert_called_with(ANY, kwargs={'deferred': True}, countdown=ANY,
+                                        retries=8)
+        self.assertTrue(subtask_mock.return_value.apply_async.called)
+        self.assertFalse(low_priority_task.retry.called)
+
+    @override_settings(TASK_RETRY_BUDGET=10)
+    @patch('news.tasks.retry_budget')
+    def test_deferred_run_not_an_attempt(self, budget_mock):
+        """A task run again after waiting for the API limit isn't counted as a first try"""
+        @et_task
+        def deferred_task():
+            pass
+
+        deferred_task.run(deferred=True)
+        self.assertFalse(budget_mock.record_attempt.called)
+        deferred_task.run()
+        self.assertTrue(budget_mock.record_attempt.called)
+
+
+@override_settings(TASK_RETRY_STORE=True)
+class DelayedRetryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def get_task(self, retries, called_directly=False):
+        @et_task
+        def failing_task(email):
+            raise URLError(reason=Exception('foo bar!'))
+
+        failing_task.push_request(id='the-task-id', retries=retries,
+                                  args=['dude@example.com'], kwargs={'start_time': 10},
+                                  called_directly=called_directly)
+        failing_task.retry = Mock(side_effect=Exception('should be parked'))
+        return failing_task
+
+    @patch('news.retries.uniform', lambda low, high: high)
+    def test_retry_parked(self):
+        failing_task = self.get_task(retries=2)
+        with self.assertRaises(Retry):
+            failing_task.run('dude@example.com')
+
+        delayed = DelayedTask.objects.get()
+        self.assertEqual(delayed.task_id, 'the-task-id')
+        self.assertEqual(delayed.name, failing_task.name)
+        self.assertEqual(delayed.args, ['dude@example.com'])
+        self.assertEqual(delayed.kwargs, {'start_time': 10})
+        self.assertEqual(delayed.retries, 3)
+        self.assertAlmostEqual((delayed.due - now()).total_seconds(), 8 * 60, delta=5)
+
+    def test_called_directly_not_parked(self):
+        """A task run in the calling process has nothing to release it from the table"""
+        failing_task = self.get_task(retries=2, called_directly=True)
+        with self.assertRaises(Exception):
+            failing_task.run('dude@example.com')
+
+        self.assertTrue(failing_task.retry.called)
+        self.assertFalse(DelayedTask.objects.exists())
+
+    def test_max_retries(self):
+        failing_task = self.get_task(retries=8)
+        with self.assertRaises(URLError):
+            failing_task.run('dude@example.com')
+
+        self.assertFalse(DelayedTask.objects.exists())
+
+    @override_settings(TASK_RETRY_RELEASE_MAX=2)
+    @patch('news.models.celery_app')
+    def test_release_due_tasks(self, celery_mock):
+        for minutes in (-3, -2, -1, 5):
+            DelayedTask.objects.create(due=now() + timedelta(minutes=minutes), task_id=minutes,
+                                       name='news.tasks.send_message', args=['the-message'],
+                                       retries=2)
+
+        release_delayed_tasks()
+        self.assertEqual(celery_mock.send_task.call_count, 2)
+        celery_mock.send_task.assert_called_with('news.tasks.send_message', args=['the-message'],
+                                                 kwargs={}, task_id='-2', retries=2)
+        self.assertEqual([task.task_id for task in DelayedTask.objects.all()], ['-1', '5'])
+
 
 class AddFxaActivityTests(TestCase):
     def _base_test(self, user_agent=False, fxa_id='123', first_device=True):
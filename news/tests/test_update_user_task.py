@@ -148,6 +148,7 @@ class UpdateUserTaskTests(TestCase):
 
         self.assert_response_ok(response, token='mytoken', created=True)
         self.upsert_contact.assert_called_with(SUBSCRIBE, data, gud_mock.return_value)
+        gud_mock.assert_called_with(email='a@example.com', token=None, use_cache=False)
 
     @patch('news.views.newsletter_slugs')
     @patch('news.views.newsletter_private_slugs')
@@ -1,9 +1,12 @@
+from itertools import count
+
+from django.core.cache import cache
 from django.test import TestCase
 
 from mock import patch, ANY, call
 
 from news import models
-from news.tasks import upsert_user
+from news.tasks import queue_upsert_user, upsert_user
 from news.utils import SET, SUBSCRIBE, UNSUBSCRIBE, generate_token
 
 
@@ -121,11 +124,12 @@ class UpsertUserTests(TestCase):
         get_user_data.return_value = self.get_user_data
 
         upsert_user(SET, data)
-        # We should have looked up the user's data
-        get_user_data.assert_called()
+        # We should have looked up the user's data, bypassing the contact cache
+        get_user_data.assert_called_with(self.token, self.email, extra_fields=['id'],
+                                         use_cache=False)
         # We'll specifically unsubscribe each newsletter the user is
         # subscribed to.
-        sfdc_mock.update.assert_called_with(self.get_user_data, sfdc_data)
+        sfdc_mock.update.assert_called_with(self.get_user_data, sfdc_data, diff=True)
 
     @patch('news.tasks.get_user_data')
     @patch('news.tasks.sfdc')
@@ -159,7 +163,7 @@ class UpsertUserTests(TestCase):
         # We should have looked up the user's data
         get_user_data.assert_called()
         # We should not have mentioned this newsletter in our call to ET
-        sfdc_mock.update.assert_called_with(self.get_user_data, sfdc_data)
+        sfdc_mock.update.assert_called_with(self.get_user_data, sfdc_data, diff=True)
 
     @patch('news.tasks.get_user_data')
     @patch('news.tasks.sfdc')
@@ -195,7 +199,7 @@ class UpsertUserTests(TestCase):
         # We should have looked up the user's data
         self.assertTrue(get_user_data.called)
         # We should not have mentioned this newsletter in our call to SF
-        sfdc_mock.update.assert_called_with(self.get_user_data, sfdc_data)
+        sfdc_mock.update.assert_called_with(self.get_user_data, sfdc_data, diff=True)
 
     @patch('news.tasks.get_user_data')
     @patch('news.tasks.sfdc')
@@ -234,7 +238,7 @@ class UpsertUserTests(TestCase):
         upsert_user(UNSUBSCRIBE, data)
         # We should have looked up the user's data
         self.assertTrue(get_user_data.called)
-        sfdc_mock.update.assert_called_with(self.get_user_data, sfdc_data)
+        sfdc_mock.update.assert_called_with(self.get_user_data, sfdc_data, diff=True)
 
     @patch('news.tasks.sfdc')
     @patch('news.tasks.get_user_data')
@@ -274,4 +278,89 @@ class UpsertUserTests(TestCase):
         # We should only mention slug, not slug2
         sfdc_data['newsletters'] = {'slug': True}
         upsert_user(SUBSCRIBE, data)
-        sfdc_mock.update.assert_called_with(get_user_mock.return_value, sfdc_data)
+        sfdc_mock.update.assert_called_with(get_user_mock.return_value, sfdc_data, diff=True)
+
+
+@patch('news.tasks.get_user_data')
+@patch('news.tasks.sfdc')
+@patch('news.tasks.upsert_user.apply_async')
+class CoalescedUpsertUserTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user_data = {
+            'status': 'ok',
+            'email': 'dude@example.com',
+            'token': 'the-token',
+            'newsletters': ['slug'],
+            'optin': True,
+        }
+
+    def queue(self, apply_mock, api_call_type, newsletters):
+        queue_upsert_user(api_call_type, {
+            'email': 'dude@example.com',
+            'newsletters': newsletters,
+        })
+        args, kwargs = apply_mock.call_args[0]
+        kwargs.pop('start_time')
+        return args, kwargs
+
+    def test_changes_applied_in_order(self, apply_mock, sfdc_mock, get_user_mock):
+        get_user_mock.return_value = self.user_data
+        first = self.queue(apply_mock, SUBSCRIBE, 'other')
+        second = self.queue(apply_mock, SET, 'slug')
+        self.assertEqual(apply_mock.call_args[1], {'countdown': 0})
+
+        upsert_user(*first[0], **first[1])
+        # subscribed to other, then set back to only slug
+        sfdc_mock.update.assert_called_once_with(self.user_data, {
+            'email': 'dude@example.com',
+            'newsletters': {},
+        }, diff=True)
+
+        upsert_user(*second[0], **second[1])
+        self.assertEqual(sfdc_mock.update.call_count, 1)
+        self.assertEqual(get_user_mock.call_count, 1)
+
+    def test_new_contact(self, apply_mock, sfdc_mock, get_user_mock):
+        get_user_mock.return_value = None
+        first = self.queue(apply_mock, SUBSCRIBE, 'slug')
+        self.queue(apply_mock, SUBSCRIBE, 'other')
+        self.queue(apply_mock, UNSUBSCRIBE, 'slug')
+        upsert_user(*first[0], **first[1])
+        self.assertFalse(sfdc_mock.update.called)
+        sfdc_mock.add.assert_called_once_with({
+            'email': 'dude@example.com',
+            'newsletters': {'other': True},
+            'token': ANY,
+        })
+
+    @patch('news.tasks.time')
+    def test_email_and_token_changes_applied_in_order(self, time_mock, apply_mock, sfdc_mock,
+                                                      get_user_mock):
+        """Changes queued under the email and the token of a contact are applied together"""
+        time_mock.side_effect = count(100)
+        get_user_mock.return_value = self.user_data
+        first = self.queue(apply_mock, SUBSCRIBE, 'other')
+        queue_upsert_user(UNSUBSCRIBE, {'token': 'the-token', 'newsletters': 'other'})
+        second = apply_mock.call_args[0]
+
+        # the task for the later change runs first
+        upsert_user(*second[0], **second[1])
+        sfdc_mock.update.assert_called_once_with(self.user_data, {
+            'email': 'dude@example.com',
+            'token': 'the-token',
+            'newsletters': {},
+        }, diff=True)
+
+        upsert_user(*first[0], **first[1])
+        self.assertEqual(sfdc_mock.update.call_count, 1)
+
+    def test_change_lost_from_cache(self, apply_mock, sfdc_mock, get_user_mock):
+        get_user_mock.return_value = self.user_data
+        args, kwargs = self.queue(apply_mock, UNSUBSCRIBE, 'slug')
+        cache.clear()
+        upsert_user(*args, **kwargs)
+        sfdc_mock.update.assert_called_once_with(self.user_data, {
+            'email': 'dude@example.com',
+            'newsletters': {'slug': False},
+        }, diff=True)
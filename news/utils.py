@@ -21,6 +21,7 @@ from news.backends.sfdc import sfdc
 from news.models import APIUser, BlockedEmail
 from news.newsletters import newsletter_inactive_slugs, newsletter_group_newsletter_slugs, \
     newsletter_languages
+from news.replica import get_replica_contact
 
 
 # Error messages
@@ -180,7 +181,8 @@ IGNORE_USER_FIELDS = [
 ]
 
 
-def get_user_data(token=None, email=None, extra_fields=None):
+def get_user_data(token=None, email=None, extra_fields=None, use_replica=False,
+                  use_cache=True):
     """Return a dictionary of the user's data from Exact Target.
     Look them up by their email if given, otherwise by the token.
 
@@ -212,9 +214,54 @@ def get_user_data(token=None, email=None, extra_fields=None):
         'pending': True if we're waiting for user to confirm subscription
         'master': True if we found them in the master subscribers table
     }
+
+    With `use_replica` the user's data may come from the local replica of SFDC
+    contacts instead, if it was synced within SFDC_REPLICA_MAX_AGE seconds, or within
+    SFDC_REPLICA_OUTAGE_MAX_AGE when SFDC can't be reached. It can be a little out of
+    date, so only use it to show the data, not to decide what to change.
+
+    With `use_cache` False the user's data always comes from SFDC rather than the
+    contact cache (see SFDC_CONTACT_CACHE_TIMEOUT). Use that for data that decides what
+    to change.
+    """
+    user = None
+    if use_replica:
+        user = get_replica_contact(token, email, settings.SFDC_REPLICA_MAX_AGE)
+
+    if user is None:
+        try:
+            user = get_sfdc_contact(token, email, use_cache)
+        except NewsletterException:
+            if use_replica:
+                # an older copy is better than an error while SFDC is unavailable
+                user = get_replica_contact(token, email, settings.SFDC_REPLICA_OUTAGE_MAX_AGE)
+            if user is None:
+                raise
+
+            statsd.incr('news.utils.get_user_data.replica_fallback')
+
+    if user is None:
+        return None
+
+    return clean_user_data(user, extra_fields)
+
+
+def get_replica_user_data(token=None, email=None):
     """
+    Return the user's data from the replica for when SFDC can't be used (e.g. in
+    maintenance mode), or None if it isn't there or hasn't been synced lately.
+    """
+    user = get_replica_contact(token, email, settings.SFDC_REPLICA_OUTAGE_MAX_AGE)
+    if user is None:
+        return None
+
+    return clean_user_data(user)
+
+
+def get_sfdc_contact(token=None, email=None, use_cache=True):
+    """Return the contact from SFDC, or None if it doesn't exist"""
     try:
-        user = sfdc.get(token, email)
+        return sfdc.get(token, email, use_cache=use_cache)
     except sfapi.SalesforceResourceNotFound:
         return None
     except requests.exceptions.RequestException as e:
@@ -226,7 +273,10 @@ def get_user_data(token=None, email=None, extra_fields=None):
                                   error_code=errors.BASKET_EMAIL_PROVIDER_AUTH_FAILURE,
                                   status_code=500)
 
+
+def clean_user_data(user, extra_fields=None):
     # don't send some of the returned data
+    user = user.copy()
     for fn in IGNORE_USER_FIELDS:
         if extra_fields and fn not in extra_fields:
             user.pop(fn, None)
@@ -237,7 +287,11 @@ def get_user_data(token=None, email=None, extra_fields=None):
 
 def get_user(token=None, email=None):
     if settings.MAINTENANCE_MODE and not settings.MAINTENANCE_READ_ONLY:
-        # can't return user data during maintenance
+        # can't read from SFDC during maintenance, but the replica may have the user
+        user_data = get_replica_user_data(token, email)
+        if user_data:
+            return HttpResponseJSON(user_data)
+
         return HttpResponseJSON({
             'status': 'error',
             'desc': 'user data is not available in maintenance mode',
@@ -245,7 +299,7 @@ def get_user(token=None, email=None):
         }, 400)
 
     try:
-        user_data = get_user_data(token, email)
+        user_data = get_user_data(token, email, use_replica=True)
         status_code = 200
     except NewsletterException as e:
         return newsletter_exception_response(e)
@@ -24,6 +24,7 @@ from news.tasks import (
     add_fxa_activity,
     add_sms_user,
     confirm_user,
+    queue_upsert_user,
     send_recovery_message_task,
     update_custom_unsub,
     update_fxa_info,
@@ -40,6 +41,7 @@ from news.utils import (
     email_is_blocked,
     get_accept_languages,
     get_best_language,
+    get_replica_user_data,
     get_user_data,
     get_user,
     has_valid_api_key,
@@ -568,11 +570,12 @@ def lookup_user(request):
     Otherwise, status is 200 and json is the return value from
     `get_user_data`. See that method for details.
 
-    Note that because this method always calls Exact Target one or
-    more times, it can be slower than some other Basket APIs, and will
-    fail if ET is down.
+    Note that unless SFDC_REPLICA_READS is enabled this method always calls
+    Salesforce, so it can be slower than some other Basket APIs, and will
+    fail if Salesforce is down.
     """
-    if settings.MAINTENANCE_MODE and not settings.MAINTENANCE_READ_ONLY:
+    maintenance = settings.MAINTENANCE_MODE and not settings.MAINTENANCE_READ_ONLY
+    if maintenance and not settings.SFDC_REPLICA_READS:
         # can't return user data during maintenance
         return HttpResponseJSON({
             'status': 'error',
@@ -610,10 +613,20 @@ def lookup_user(request):
         if not email:
             return invalid_email_response()
 
-    try:
-        user_data = get_user_data(token=token, email=email)
-    except NewsletterException as e:
-        return newsletter_exception_response(e)
+    if maintenance:
+        # can't read from SFDC during maintenance, but the replica may have the user
+        user_data = get_replica_user_data(token=token, email=email)
+        if not user_data:
+            return HttpResponseJSON({
+                'status': 'error',
+                'desc': 'user data is not available in maintenance mode',
+                'code': errors.BASKET_NETWORK_FAILURE,
+            }, 400)
+    else:
+        try:
+            user_data = get_user_data(token=token, email=email, use_replica=True)
+        except NewsletterException as e:
+            return newsletter_exception_response(e)
 
     status_code = 200
     if not user_data:
@@ -729,7 +742,8 @@ def update_user_task(request, api_call_type, data=None, optin=False, sync=False)
             }, 400)
 
         try:
-            user_data = get_user_data(email=email, token=token)
+            # only changes are sent, so this must not be a stale cached copy
+            user_data = get_user_data(email=email, token=token, use_cache=False)
         except NewsletterException as e:
             return newsletter_exception_response(e)
 
@@ -749,7 +763,11 @@ def update_user_task(request, api_call_type, data=None, optin=False, sync=False)
             'created': created,
         })
     else:
-        upsert_user.delay(api_call_type, data, start_time=time())
+        if settings.UPSERT_COALESCE_WINDOW:
+            queue_upsert_user(api_call_type, data)
+        else:
+            upsert_user.delay(api_call_type, data, start_time=time())
+
         return HttpResponseJSON({
             'status': 'ok',
         })
@@ -199,6 +199,33 @@ SFMC_SETTINGS = {
 if ET_CLIENT_ID and ET_CLIENT_SECRET:
     SFMC_SETTINGS['clientid'] = ET_CLIENT_ID
     SFMC_SETTINGS['clientsecret'] = ET_CLIENT_SECRET
+# Directory to keep the parsed SFMC WSDL in so that new processes don't have to parse it.
+# Must be writable. If empty suds' default cache is used, which keeps it in the temp
+# directory for a day.
+SFMC_WSDL_CACHE_DIR = config('SFMC_WSDL_CACHE_DIR', '')
+# Minutes between runs of the task that gets a new SFMC token for all processes once the
+# current one expires within SFMC_TOKEN_REFRESH_AHEAD seconds, so that requests don't
+# have to wait for one. The interval must be well under the lead time, e.g. 5. 0 to disable.
+SFMC_TOKEN_REFRESH_INTERVAL = config('SFMC_TOKEN_REFRESH_INTERVAL', 0, cast=int)
+SFMC_TOKEN_REFRESH_AHEAD = config('SFMC_TOKEN_REFRESH_AHEAD', 60 * 15, cast=int)
+
+# Send data extension rows added or upserted by tasks running concurrently in a worker
+# process (threaded, gevent, or eventlet pools) together in one SOAP request.
+SFMC_BATCH_WRITES = config('SFMC_BATCH_WRITES', False, cast=bool)
+# max number of rows per request
+SFMC_BATCH_SIZE = config('SFMC_BATCH_SIZE', 100, cast=int)
+# seconds to wait for more rows, subscribers or phone numbers before sending a batch
+SFMC_BATCH_WAIT = config('SFMC_BATCH_WAIT', 0.5, cast=float)
+# Send the same message to the subscribers of tasks running concurrently in a worker
+# process in one Triggered Send request.
+SFMC_BATCH_SENDS = config('SFMC_BATCH_SENDS', False, cast=bool)
+# max number of subscribers per Triggered Send request
+SFMC_SEND_BATCH_SIZE = config('SFMC_SEND_BATCH_SIZE', 100, cast=int)
+# Send the same SMS message to the numbers of tasks running concurrently in a worker
+# process in one request. Mobile_Subscribers opt-in rows are batched by SFMC_BATCH_WRITES.
+SFMC_BATCH_SMS = config('SFMC_BATCH_SMS', False, cast=bool)
+# max number of phone numbers per SMS send request
+SFMC_SMS_BATCH_SIZE = config('SFMC_SMS_BATCH_SIZE', 100, cast=int)
 
 # Salesforce.com
 SFDC_SETTINGS = {
@@ -206,10 +233,69 @@ SFDC_SETTINGS = {
     'password': config('SFDC_PASSWORD', None),
     'security_token': config('SFDC_SEC_TOKEN', None),
     'sandbox': config('SFDC_USE_SANDBOX', USE_SANDBOX_BACKEND, cast=bool),
+    # log in here instead of Salesforce.com, e.g. http://localhost:8500 for run_fake_sfdc
+    'login_url': config('SFDC_LOGIN_URL', None),
 }
 # default SFDC sessions timeout after 2 hours of inactivity. so they never timeout on
 # prod. Let's make it every 4 hours by default.
 SFDC_SESSION_TIMEOUT = config('SFDC_SESSION_TIMEOUT', 60 * 60 * 4, cast=int)
+# Percent of the daily SFDC API limit after which tasks of low or normal priority
+# are retried later. Interactive requests are never delayed.
+SFDC_API_LIMIT_LOW_PRIORITY_PERCENT = config('SFDC_API_LIMIT_LOW_PRIORITY_PERCENT', 80, cast=float)
+SFDC_API_LIMIT_NORMAL_PRIORITY_PERCENT = config('SFDC_API_LIMIT_NORMAL_PRIORITY_PERCENT', 95,
+                                                cast=float)
+# Seconds to cache contact records fetched from SFDC, by token and email. 0 disables caching.
+# Cached records are removed when basket adds, updates, or deletes the contact, but a
+# lookup racing a write can still cache the old record for this long.
+SFDC_CONTACT_CACHE_TIMEOUT = config('SFDC_CONTACT_CACHE_TIMEOUT', 0, cast=int)
+# Look contacts up with a SOQL query for only the fields basket uses instead of
+# fetching every field of the record.
+SFDC_QUERY_LOOKUPS = config('SFDC_QUERY_LOOKUPS', False, cast=bool)
+# Send contact creates and updates from tasks running concurrently in a worker process
+# (threaded, gevent, or eventlet pools) together in sObject Collections requests.
+SFDC_BATCH_WRITES = config('SFDC_BATCH_WRITES', False, cast=bool)
+# max number of records per request (Salesforce allows up to 200)
+SFDC_BATCH_SIZE = config('SFDC_BATCH_SIZE', 200, cast=int)
+# seconds to wait for more records before sending a batch
+SFDC_BATCH_WAIT = config('SFDC_BATCH_WAIT', 0.5, cast=float)
+# Remember the Salesforce Contact Id for each token and email tasks see, so that
+# they can write to a known contact by Id without looking it up first.
+SFDC_CONTACT_ID_INDEX = config('SFDC_CONTACT_ID_INDEX', False, cast=bool)
+# Minutes between copying contacts changed in SFDC into the local replica. 0 disables syncing.
+SFDC_REPLICA_SYNC_INTERVAL = config('SFDC_REPLICA_SYNC_INTERVAL', 0, cast=int)
+# max contacts copied per sync. The rest are copied by the next one.
+SFDC_REPLICA_SYNC_MAX_RECORDS = config('SFDC_REPLICA_SYNC_MAX_RECORDS', 50000, cast=int)
+# Answer user lookups from the replica when it was synced within SFDC_REPLICA_MAX_AGE
+# seconds, or within SFDC_REPLICA_OUTAGE_MAX_AGE when SFDC is down or in maintenance.
+SFDC_REPLICA_READS = config('SFDC_REPLICA_READS', False, cast=bool)
+SFDC_REPLICA_MAX_AGE = config('SFDC_REPLICA_MAX_AGE', 900, cast=int)
+SFDC_REPLICA_OUTAGE_MAX_AGE = config('SFDC_REPLICA_OUTAGE_MAX_AGE', 86400, cast=int)
+
+# Connection pooling for HTTP requests to the SFDC and SFMC APIs
+# max connections kept open per vendor host in each process
+VENDOR_HTTP_POOL_SIZE = config('VENDOR_HTTP_POOL_SIZE', 10, cast=int)
+VENDOR_HTTP_KEEP_ALIVE = config('VENDOR_HTTP_KEEP_ALIVE', True, cast=bool)
+# seconds
+VENDOR_HTTP_CONNECT_TIMEOUT = config('VENDOR_HTTP_CONNECT_TIMEOUT', 5, cast=float)
+VENDOR_HTTP_READ_TIMEOUT = config('VENDOR_HTTP_READ_TIMEOUT', 30, cast=float)
+# Times to retry a request after a connection error or reset. Requests that may have
+# reached the vendor are only retried for idempotent methods (not POST or PATCH). A call
+# can take up to (connect + read timeout) * (retries + 1) seconds, 70 by default.
+VENDOR_HTTP_RETRIES = config('VENDOR_HTTP_RETRIES', 1, cast=int)
+# Stop calling SFDC or SFMC for a while once this many calls fail with network or
+# server errors within the window (seconds), so that requests fail fast instead of
+# tying up workers. After the reset timeout (seconds) a single trial call is let through.
+VENDOR_CIRCUIT_BREAKER_ENABLE = config('VENDOR_CIRCUIT_BREAKER_ENABLE', False, cast=bool)
+VENDOR_CIRCUIT_BREAKER_THRESHOLD = config('VENDOR_CIRCUIT_BREAKER_THRESHOLD', 20, cast=int)
+VENDOR_CIRCUIT_BREAKER_WINDOW = config('VENDOR_CIRCUIT_BREAKER_WINDOW', 60, cast=int)
+VENDOR_CIRCUIT_BREAKER_RESET_TIMEOUT = config('VENDOR_CIRCUIT_BREAKER_RESET_TIMEOUT', 30,
+                                              cast=int)
+# Max calls to each vendor a process makes at once, e.g. with gevent workers. 0 for no limit.
+# Keep VENDOR_HTTP_POOL_SIZE at least this large. Calls waiting for a batch
+# (SFDC_BATCH_WRITES) count toward the limit.
+VENDOR_MAX_CONCURRENCY = config('VENDOR_MAX_CONCURRENCY', 0, cast=int)
+# seconds a call waits for a slot before failing
+VENDOR_CONCURRENCY_WAIT = config('VENDOR_CONCURRENCY_WAIT', 5, cast=float)
 
 CORS_ORIGIN_ALLOW_ALL = True
 CORS_URLS_REGEX = r'^/news/.*$'
@@ -224,6 +310,34 @@ CELERY_DISABLE_RATE_LIMITS = True
 CELERY_IGNORE_RESULT = True
 CELERYD_PREFETCH_MULTIPLIER = config('CELERYD_PREFETCH_MULTIPLIER', 1, cast=int)
 CELERY_MESSAGE_COMPRESSION = 'gzip'
+# Number of queues (basket-affinity-0, basket-affinity-1, ...) to send the tasks for an
+# email or token to instead of locking it. Each needs a worker with a concurrency of 1.
+TASK_AFFINITY_QUEUES = config('TASK_AFFINITY_QUEUES', 0, cast=int)
+# Send news.tasks to queues by priority and backend (see news.routers). A worker started
+# without -Q consumes all of them.
+TASK_QUEUES_ENABLE = config('TASK_QUEUES_ENABLE', False, cast=bool)
+# The affinity queues come first. All of the tasks for a subscriber must go to its queue
+# to run in order without the lock, so with both on they skip the priority queues.
+CELERY_ROUTES = []
+if TASK_AFFINITY_QUEUES:
+    CELERY_ROUTES.append('news.routers.AffinityRouter')
+if TASK_QUEUES_ENABLE:
+    CELERY_ROUTES.append('news.routers.QueueRouter')
+# Seconds between reports of the depth and age of each queue. 0 to disable.
+QUEUE_STATS_INTERVAL = config('QUEUE_STATS_INTERVAL', 0, cast=int)
+# Keep task retries in the database until they're due instead of as ETA messages in
+# worker memory, and queue at most TASK_RETRY_RELEASE_MAX of them every
+# TASK_RETRY_RELEASE_INTERVAL seconds.
+TASK_RETRY_STORE = config('TASK_RETRY_STORE', False, cast=bool)
+TASK_RETRY_RELEASE_INTERVAL = config('TASK_RETRY_RELEASE_INTERVAL', 10, cast=int)
+TASK_RETRY_RELEASE_MAX = config('TASK_RETRY_RELEASE_MAX', 500, cast=int)
+# Allow task retries of at most TASK_RETRY_BUDGET percent of the first tries, and at
+# least TASK_RETRY_BUDGET_MIN, over TASK_RETRY_BUDGET_WINDOW seconds. Retries over the
+# budget wait at least TASK_RETRY_BUDGET_DELAY seconds. 0 to disable.
+TASK_RETRY_BUDGET = config('TASK_RETRY_BUDGET', 0, cast=int)
+TASK_RETRY_BUDGET_WINDOW = config('TASK_RETRY_BUDGET_WINDOW', 600, cast=int)
+TASK_RETRY_BUDGET_MIN = config('TASK_RETRY_BUDGET_MIN', 10, cast=int)
+TASK_RETRY_BUDGET_DELAY = config('TASK_RETRY_BUDGET_DELAY', 30 * 60, cast=int)
 
 SNITCH_ID = config('SNITCH_ID', None)
 
@@ -235,6 +349,30 @@ if SNITCH_ID:
         'schedule': timedelta(minutes=5),
     }
 
+if SFDC_REPLICA_SYNC_INTERVAL:
+    CELERYBEAT_SCHEDULE['sync_contact_replica'] = {
+        'task': 'news.tasks.sync_contact_replica',
+        'schedule': timedelta(minutes=SFDC_REPLICA_SYNC_INTERVAL),
+    }
+
+if SFMC_TOKEN_REFRESH_INTERVAL:
+    CELERYBEAT_SCHEDULE['refresh_sfmc_token'] = {
+        'task': 'news.tasks.refresh_sfmc_token',
+        'schedule': timedelta(minutes=SFMC_TOKEN_REFRESH_INTERVAL),
+    }
+
+if QUEUE_STATS_INTERVAL:
+    CELERYBEAT_SCHEDULE['queue_stats'] = {
+        'task': 'news.tasks.queue_stats',
+        'schedule': timedelta(seconds=QUEUE_STATS_INTERVAL),
+    }
+
+if TASK_RETRY_STORE:
+    CELERYBEAT_SCHEDULE['release_delayed_tasks'] = {
+        'task': 'news.tasks.release_delayed_tasks',
+        'schedule': timedelta(seconds=TASK_RETRY_RELEASE_INTERVAL),
+    }
+
 
 # via http://stackoverflow.com/a/6556951/107114
 def get_default_gateway_linux():
@@ -307,6 +445,9 @@ MAINTENANCE_READ_ONLY = config('MAINTENANCE_READ_ONLY', False, cast=bool)
 
 TASK_LOCK_TIMEOUT = config('TASK_LOCK_TIMEOUT', 60, cast=int)
 TASK_LOCKING_ENABLE = config('TASK_LOCKING_ENABLE', False, cast=bool)
+# Seconds to wait before running an upsert_user task from the subscribe views, so that
+# the changes a user makes within that time are applied together. 0 to disable.
+UPSERT_COALESCE_WINDOW = config('UPSERT_COALESCE_WINDOW', 0, cast=int)
 
 DONATE_ACCESS_KEY_ID = config('DONATE_ACCESS_KEY_ID', default='')
 DONATE_SECRET_ACCESS_KEY = config('DONATE_SECRET_ACCESS_KEY', default='')